@@ -1,8 +1,136 @@
 #!/usr/bin/env python3
-import subprocess
+"""
+Проверка версии Chrome в проекте.
+
+get_chrome_version() не запускает браузер, если версию можно узнать без
+этого: сначала смотрит кеш (ключ - inode/mtime/size бинарника), затем
+install.json рядом с бинарником (пишет update_chrome.py), затем имя
+версионного каталога chrome-versions/<версия>. Только если ничего не
+нашлось, запускается `chrome --version`, и результат тоже кешируется.
+Поэтому health check парсера стоит один stat() вместо запуска процесса.
+"""
+import json
 import os
+import re
+import subprocess
+from collections import namedtuple
+from datetime import datetime
 from pathlib import Path
 
+INSTALL_METADATA = 'install.json'
+VERSION_CACHE = '.version_cache.json'
+
+ChromeVersion = namedtuple('ChromeVersion', ['version', 'version_line', 'source'])
+
+# Кеш в памяти процесса: {(realpath, inode, mtime_ns, size): ChromeVersion}
+_version_cache = {}
+
+_VERSION_RE = re.compile(r'(\d+(?:\.\d+){2,})')
+
+
+def _stat_key(chrome_path):
+    real_path = os.path.realpath(chrome_path)
+    st = os.stat(real_path)
+    return real_path, (real_path, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    """Запись через временный файл, чтобы читатели не видели половину JSON."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError:
+        # Нет прав на запись - просто работаем без дискового кеша
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def _from_metadata(binary_dir):
+    metadata = _read_json(os.path.join(binary_dir, INSTALL_METADATA))
+    if metadata and metadata.get('version'):
+        line = metadata.get('version_line') or f"Google Chrome {metadata['version']}"
+        return ChromeVersion(metadata['version'], line, 'metadata')
+    return None
+
+
+def _from_directory_name(binary_dir):
+    name = os.path.basename(binary_dir)
+    if _VERSION_RE.fullmatch(name):
+        return ChromeVersion(name, f'Google Chrome {name}', 'directory')
+    return None
+
+
+def _from_exec(chrome_path):
+    result = subprocess.run(
+        [str(chrome_path), '--version'],
+        capture_output=True,
+        text=True,
+        timeout=5
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or f'exit code {result.returncode}')
+    line = result.stdout.strip()
+    match = _VERSION_RE.search(line)
+    return ChromeVersion(match.group(1) if match else line, line, 'exec')
+
+
+def get_chrome_version(chrome_path, allow_exec=True):
+    """Версия Chrome без запуска процесса (если возможно).
+
+    Возвращает ChromeVersion(version, version_line, source), где source -
+    'cache', 'metadata', 'directory' или 'exec'. Если бинарника нет или
+    версию узнать нельзя (allow_exec=False), возвращает None.
+    """
+    try:
+        real_path, key = _stat_key(chrome_path)
+    except OSError:
+        return None
+
+    cached = _version_cache.get(key)
+    if cached is not None:
+        return cached._replace(source='cache')
+
+    binary_dir = os.path.dirname(real_path)
+    cache_file = os.path.join(binary_dir, VERSION_CACHE)
+    disk_cache = _read_json(cache_file)
+    if disk_cache and disk_cache.get('key') == list(key):
+        info = ChromeVersion(disk_cache['version'], disk_cache['version_line'], 'cache')
+        _version_cache[key] = info
+        return info
+
+    info = _from_metadata(binary_dir) or _from_directory_name(binary_dir)
+    if info is None:
+        if not allow_exec:
+            return None
+        info = _from_exec(real_path)
+
+    _version_cache[key] = info
+    _write_json(cache_file, {
+        'key': list(key),
+        'version': info.version,
+        'version_line': info.version_line,
+    })
+    return info
+
+
+def write_install_metadata(binary_dir, version, version_line):
+    """Сохранить install.json рядом с бинарником (вызывается при установке)."""
+    _write_json(os.path.join(binary_dir, INSTALL_METADATA), {
+        'version': version,
+        'version_line': version_line,
+        'installed_at': datetime.now().isoformat(timespec='seconds'),
+    })
+
 
 def check_chrome_version():
     # Путь к Chrome в проекте
@@ -22,30 +150,22 @@ def check_chrome_version():
 
     # Проверить версию
     try:
-        result = subprocess.run(
-            [str(chrome_path), '--version'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-
-        if result.returncode == 0:
-            version = result.stdout.strip()
-            print(f"✅ Chrome version: {version}")
-
-            # Проверить что это не старый Chromium 116
-            if 'Chromium 116' in version:
-                print("❌ STILL OLD Chromium 116!")
-            elif '128.' in version or '129.' in version:
-                print("✅ Good! Modern Chrome detected")
-            else:
-                print(f"⚠ Unknown version")
-        else:
-            print(f"❌ Error: {result.stderr}")
-
+        info = get_chrome_version(chrome_path)
     except Exception as e:
         print(f"❌ Cannot run Chrome: {e}")
+        return
+
+    version = info.version_line
+    print(f"✅ Chrome version: {version} (source: {info.source})")
+
+    # Проверить что это не старый Chromium 116
+    if 'Chromium 116' in version:
+        print("❌ STILL OLD Chromium 116!")
+    elif '128.' in version or '129.' in version:
+        print("✅ Good! Modern Chrome detected")
+    else:
+        print(f"⚠ Unknown version")
 
 
 if __name__ == '__main__':
-    check_chrome_version()
\ No newline at end of file
+    check_chrome_version()
@@ -28,6 +28,20 @@ DATABASES = {
 }
 
 DATABASE_ROUTERS = [
+    'conf.read_routing.PlanningReadRouter',
     'conf.routers.DefaultRouter',
     'one_c_raw.router.Router',
 ]
+
+# Алиас для чтений фазы планирования команд дедупликации (--read-from)
+DEDUPE_READ_ALIAS = os.getenv('DEDUPE_READ_ALIAS', 'backup')
+# Допустимое отставание реплики, секунд; при большем - чтение из default
+DEDUPE_REPLICA_MAX_LAG = float(os.getenv('DEDUPE_REPLICA_MAX_LAG', '60'))
+# Каталог временных файлов внешней сортировки (--grouping external); пусто - системный
+DEDUPE_SPILL_DIR = os.getenv('DEDUPE_SPILL_DIR', '')
+# Отставание реплик, при котором пакетные изменения уменьшают пачку, секунд (_batching)
+DEDUPE_BATCH_MAX_LAG = float(os.getenv('DEDUPE_BATCH_MAX_LAG', '10'))
+# Кэш кодов номенклатур с удаленными поставщиками (linked/removed_suppliers.py):
+# файл (пусто - var/removed_suppliers.cache в каталоге проекта) и время жизни, секунд
+REMOVED_SUPPLIERS_CACHE_PATH = os.getenv('REMOVED_SUPPLIERS_CACHE_PATH', '')
+REMOVED_SUPPLIERS_CACHE_TTL = int(os.getenv('REMOVED_SUPPLIERS_CACHE_TTL', '3600'))
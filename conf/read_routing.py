@@ -0,0 +1,85 @@
+"""
+Маршрутизация чтений фазы планирования на реплику.
+
+Команды дедупликации сначала долго читают (группировка товаров, даты
+последней информации, количество истории, превью), а затем пишут. Чтения
+внутри route_reads(alias) уходят на alias - но только для моделей, которые
+и так читаются из default; остальные роутеры (например, 1С) не затрагиваются.
+Запись всегда идет в default, в том числе сохранение и удаление объектов,
+загруженных с реплики.
+
+Роутер должен стоять в DATABASE_ROUTERS первым: вне route_reads он ничего
+не решает и передает выбор следующим роутерам.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import DEFAULT_DB_ALIAS, router
+
+_read_alias = ContextVar('planning_read_alias', default=None)
+
+# Алиасы, которые когда-либо использовались для чтения планирования:
+# объекты оттуда пишутся в default и могут ссылаться на объекты default
+_replica_aliases = set()
+
+# Модель -> читается ли она из default по мнению остальных роутеров
+_default_models = {}
+
+
+@contextmanager
+def route_reads(alias):
+    """Чтения моделей default внутри блока - с alias. None/default - без изменений."""
+    if alias in (None, DEFAULT_DB_ALIAS):
+        yield DEFAULT_DB_ALIAS
+        return
+    _replica_aliases.add(alias)
+    token = _read_alias.set(alias)
+    try:
+        yield alias
+    finally:
+        _read_alias.reset(token)
+
+
+def current_read_alias():
+    return _read_alias.get() or DEFAULT_DB_ALIAS
+
+
+class PlanningReadRouter:
+    def _reads_from_default(self, model):
+        if model not in _default_models:
+            chosen = None
+            for other in router.routers:
+                if other is self or not hasattr(other, 'db_for_read'):
+                    continue
+                chosen = other.db_for_read(model)
+                if chosen:
+                    break
+            _default_models[model] = chosen in (None, DEFAULT_DB_ALIAS)
+        return _default_models[model]
+
+    def db_for_read(self, model, **hints):
+        alias = _read_alias.get()
+        if alias is None:
+            # Связанные объекты товара, загруженного с реплики, после выхода
+            # из route_reads читаются из default (иначе Django взял бы базу экземпляра)
+            instance = hints.get('instance')
+            if instance is not None and instance._state.db in _replica_aliases and self._reads_from_default(model):
+                return DEFAULT_DB_ALIAS
+            return None
+        if not self._reads_from_default(model):
+            return None
+        return alias
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in _replica_aliases and self._reads_from_default(model):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if {obj1._state.db, obj2._state.db} <= {DEFAULT_DB_ALIAS} | _replica_aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        return None
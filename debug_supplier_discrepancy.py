@@ -7,6 +7,7 @@ django.setup()
 
 from one_c_raw.models import Nomenclature
 from linked.helpers import get_ones_nomenclature_qs
+from linked.removed_suppliers import get_removed_suppliers
 from django.conf import settings
 
 
@@ -192,6 +193,11 @@ def check_sql_queries(nomen_base, nomen_ones):
     has_problems = problem_qs.exists()
     print(f"📌 Результат exists(): {has_problems}")
 
+    # Та же проверка без JOIN: битовая карта _mark_remove по коду (linked/removed_suppliers.py)
+    removed = get_removed_suppliers()
+    print(f"📌 Кэш удаленных поставщиков: {nomen_base.code in removed} "
+          f"(номенклатур в кэше: {len(removed)}, возраст: {removed.age:.0f}с)")
+
 
 def check_supplier_discrepancy_detailed(nomenclature_code):
     """Детальная проверка расхождения поставщиков"""
@@ -8,6 +8,7 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conf.docker')
 django.setup()
 
 from linked.helpers import get_ones_nomenclature_qs
+from linked.removed_suppliers import get_removed_suppliers
 from one_c_raw.models import Nomenclature
 
 
@@ -22,6 +23,10 @@ def find_problem_nomenclatures():
 
     print(f"Всего номенклатур для проверки: {total_count}")
 
+    # Коды с удаленными поставщиками одним запросом (кэш на диске) - третья проверка
+    removed_suppliers = get_removed_suppliers()
+    print(f"Номенклатур с удаленными поставщиками (кэш): {len(removed_suppliers)}")
+
     problem_nomenclatures = []
     processed = 0
 
@@ -41,6 +46,10 @@ def find_problem_nomenclatures():
             nomen_obj = get_ones_nomenclature_qs().get(code=code)
             manual_result = nomen_obj.supplier.filter(_mark_remove=1).exists()
 
+            cache_result = code in removed_suppliers
+            if cache_result != manual_result:
+                print(f"⚠️ Кэш расходится с ручной проверкой: {code} (кэш: {cache_result}, ручная: {manual_result})")
+
             if join_result != manual_result:
                 # Собираем информацию о всех поставщиках
                 all_suppliers = nomen_obj.supplier.all()
@@ -60,6 +69,7 @@ def find_problem_nomenclatures():
                     'name': nomen_data['name'],
                     'join_excludes': join_result,
                     'manual_check_excludes': manual_result,
+                    'cache_excludes': cache_result,
                     'suppliers_count': len(all_suppliers),
                     'suppliers_with_mark_remove': len([s for s in all_suppliers if s._mark_remove]),
                     'suppliers': suppliers_info
@@ -99,7 +109,7 @@ def save_to_file(problem_nomenclatures):
     with open(filepath, 'w', newline='', encoding='utf-8') as csvfile:
         fieldnames = [
             'code', 'art', 'name',
-            'join_excludes', 'manual_check_excludes',
+            'join_excludes', 'manual_check_excludes', 'cache_excludes',
             'suppliers_count', 'suppliers_with_mark_remove',
             'suppliers_info'
         ]
@@ -119,6 +129,7 @@ def save_to_file(problem_nomenclatures):
                 'name': nomen['name'],
                 'join_excludes': nomen['join_excludes'],
                 'manual_check_excludes': nomen['manual_check_excludes'],
+                'cache_excludes': nomen['cache_excludes'],
                 'suppliers_count': nomen['suppliers_count'],
                 'suppliers_with_mark_remove': nomen['suppliers_with_mark_remove'],
                 'suppliers_info': suppliers_str
@@ -142,6 +153,7 @@ def show_detailed_analysis(problem_nomenclatures):
         print(f"   Название: {problem['name'][:100]}...")
         print(f"   .filter(supplier___mark_remove=1): {problem['join_excludes']}")
         print(f"   .supplier.filter(_mark_remove=1): {problem['manual_check_excludes']}")
+        print(f"   Кэш удаленных поставщиков: {problem['cache_excludes']}")
         print(f"   Всего поставщиков: {problem['suppliers_count']}")
         print(f"   Поставщиков с _mark_remove=1: {problem['suppliers_with_mark_remove']}")
 
@@ -0,0 +1,201 @@
+# removed_suppliers.py
+"""
+Кэш кодов номенклатур, у которых есть поставщик с _mark_remove=1.
+
+Фильтр .exclude(supplier___mark_remove=1) по кросс-базовой связи на MySQL
+медленный и расходится с проверкой nomen.supplier.filter(_mark_remove=1)
+(см. test_task_logic.py, find_problem_nomenclatures.py). Здесь состояние
+_mark_remove загружается одним потоковым запросом по supplier_nomenclature в
+битовую карту по коду номенклатуры (или множество, если коды не целые), и
+проверка кода - O(1) без запросов к БД.
+
+Карта сохраняется на диск (REMOVED_SUPPLIERS_CACHE_PATH, по умолчанию
+var/removed_suppliers.cache в каталоге проекта) и используется, пока:
+- не истек TTL (REMOVED_SUPPLIERS_CACHE_TTL, секунд);
+- не изменилась проба - всего строк, строк с _mark_remove=1 и максимальный
+  первичный ключ supplier_nomenclature (один агрегирующий запрос).
+
+Файл - строка заголовка JSON и сами данные: сырые байты битовой карты или
+JSON-список кодов. pickle не используется: чтение файла из общего каталога
+не должно исполнять код.
+
+Использование:
+    removed = get_removed_suppliers()
+    171664 in removed
+    qs = removed.exclude(get_ones_nomenclature_qs())   # вместо supplier___mark_remove=1
+"""
+import json
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.db.models import Count, Max, Q
+
+from one_c_raw.models import SupplierNomenclature
+
+CACHE_FORMAT = 'removed-suppliers'
+CACHE_VERSION = 2
+DEFAULT_TTL = 3600
+# Коды больше этого хранятся множеством, а не битовой картой (карта - до 16 МБ)
+BITMAP_MAX_CODE = 1 << 27
+
+
+class RemovedSuppliers:
+    """Коды номенклатур с удаленными поставщиками: битовая карта или множество."""
+
+    def __init__(self, codes, probe, created_at=None):
+        codes = set(codes)
+        self.probe = probe
+        self.created_at = created_at or time.time()
+        self.count = len(codes)
+        self._codes = None
+        if all(isinstance(code, int) and 0 <= code <= BITMAP_MAX_CODE for code in codes):
+            self.bitmap = bytearray(max(codes, default=0) // 8 + 1)
+            for code in codes:
+                self.bitmap[code >> 3] |= 1 << (code & 7)
+            self.codes_set = None
+        else:
+            self.bitmap = None
+            self.codes_set = frozenset(codes)
+
+    def __contains__(self, code):
+        if self.codes_set is not None:
+            return code in self.codes_set
+        if not isinstance(code, int) or code < 0 or code >> 3 >= len(self.bitmap):
+            return False
+        return bool(self.bitmap[code >> 3] & (1 << (code & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def codes(self):
+        """Список кодов (для code__in)."""
+        if self._codes is None:
+            if self.codes_set is not None:
+                self._codes = list(self.codes_set)
+            else:
+                self._codes = [index * 8 + bit for index, byte in enumerate(self.bitmap) if byte
+                               for bit in range(8) if byte & (1 << bit)]
+        return self._codes
+
+    def exclude(self, queryset, field='code'):
+        """queryset без номенклатур с удаленными поставщиками."""
+        return queryset.exclude(**{f'{field}__in': self.codes()})
+
+    @property
+    def age(self):
+        return time.time() - self.created_at
+
+    def to_cache(self):
+        """Содержимое файла кэша: строка заголовка JSON и данные."""
+        if self.bitmap is not None:
+            kind, payload = 'bitmap', bytes(self.bitmap)
+        else:
+            kind, payload = 'codes', json.dumps(list(self.codes_set)).encode('utf-8')
+        header = {
+            'format': CACHE_FORMAT,
+            'version': CACHE_VERSION,
+            'probe': list(self.probe),
+            'created_at': self.created_at,
+            'count': self.count,
+            'kind': kind,
+            'size': len(payload),
+        }
+        return json.dumps(header).encode('utf-8') + b'\n' + payload
+
+    @classmethod
+    def from_cache(cls, data):
+        """RemovedSuppliers из содержимого файла; ValueError, если файл
+        поврежден, обрезан или другой версии."""
+        header_line, _, payload = data.partition(b'\n')
+        header = json.loads(header_line)
+        if not isinstance(header, dict) or header.get('format') != CACHE_FORMAT:
+            raise ValueError('не файл кэша удаленных поставщиков')
+        if header.get('version') != CACHE_VERSION:
+            raise ValueError(f"версия кэша {header.get('version')}, ожидается {CACHE_VERSION}")
+        if header.get('size') != len(payload):
+            raise ValueError(f"размер данных {len(payload)}, в заголовке {header.get('size')}")
+
+        removed = cls((), tuple(header['probe']), header['created_at'])
+        removed.count = header['count']
+        if header['kind'] == 'bitmap':
+            removed.bitmap = bytearray(payload)
+        elif header['kind'] == 'codes':
+            removed.bitmap = None
+            removed.codes_set = frozenset(json.loads(payload))
+        else:
+            raise ValueError(f"неизвестный вид данных: {header['kind']}")
+        return removed
+
+
+def probe_suppliers():
+    """(всего строк, строк с _mark_remove=1, максимальный pk) supplier_nomenclature."""
+    stats = SupplierNomenclature.objects.aggregate(
+        total=Count('pk'),
+        removed=Count('pk', filter=Q(_mark_remove=1)),
+        max_pk=Max('pk'),
+    )
+    return stats['total'], stats['removed'], str(stats['max_pk'])
+
+
+def load_removed_suppliers():
+    """Загружает коды из БД одним потоковым запросом."""
+    probe = probe_suppliers()
+    codes = (
+        SupplierNomenclature.objects
+        .filter(_mark_remove=1)
+        .values_list('nomenclature__code', flat=True)
+        .iterator(chunk_size=10000)
+    )
+    return RemovedSuppliers((code for code in codes if code is not None), probe)
+
+
+def cache_path():
+    return getattr(settings, 'REMOVED_SUPPLIERS_CACHE_PATH', '') or os.path.join(
+        settings.BASE_DIR, 'var', 'removed_suppliers.cache')
+
+
+def read_cache(path):
+    try:
+        with open(path, 'rb') as f:
+            return RemovedSuppliers.from_cache(f.read())
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_cache(path, removed):
+    # Запись через временный файл - параллельный читатель не увидит половину карты
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.removed_suppliers_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(removed.to_cache())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def get_removed_suppliers(ttl=None, refresh=False, path=None):
+    """Коды номенклатур с удаленными поставщиками из кэша или из БД.
+
+    Кэш используется, если он моложе ttl и проба БД не изменилась; иначе
+    карта загружается заново и сохраняется. refresh=True - всегда из БД.
+    """
+    ttl = getattr(settings, 'REMOVED_SUPPLIERS_CACHE_TTL', DEFAULT_TTL) if ttl is None else ttl
+    path = path or cache_path()
+
+    if not refresh:
+        removed = read_cache(path)
+        if removed is not None and removed.age < ttl and removed.probe == probe_suppliers():
+            return removed
+
+    removed = load_removed_suppliers()
+    try:
+        write_cache(path, removed)
+    except OSError as e:
+        print(f"⚠️ Не удалось сохранить кэш удаленных поставщиков в {path}: {e}")
+    return removed
+
@@ -0,0 +1,190 @@
+"""
+Адаптивный размер пачки для пакетных изменений в БД.
+
+Вместо угадывания --batch-size пачка подстраивается под целевое время одной
+пачки (target):
+- пачка быстрее target - размер растет (не больше чем вдвое за шаг);
+- медленнее - уменьшается пропорционально превышению;
+- если есть сеансы, ждущие блокировку из-за нас (заблокированные этим
+  сеансом или ждущие при работе с изменяемыми таблицами - models), или растет
+  отставание реплик (pg_stat_replication.replay_lag) - размер сразу
+  уменьшается вдвое и не растет, пока давление не спадет. Ожидания блокировок
+  в чужих таблицах (миграция, отчет) на размер пачки не влияют.
+Нагрузка на БД проверяется не чаще, чем раз в probe_interval секунд.
+Изменения размера пишутся в лог команды, в конце - сводка.
+
+target=0 - фиксированный размер (поведение до адаптивных пачек).
+Только для циклов, где каждая пачка - своя транзакция: внутри одной общей
+транзакции уменьшение пачки блокировок не отпускает.
+"""
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+DEFAULT_TARGET_SECONDS = 1.0
+DEFAULT_MIN_SIZE = 50
+DEFAULT_MAX_SIZE = 20000
+DEFAULT_PROBE_INTERVAL = 5.0
+# Допустимое отставание реплик при записи, секунд
+DEFAULT_MAX_REPLICATION_LAG = 10.0
+
+# Пачка в пределах +-TOLERANCE от target размер не меняет
+TOLERANCE = 0.2
+MAX_GROWTH = 2.0
+
+
+def probe_pressure(using='default', tables=()):
+    """(сеансов, ждущих блокировку из-за нас, максимальное отставание реплик в секундах).
+
+    Ждущий сеанс учитывается, если его блокирует этот сеанс или если он держит
+    либо ждет блокировку на одной из tables (имена таблиц): ожидание строки,
+    которую меняет пачка, - это блокировка на transactionid при уже
+    полученной блокировке таблицы.
+    """
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT count(DISTINCT w.pid) FROM pg_locks w
+            WHERE NOT w.granted AND w.pid <> pg_backend_pid()
+              AND (pg_backend_pid() = ANY(pg_blocking_pids(w.pid))
+                   OR EXISTS (
+                       SELECT 1 FROM pg_locks t
+                       WHERE t.pid = w.pid
+                         AND t.database = (SELECT oid FROM pg_database WHERE datname = current_database())
+                         AND t.relation = ANY(
+                           ARRAY(SELECT to_regclass(u.table_name)::oid FROM unnest(%s::text[]) AS u(table_name)))
+                   ))
+        """, [[connection.ops.quote_name(table) for table in tables]])
+        lock_waits = cursor.fetchone()[0]
+        cursor.execute('SELECT coalesce(max(extract(epoch FROM replay_lag)), 0) FROM pg_stat_replication')
+        lag = float(cursor.fetchone()[0] or 0)
+    return lock_waits, lag
+
+
+class AdaptiveBatcher:
+    """Размер пачки, подстраиваемый под время выполнения и нагрузку на БД.
+
+    Использование:
+        batcher = AdaptiveBatcher(1000, write=self.stdout.write, label='remove_duplicate_items')
+        for batch in batcher.batches(ids):
+            ...  # время от выдачи пачки до запроса следующей - время пачки
+        batcher.finish()
+
+    Для циклов, которые копят пачку сами: batcher.size и with batcher.measure(rows).
+    """
+
+    def __init__(self, initial, target=DEFAULT_TARGET_SECONDS, min_size=DEFAULT_MIN_SIZE,
+                 max_size=DEFAULT_MAX_SIZE, write=None, label='', using='default',
+                 probe_interval=DEFAULT_PROBE_INTERVAL, max_lag=None, models=()):
+        self.target = target
+        self.min_size = min(min_size, initial)
+        self.max_size = max(max_size, initial)
+        self.size = initial
+        self.write = write
+        self.label = label
+        self.using = using
+        self.probe_interval = probe_interval
+        if max_lag is None:
+            max_lag = getattr(settings, 'DEDUPE_BATCH_MAX_LAG', DEFAULT_MAX_REPLICATION_LAG)
+        self.max_lag = max_lag
+        # Изменяемые модели: ожидания блокировок на их таблицах уменьшают пачку
+        self.tables = [model._meta.db_table for model in models]
+
+        self._last_probe = 0.0
+        self._last_lag = 0.0
+        self._probe_failed = False
+        self.batches_done = 0
+        self.rows_done = 0
+        self.seconds = 0.0
+        self.sizes = [initial]
+
+    @property
+    def adaptive(self):
+        return self.target > 0
+
+    def batches(self, sequence):
+        """Срезы sequence текущего размера; время каждой пачки учитывается."""
+        position = 0
+        while position < len(sequence):
+            batch = sequence[position:position + self.size]
+            position += len(batch)
+            with self.measure(len(batch)):
+                yield batch
+
+    @contextmanager
+    def measure(self, rows):
+        started = time.monotonic()
+        yield
+        self.record(rows, time.monotonic() - started)
+
+    def record(self, rows, seconds):
+        """Учитывает выполненную пачку и выбирает размер следующей."""
+        self.batches_done += 1
+        self.rows_done += rows
+        self.seconds += seconds
+        if not self.adaptive or rows == 0:
+            return
+
+        pressure = self._pressure()
+        if pressure:
+            self._resize(self.size // 2, pressure)
+            return
+
+        # Пачки меньше текущего размера (хвост) о скорости при size не говорят
+        if rows < self.size:
+            return
+        ratio = self.target / max(seconds, 1e-3)
+        if ratio > 1 + TOLERANCE:
+            self._resize(int(self.size * min(ratio, MAX_GROWTH)), f'{seconds:.2f} с < {self.target:.2f} с')
+        elif ratio < 1 - TOLERANCE:
+            self._resize(int(self.size * ratio), f'{seconds:.2f} с > {self.target:.2f} с')
+
+    def shrink(self, reason):
+        """Уменьшает пачку вдвое по внешней причине (например, таймаут пачки)."""
+        if self.adaptive:
+            self._resize(self.size // 2, reason)
+
+    def _pressure(self):
+        """Причина уменьшения пачки из-за нагрузки на БД или None."""
+        now = time.monotonic()
+        if self._probe_failed or now - self._last_probe < self.probe_interval:
+            return None
+        self._last_probe = now
+        try:
+            lock_waits, lag = probe_pressure(self.using, self.tables)
+        except DatabaseError as e:
+            # Нет прав на pg_stat_* или не PostgreSQL - работаем только по времени пачки
+            self._probe_failed = True
+            self._log(f'проверка нагрузки БД недоступна ({e}), размер - только по времени пачки')
+            return None
+
+        previous_lag, self._last_lag = self._last_lag, lag
+        if lock_waits:
+            return f'ожидающих блокировку сеансов: {lock_waits}'
+        if lag > self.max_lag:
+            return f'отставание реплик {lag:.1f} с > {self.max_lag:.0f} с'
+        if lag > previous_lag and lag > self.max_lag / 2:
+            return f'отставание реплик растет: {previous_lag:.1f} -> {lag:.1f} с'
+        return None
+
+    def _resize(self, size, reason):
+        size = max(self.min_size, min(self.max_size, size))
+        if size == self.size:
+            return
+        self._log(f'размер пачки {self.size} -> {size} ({reason})')
+        self.size = size
+        self.sizes.append(size)
+
+    def _log(self, message):
+        if self.write:
+            self.write(f'   [{self.label}] {message}' if self.label else f'   {message}')
+
+    def finish(self):
+        if not self.write or not self.batches_done:
+            return
+        mode = f'цель {self.target:.2f} с/пачку' if self.adaptive else 'фиксированный размер'
+        self.write(f'   Пачек: {self.batches_done}, строк: {self.rows_done}, '
+                   f'среднее время пачки: {self.seconds / self.batches_done:.2f} с ({mode}); '
+                   f'размер: мин {min(self.sizes)}, макс {max(self.sizes)}, последний {self.size}')
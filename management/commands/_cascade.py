@@ -0,0 +1,218 @@
+"""
+Граф каскадного удаления модели, построенный по _meta.
+
+Повторяет то, как Django Collector находит зависимые объекты
+(обратные FK и OneToOne, включая скрытые through-модели M2M), но ничего
+не загружает в Python: по графу строятся подзапросы для подсчета строк
+и set-based DELETE для быстрого удаления.
+"""
+import json
+import os
+import time
+from collections import Counter, namedtuple
+
+from django.db import connections, models, transaction
+from django.db.models import signals
+
+# Зависимая таблица: модель, FK на родителя, родитель, on_delete, глубина
+# и ребро, через которое в каскад попал сам родитель (None для корня)
+CascadeEdge = namedtuple('CascadeEdge', ['model', 'field', 'parent', 'on_delete', 'depth', 'via'])
+
+# Средний размер WAL-записи об удалении одной строки (заголовок + xl_heap_delete)
+WAL_BYTES_PER_ROW = 54
+PAGE_SIZE = 8192
+
+# Сколько последних запусков учитывать при оценке скорости
+THROUGHPUT_HISTORY = 5
+
+
+def related_fields(model):
+    """Обратные связи модели - те же, что проверяет Collector при удалении."""
+    return [
+        f for f in model._meta.get_fields(include_hidden=True)
+        if f.auto_created and not f.concrete and (f.one_to_one or f.one_to_many)
+    ]
+
+
+def cascade_graph(model, max_depth=10):
+    """Ребра графа зависимостей от model в порядке обхода в ширину.
+
+    В глубину идем только по CASCADE: SET_NULL/SET_DEFAULT обновляют строки,
+    PROTECT/RESTRICT/DO_NOTHING ничего не удаляют дальше.
+    """
+    edges = []
+    queue = [(model, 0, (model,), None)]
+    while queue:
+        parent, depth, path, via = queue.pop(0)
+        if depth >= max_depth:
+            continue
+        for rel in related_fields(parent):
+            child = rel.related_model
+            on_delete = rel.field.remote_field.on_delete
+            edge = CascadeEdge(child, rel.field, parent, on_delete, depth + 1, via)
+            edges.append(edge)
+            if on_delete is models.CASCADE and child not in path:
+                queue.append((child, depth + 1, path + (child,), edge))
+    return edges
+
+
+def edge_queryset(edge, ids, using='default'):
+    """QuerySet строк таблицы edge.model, которые затронет удаление ids корневой модели."""
+    parent_qs = ids if edge.via is None else edge_queryset(edge.via, ids, using).values('pk')
+    return edge.model._base_manager.using(using).filter(**{f'{edge.field.name}__in': parent_qs})
+
+
+def count_cascade(model, ids, using='default', chunk_size=10000):
+    """{label модели: (строк, действие)} для удаления ids модели model.
+
+    action - 'delete' для каскадного удаления, 'update' для SET_NULL/SET_DEFAULT,
+    'protect' для PROTECT/RESTRICT (удаление упадет), 'none' для DO_NOTHING.
+    """
+    edges = cascade_graph(model)
+    result = {model._meta.label: [0, 'delete']}
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        result[model._meta.label][0] += model._base_manager.using(using).filter(pk__in=chunk).count()
+        for edge in edges:
+            action = _action(edge.on_delete)
+            entry = result.setdefault(edge.model._meta.label, [0, action])
+            entry[0] += edge_queryset(edge, chunk, using).count()
+    return {label: tuple(value) for label, value in result.items()}
+
+
+def _action(on_delete):
+    if on_delete is models.CASCADE:
+        return 'delete'
+    if on_delete in (models.SET_NULL, models.SET_DEFAULT) or getattr(on_delete, 'deconstruct', None):
+        return 'update'
+    if on_delete in (models.PROTECT, getattr(models, 'RESTRICT', None)):
+        return 'protect'
+    return 'none'
+
+
+def table_stats(model, using='default'):
+    """(байт на строку с учетом индексов, страниц в таблице) по статистике pg_class."""
+    sql = """
+        SELECT pg_total_relation_size(c.oid)::float / greatest(c.reltuples, 1), c.relpages
+        FROM pg_class c
+        WHERE c.oid = %s::regclass
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, [model._meta.db_table])
+        row = cursor.fetchone()
+    return (row[0], row[1]) if row else (0, 0)
+
+
+def estimate_volume(model, rows, using='default'):
+    """(освобождаемые байты, оценка WAL сверху) для удаления rows строк."""
+    bytes_per_row, relpages = table_stats(model, using)
+    # Первое изменение страницы после checkpoint пишет ее целиком (full page image)
+    wal_bytes = rows * WAL_BYTES_PER_ROW + min(rows, relpages) * PAGE_SIZE
+    return rows * bytes_per_row, wal_bytes
+
+
+def load_throughput(stats_file):
+    """Средняя скорость (объектов/сек) по последним запускам или None."""
+    try:
+        with open(stats_file, encoding='utf-8') as f:
+            runs = json.load(f)
+    except (OSError, ValueError):
+        return None
+    runs = [r for r in runs[-THROUGHPUT_HISTORY:] if r.get('seconds')]
+    if not runs:
+        return None
+    return sum(r['objects'] for r in runs) / sum(r['seconds'] for r in runs)
+
+
+def save_throughput(stats_file, objects, seconds):
+    """Добавить результат запуска в файл статистики скорости."""
+    try:
+        with open(stats_file, encoding='utf-8') as f:
+            runs = json.load(f)
+    except (OSError, ValueError):
+        runs = []
+    runs.append({'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'objects': objects, 'seconds': round(seconds, 3)})
+    tmp_file = f'{stats_file}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(runs[-THROUGHPUT_HISTORY * 4:], f, ensure_ascii=False, indent=1)
+    os.replace(tmp_file, stats_file)
+
+
+def can_fast_delete(model):
+    """Можно ли удалять model и ее каскад сырыми DELETE, минуя Collector.
+
+    Нельзя, если на затрагиваемых моделях есть сигналы удаления или
+    GenericRelation, либо в графе встречается PROTECT/RESTRICT/SET(...) -
+    это обрабатывает только Collector.
+    """
+    edges = cascade_graph(model)
+    deleted_models = {model} | {edge.model for edge in edges if edge.on_delete is models.CASCADE}
+    for deleted_model in deleted_models:
+        if (signals.pre_delete.has_listeners(deleted_model)
+                or signals.post_delete.has_listeners(deleted_model)):
+            return False
+        # GenericRelation и подобные - Collector удаляет их через bulk_related_objects
+        if any(hasattr(f, 'bulk_related_objects') for f in deleted_model._meta.private_fields):
+            return False
+    allowed = (models.CASCADE, models.SET_NULL, models.DO_NOTHING)
+    return all(edge.on_delete in allowed for edge in edges)
+
+
+def _rows_condition(edge, connection):
+    """SQL-условие на строки edge.model, затрагиваемые удалением корня (%s - массив ID корня)."""
+    qn = connection.ops.quote_name
+    fk_col = qn(edge.field.column)
+    target = edge.field.target_field
+    parent_meta = edge.parent._meta
+
+    if edge.via is None:
+        if target.primary_key:
+            return f'{fk_col} = ANY(%s)'
+        parent_rows = f'{qn(parent_meta.pk.column)} = ANY(%s)'
+    else:
+        parent_rows = _rows_condition(edge.via, connection)
+    return (
+        f'{fk_col} IN (SELECT {qn(target.column)} FROM {qn(parent_meta.db_table)} '
+        f'WHERE {parent_rows})'
+    )
+
+
+def fast_delete(model, ids, using='default'):
+    """Удалить ids модели model вместе с каскадом set-based запросами.
+
+    Порядок берется из графа: сначала SET_NULL-обновления, затем DELETE
+    зависимых таблиц от самых глубоких к корню, затем сам корень - все в
+    одной транзакции. Результат в том же формате, что у QuerySet.delete():
+    (всего удалено, {label модели: удалено}).
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    edges = cascade_graph(model)
+    deleted = Counter()
+    ids = list(ids)
+
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        for edge in edges:
+            if edge.on_delete is models.SET_NULL:
+                cursor.execute(
+                    f'UPDATE {qn(edge.model._meta.db_table)} SET {qn(edge.field.column)} = NULL '
+                    f'WHERE {_rows_condition(edge, connection)}',
+                    [ids],
+                )
+
+        cascade_edges = [edge for edge in edges if edge.on_delete is models.CASCADE]
+        for edge in sorted(cascade_edges, key=lambda e: e.depth, reverse=True):
+            cursor.execute(
+                f'DELETE FROM {qn(edge.model._meta.db_table)} WHERE {_rows_condition(edge, connection)}',
+                [ids],
+            )
+            deleted[edge.model._meta.label] += cursor.rowcount
+
+        meta = model._meta
+        cursor.execute(
+            f'DELETE FROM {qn(meta.db_table)} WHERE {qn(meta.pk.column)} = ANY(%s)',
+            [ids],
+        )
+        deleted[meta.label] += cursor.rowcount
+
+    return sum(deleted.values()), dict(deleted)
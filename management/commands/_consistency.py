@@ -0,0 +1,188 @@
+"""
+Сверка таблицы модели между двумя базами (например, default и backup) по
+контрольным суммам диапазонов первичного ключа.
+
+1. Диапазон ID [min, max] обеих баз делится на chunks равных частей.
+2. Для всех диапазонов уровня каждая база одним запросом считает count(*) и
+   сумму 64-битных префиксов md5 строк (сумма не зависит от порядка строк).
+   Запросы к двум базам выполняются параллельно - у каждой базы свой поток
+   и свое соединение.
+3. Совпавшие диапазоны отбрасываются, различающиеся делятся на fanout частей
+   и проверяются на следующем уровне.
+4. Диапазон, в котором строк не больше leaf_size, сравнивается построчно:
+   с обеих сторон забираются пары (pk, md5) - так находятся точные ID.
+Объем переданных данных пропорционален числу различий, а не размеру таблицы.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from django.db import connections
+
+DEFAULT_CHUNKS = 64
+DEFAULT_FANOUT = 16
+DEFAULT_LEAF_SIZE = 500
+
+
+@dataclass
+class ConsistencyDiff:
+    only_left: list = field(default_factory=list)
+    only_right: list = field(default_factory=list)
+    changed: list = field(default_factory=list)
+    # Статистика: уровни, запросов к каждой базе, строк сумм и строк (pk, md5)
+    levels: int = 0
+    queries: int = 0
+    checksum_rows: int = 0
+    leaf_rows: int = 0
+
+    @property
+    def total(self):
+        return len(self.only_left) + len(self.only_right) + len(self.changed)
+
+
+def model_columns(model, field_names=None):
+    """Колонки, входящие в контрольную сумму (по умолчанию - все, кроме pk)."""
+    meta = model._meta
+    if field_names:
+        return [meta.get_field(name).column for name in field_names]
+    return [f.column for f in meta.concrete_fields if not f.primary_key]
+
+
+def split_range(lo, hi, parts):
+    """[lo, hi) -> не больше parts непустых полуинтервалов."""
+    step = max(1, -(-(hi - lo) // parts))
+    return [(start, min(start + step, hi)) for start in range(lo, hi, step)]
+
+
+class AliasReader:
+    """Запросы контрольных сумм к одной базе. Все запросы идут через один
+    поток: соединения Django привязаны к потоку, а так базы опрашиваются
+    параллельно без лишних подключений."""
+
+    def __init__(self, alias, model, columns, filters=None):
+        self.alias = alias
+        connection = connections[alias]
+        qn = connection.ops.quote_name
+        meta = model._meta
+        self.table = qn(meta.db_table)
+        self.pk = qn(meta.pk.column)
+        self.row_hash = f"md5(ROW({', '.join(f't.{qn(c)}' for c in columns)})::text)"
+
+        # filters - {колонка: значение}, входят в условие соединения
+        filters = filters or {}
+        self.filter_sql = ''.join(f' AND t.{qn(column)} = %s' for column in filters)
+        self.filter_params = list(filters.values())
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'consistency-{alias}')
+
+    def submit(self, method, *args):
+        return self.executor.submit(method, *args)
+
+    def _fetch(self, sql, params):
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def bounds(self):
+        (lo, hi), = self._fetch(
+            f'SELECT min(t.{self.pk}), max(t.{self.pk}) FROM {self.table} t WHERE true{self.filter_sql}',
+            self.filter_params,
+        )
+        return lo, hi
+
+    def _ranges_sql(self, select, group_by=''):
+        return f"""
+            SELECT {select}
+            FROM unnest(%s::bigint[], %s::bigint[]) AS r(lo, hi)
+            JOIN {self.table} t ON t.{self.pk} >= r.lo AND t.{self.pk} < r.hi{self.filter_sql}
+            {group_by}
+        """
+
+    def checksums(self, ranges):
+        """{lo: (строк, сумма префиксов md5)} для непустых диапазонов."""
+        sql = self._ranges_sql(
+            f"r.lo, count(*), sum(('x' || substr({self.row_hash}, 1, 16))::bit(64)::bigint)",
+            'GROUP BY r.lo',
+        )
+        rows = self._fetch(sql, [[lo for lo, _ in ranges], [hi for _, hi in ranges]] + self.filter_params)
+        return {lo: (count, total) for lo, count, total in rows}
+
+    def row_hashes(self, ranges):
+        """{pk: md5 строки} для всех строк диапазонов."""
+        sql = self._ranges_sql(f't.{self.pk}, {self.row_hash}')
+        rows = self._fetch(sql, [[lo for lo, _ in ranges], [hi for _, hi in ranges]] + self.filter_params)
+        return dict(rows)
+
+    def close(self):
+        self.submit(connections[self.alias].close).result()
+        self.executor.shutdown()
+
+
+def _both(left, right, method, *args):
+    """Один и тот же запрос к двум базам параллельно."""
+    left_future = left.submit(getattr(left, method), *args)
+    right_future = right.submit(getattr(right, method), *args)
+    return left_future.result(), right_future.result()
+
+
+def compare_model(model, left_alias, right_alias, field_names=None, filters=None,
+                  chunks=DEFAULT_CHUNKS, fanout=DEFAULT_FANOUT, leaf_size=DEFAULT_LEAF_SIZE, on_level=None):
+    """Сравнивает таблицу модели в двух базах. Возвращает ConsistencyDiff.
+
+    on_level(уровень, проверено диапазонов, различается) вызывается после
+    каждого уровня деления.
+    """
+    columns = model_columns(model, field_names)
+    left = AliasReader(left_alias, model, columns, filters)
+    right = AliasReader(right_alias, model, columns, filters)
+    diff = ConsistencyDiff()
+    try:
+        (left_lo, left_hi), (right_lo, right_hi) = _both(left, right, 'bounds')
+        diff.queries += 1
+        lows = [v for v in (left_lo, right_lo) if v is not None]
+        if not lows:
+            return diff
+        highs = [v for v in (left_hi, right_hi) if v is not None]
+        pending = split_range(min(lows), max(highs) + 1, chunks)
+
+        while pending:
+            diff.levels += 1
+            left_sums, right_sums = _both(left, right, 'checksums', pending)
+            diff.queries += 1
+            diff.checksum_rows += len(left_sums) + len(right_sums)
+
+            leaves = []
+            next_level = []
+            differing = 0
+            for lo, hi in pending:
+                left_sum = left_sums.get(lo, (0, 0))
+                right_sum = right_sums.get(lo, (0, 0))
+                if left_sum == right_sum:
+                    continue
+                differing += 1
+                if max(left_sum[0], right_sum[0]) <= leaf_size or hi - lo <= fanout:
+                    leaves.append((lo, hi))
+                else:
+                    next_level.extend(split_range(lo, hi, fanout))
+
+            if leaves:
+                left_rows, right_rows = _both(left, right, 'row_hashes', leaves)
+                diff.queries += 1
+                diff.leaf_rows += len(left_rows) + len(right_rows)
+                for pk, row_hash in left_rows.items():
+                    other = right_rows.get(pk)
+                    if other is None:
+                        diff.only_left.append(pk)
+                    elif other != row_hash:
+                        diff.changed.append(pk)
+                diff.only_right.extend(pk for pk in right_rows if pk not in left_rows)
+
+            if on_level:
+                on_level(diff.levels, len(pending), differing)
+            pending = next_level
+    finally:
+        left.close()
+        right.close()
+
+    diff.only_left.sort()
+    diff.only_right.sort()
+    diff.changed.sort()
+    return diff
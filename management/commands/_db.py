@@ -0,0 +1,59 @@
+"""
+Низкоуровневые помощники для работы с PostgreSQL из команд.
+"""
+import io
+
+# Сколько строк отправлять одной командой COPY
+COPY_CHUNK_ROWS = 50000
+
+
+def _copy_value(value):
+    """Значение в текстовом формате COPY."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Загрузить строки в таблицу через COPY ... FROM STDIN.
+
+    cursor - курсор Django (connection.cursor()). Работает и с psycopg2,
+    и с psycopg 3. Возвращает количество загруженных строк.
+    """
+    raw_cursor = getattr(cursor, 'cursor', cursor)
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+    total = 0
+
+    if hasattr(raw_cursor, 'copy_expert'):
+        # psycopg2: текстовый буфер порциями, чтобы не держать все в памяти
+        buffer = io.StringIO()
+        buffered = 0
+        for row in rows:
+            buffer.write('\t'.join(_copy_value(value) for value in row))
+            buffer.write('\n')
+            buffered += 1
+            if buffered >= COPY_CHUNK_ROWS:
+                buffer.seek(0)
+                raw_cursor.copy_expert(sql, buffer)
+                total += buffered
+                buffer = io.StringIO()
+                buffered = 0
+        if buffered:
+            buffer.seek(0)
+            raw_cursor.copy_expert(sql, buffer)
+            total += buffered
+    else:
+        # psycopg 3
+        with raw_cursor.copy(sql) as copy:
+            for row in rows:
+                copy.write_row(row)
+                total += 1
+    return total
@@ -0,0 +1,203 @@
+"""
+Группировка товаров по ключу артикула для поиска дубликатов.
+
+Два бэкенда с одинаковым результатом - {ключ: [ItemRecord]} только для групп
+из 2+ товаров, группы в порядке первого появления ключа, товары внутри группы
+в порядке чтения:
+- memory   - словарь всех ключей в памяти (быстро, но память растет вместе с
+             числом товаров конкурента);
+- external - внешняя сортировка: кортежи (ключ, номер, поля записи) копятся
+             пачками в пределах memory_budget, каждая пачка сортируется и
+             сбрасывается во временный файл, затем файлы сливаются heapq.merge
+             и соседние строки с одинаковым ключом образуют группу. В памяти
+             остаются только пачка и группы дубликатов.
+
+При слиянии каждый открытый файл держит в памяти один блок (SPILL_BLOCK
+строк), поэтому одновременно сливается не больше memory_budget / размер
+блока файлов (fan-in, не больше MAX_FAN_IN открытых файлов); если пачек
+больше, они сначала сливаются промежуточными проходами в более длинные.
+"""
+import heapq
+import itertools
+import os
+import pickle
+import tempfile
+from dataclasses import dataclass
+
+from django.conf import settings
+
+from ._records import RECORD_FIELDS, ItemRecord
+
+BACKENDS = ('memory', 'external')
+DEFAULT_MEMORY_BUDGET_MB = 256
+
+# Примерный размер строки пачки в памяти: кортеж, ключ, поля записи
+# (см. замер ItemRecord в _records) и ссылка в списке
+ESTIMATED_ROW_BYTES = 400
+
+# Строк в одном pickle-блоке файла пачки
+SPILL_BLOCK = 10000
+# Наибольшее число файлов, сливаемых за один проход (открытых одновременно)
+MAX_FAN_IN = 64
+
+
+@dataclass
+class GroupingStats:
+    items: int = 0
+    keys: int = 0
+    runs: int = 0
+    merge_passes: int = 0
+    spilled_bytes: int = 0
+
+
+def _sort_key(key):
+    # None не сравнивается со строками и не должен совпасть с ''
+    return (key is not None, key or '')
+
+
+def merge_fan_in(memory_budget_mb):
+    """Сколько файлов сливать за проход, чтобы их блоки уместились в бюджет."""
+    block_bytes = SPILL_BLOCK * ESTIMATED_ROW_BYTES
+    return max(2, min(MAX_FAN_IN, memory_budget_mb * 1024 * 1024 // block_bytes))
+
+
+def _iter_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                block = pickle.load(f)
+            except EOFError:
+                return
+            yield from block
+
+
+class _RunWriter:
+    """Отсортированные пачки строк во временных файлах."""
+
+    def __init__(self, directory, fan_in=MAX_FAN_IN):
+        self.directory = directory
+        self.fan_in = fan_in
+        self.paths = []
+        self.bytes = 0
+        self.files = 0
+        self.merge_passes = 0
+
+    def _write_sorted(self, rows):
+        """Записать уже отсортированные строки (итератор) блоками по SPILL_BLOCK."""
+        path = os.path.join(self.directory, f'run_{self.files:05d}.pickle')
+        self.files += 1
+        rows = iter(rows)
+        with open(path, 'wb') as f:
+            while True:
+                block = list(itertools.islice(rows, SPILL_BLOCK))
+                if not block:
+                    break
+                pickle.dump(block, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return path
+
+    def write(self, rows):
+        rows.sort()
+        path = self._write_sorted(rows)
+        self.paths.append(path)
+        self.bytes += os.path.getsize(path)
+
+    def merged(self):
+        # Промежуточные проходы: по fan_in файлов в один, пока не останется fan_in
+        while len(self.paths) > self.fan_in:
+            self.merge_passes += 1
+            paths, self.paths = self.paths, []
+            for i in range(0, len(paths), self.fan_in):
+                chunk = paths[i:i + self.fan_in]
+                if len(chunk) == 1:
+                    self.paths.extend(chunk)
+                    continue
+                self.paths.append(self._write_sorted(heapq.merge(*(_iter_run(path) for path in chunk))))
+                for path in chunk:
+                    os.remove(path)
+        return heapq.merge(*(_iter_run(path) for path in self.paths))
+
+
+def _group_memory(records, skip_empty, stats):
+    groups = {}
+    for record in records:
+        stats.items += 1
+        key = record.article_key
+        if skip_empty and not key:
+            continue
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(record)
+    stats.keys = len(groups)
+    return {key: group for key, group in groups.items() if len(group) > 1}
+
+
+def _group_external(records, skip_empty, stats, memory_budget_mb, on_spill):
+    run_rows = max(SPILL_BLOCK, memory_budget_mb * 1024 * 1024 // ESTIMATED_ROW_BYTES)
+    spill_dir = getattr(settings, 'DEDUPE_SPILL_DIR', None) or None
+
+    with tempfile.TemporaryDirectory(prefix='dedupe_grouping_', dir=spill_dir) as directory:
+        writer = _RunWriter(directory, merge_fan_in(memory_budget_mb))
+        rows = []
+        for seq, record in enumerate(records):
+            stats.items += 1
+            key = record.article_key
+            if skip_empty and not key:
+                continue
+            rows.append((_sort_key(key), seq, tuple(getattr(record, name) for name in RECORD_FIELDS)))
+            if len(rows) >= run_rows:
+                writer.write(rows)
+                rows = []
+                if on_spill:
+                    on_spill(len(writer.paths), writer.bytes)
+        if rows:
+            writer.write(rows)
+            rows = []
+
+        stats.runs = len(writer.paths)
+
+        # Слияние: строки одного ключа идут подряд и в порядке чтения (seq)
+        duplicates = []
+        current_key = None
+        group = []
+        for sort_key, seq, values in writer.merged():
+            if sort_key != current_key:
+                if len(group) > 1:
+                    duplicates.append(group)
+                if group:
+                    stats.keys += 1
+                current_key = sort_key
+                group = []
+            group.append((seq, values))
+        if len(group) > 1:
+            duplicates.append(group)
+        if group:
+            stats.keys += 1
+
+        stats.merge_passes = writer.merge_passes
+        stats.spilled_bytes = writer.bytes
+
+    # Порядок групп - по первому появлению ключа, как у словаря в памяти
+    duplicates.sort(key=lambda g: g[0][0])
+    result = {}
+    for group in duplicates:
+        members = [ItemRecord(*values) for _, values in group]
+        result[members[0].article_key] = members
+    return result
+
+
+def group_duplicates(records, backend='memory', memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                     skip_empty=False, on_spill=None):
+    """Группы дубликатов по article_key. Возвращает ({ключ: [ItemRecord]}, GroupingStats).
+
+    records - iterable ItemRecord (лучше генератор iter_item_records: тогда
+    внешний бэкенд не держит все записи в памяти). skip_empty - пропускать
+    товары без ключа. on_spill(пачек, байт) вызывается после сброса пачки.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Неизвестный бэкенд группировки: {backend}. Доступны: {", ".join(BACKENDS)}')
+    stats = GroupingStats()
+    if backend == 'external':
+        groups = _group_external(records, skip_empty, stats, memory_budget_mb, on_spill)
+    else:
+        groups = _group_memory(records, skip_empty, stats)
+    return groups, stats
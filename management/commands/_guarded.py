@@ -0,0 +1,170 @@
+"""
+Пачки изменений с таймаутами, повторами и разбиением.
+
+Каждая пачка выполняется в своей транзакции с SET LOCAL lock_timeout и
+statement_timeout, поэтому заблокированный UPDATE/DELETE (например, за
+транзакцией парсера) не висит бесконечно:
+- таймаут блокировки/запроса, deadlock или ошибка сериализации - повтор
+  через экспоненциальную паузу со случайным разбросом (retries раз);
+- пачка, не прошедшая после всех повторов, делится пополам, и половины
+  выполняются так же, но с одним повтором (иначе одна заблокированная строка
+  ждала бы retries таймаутов на каждом уровне деления);
+- прочие ошибки данных (с SQLSTATE) сразу делят пачку - так находится проблемная строка;
+- неделимая пачка, которая так и не выполнилась, записывается в JSONL-файл
+  неудачных пачек, и команда продолжает работу с остальными.
+Ошибки в коде запроса (ProgrammingError) и ошибки соединения (SQLSTATE
+класса 08 или ошибка без SQLSTATE - БД недоступна) не перехватываются: при
+недоступной БД деление пачки дало бы лишь тысячи неудачных подключений.
+"""
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from django.db import DatabaseError, ProgrammingError, connections, transaction
+
+DEFAULT_LOCK_TIMEOUT = 5.0
+DEFAULT_STATEMENT_TIMEOUT = 300.0
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
+# SQLSTATE: lock_not_available, query_canceled (statement_timeout),
+# deadlock_detected, serialization_failure
+RETRYABLE_SQLSTATES = {'55P03', '57014', '40P01', '40001'}
+
+
+def sqlstate(error):
+    """Код SQLSTATE исходной ошибки драйвера (psycopg2 - pgcode, psycopg 3 - sqlstate)."""
+    cause = error.__cause__
+    return getattr(cause, 'pgcode', None) or getattr(cause, 'sqlstate', None)
+
+
+def is_connection_error(error):
+    """Соединение потеряно или БД недоступна - повтор и деление пачки бесполезны."""
+    code = sqlstate(error)
+    return code is None or code.startswith('08')
+
+
+def split_half(batch):
+    """Половины списка или None, если делить нечего."""
+    if len(batch) < 2:
+        return None
+    middle = len(batch) // 2
+    return [batch[:middle], batch[middle:]]
+
+
+def split_id_range(batch):
+    """Половины диапазона ID (lo, hi) или None."""
+    lo, hi = batch
+    if hi - lo < 2:
+        return None
+    middle = lo + (hi - lo) // 2
+    return [(lo, middle), (middle, hi)]
+
+
+@dataclass
+class GuardedResult:
+    # Результаты operation для выполненных частей пачки
+    results: list = field(default_factory=list)
+    timeouts: int = 0
+    failed_batches: int = 0
+
+
+class GuardedBatches:
+    """Выполнение пачек с таймаутами, повторами, разбиением и записью неудач."""
+
+    def __init__(self, label, lock_timeout=DEFAULT_LOCK_TIMEOUT, statement_timeout=DEFAULT_STATEMENT_TIMEOUT,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, failed_file=None, write=None, using='default'):
+        self.label = label
+        self.lock_timeout = lock_timeout
+        self.statement_timeout = statement_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.failed_file = failed_file or f'failed_batches_{label}_{datetime.now():%Y%m%d_%H%M%S}.jsonl'
+        self.write = write
+        self.using = using
+
+        self.retried = 0
+        self.splits = 0
+        self.failed = 0
+
+    def _execute(self, batch, operation):
+        with transaction.atomic(using=self.using):
+            with connections[self.using].cursor() as cursor:
+                # SET LOCAL не принимает параметры - значения только числа
+                cursor.execute(f"SET LOCAL lock_timeout = '{int(self.lock_timeout * 1000)}ms'")
+                cursor.execute(f"SET LOCAL statement_timeout = '{int(self.statement_timeout * 1000)}ms'")
+            return operation(batch)
+
+    def run(self, batch, operation, split=split_half, describe=list):
+        """Выполняет operation(batch) под защитой. Возвращает GuardedResult.
+
+        split(batch) -> [части] или None; describe(batch) - что записать в
+        файл неудачных пачек (по умолчанию - список элементов).
+        """
+        result = GuardedResult()
+        self._run(batch, operation, split, describe, result, self.retries)
+        return result
+
+    def _run(self, batch, operation, split, describe, result, retries):
+        attempt = 0
+        while True:
+            try:
+                result.results.append(self._execute(batch, operation))
+                return
+            except ProgrammingError:
+                raise
+            except DatabaseError as e:
+                if is_connection_error(e):
+                    raise
+                code = sqlstate(e)
+                retryable = code in RETRYABLE_SQLSTATES
+                if retryable:
+                    result.timeouts += 1
+                if retryable and attempt < retries:
+                    delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                    attempt += 1
+                    self.retried += 1
+                    self._log(f'{code}: {str(e).strip()}; повтор {attempt}/{retries} через {delay:.1f} с')
+                    time.sleep(delay)
+                    continue
+                error = e
+                break
+
+        parts = split(batch)
+        if parts:
+            self.splits += 1
+            self._log(f'пачка делится на {len(parts)} части после ошибки {sqlstate(error)}: {str(error).strip()}')
+            for part in parts:
+                self._run(part, operation, split, describe, result, min(retries, 1))
+            return
+
+        self.failed += 1
+        result.failed_batches += 1
+        self._record(describe(batch), error, attempt)
+
+    def _record(self, batch_description, error, attempts):
+        entry = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'label': self.label,
+            'batch': batch_description,
+            'sqlstate': sqlstate(error),
+            'error': str(error).strip(),
+            'attempts': attempts + 1,
+        }
+        with open(self.failed_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+        self._log(f'пачка не выполнена и записана в {self.failed_file}: {entry["error"]}')
+
+    def _log(self, message):
+        if self.write:
+            self.write(f'   [{self.label}] {message}')
+
+    def finish(self):
+        if not self.write or not (self.retried or self.splits or self.failed):
+            return
+        self.write(f'   Повторов после таймаутов: {self.retried}, разбиений пачек: {self.splits}, '
+                   f'не выполнено пачек: {self.failed}')
+        if self.failed:
+            self.write(f'   Неудачные пачки: {self.failed_file}')
@@ -0,0 +1,127 @@
+"""
+Операции над ItemInfoHistory, выполняемые целиком на стороне БД.
+
+Модуль начинается с подчеркивания, поэтому Django не считает его командой.
+"""
+from django.db import connections
+from kenny.items.models import ItemInfoHistory
+
+# Поля, по которым две записи истории считаются одним и тем же снимком
+SNAPSHOT_FIELDS = ('analyzed_at', 'prices', 'available_type', 'url')
+
+# Поля, неизменность которых означает "состояние товара не поменялось"
+STATE_FIELDS = ('prices', 'available_type')
+
+# NULL и пустая строка не должны давать одинаковый хеш
+NULL_MARKER = '<NULL>'
+
+
+def history_table():
+    return ItemInfoHistory._meta.db_table
+
+
+def history_column(field_name):
+    return ItemInfoHistory._meta.get_field(field_name).column
+
+
+def snapshot_hash_sql(alias, fields=SNAPSHOT_FIELDS, connection=None):
+    """SQL-выражение md5 по содержимому снимка для строки с алиасом alias."""
+    qn = (connection or connections['default']).ops.quote_name
+    parts = ', '.join(
+        f"coalesce({alias}.{qn(history_column(name))}::text, '{NULL_MARKER}')"
+        for name in fields
+    )
+    return f"md5(concat_ws('|', {parts}))"
+
+
+def _copy_history_sql(connection, source_sql, return_ids):
+    """INSERT ... SELECT истории на мастер с пропуском одинаковых снимков.
+
+    source_sql должен отдавать строки истории подчиненных (алиас s) и колонку
+    plan_master_id - ID мастера, на которого переносится строка.
+    """
+    qn = connection.ops.quote_name
+    meta = ItemInfoHistory._meta
+    table = qn(meta.db_table)
+    pk = qn(meta.pk.column)
+    item_col = history_column('item')
+
+    columns = [f.column for f in meta.concrete_fields if not f.primary_key]
+    insert_cols = ', '.join(qn(c) for c in columns)
+    select_cols = ', '.join(
+        'u.plan_master_id' if c == item_col else f'u.{qn(c)}' for c in columns
+    )
+    result_sql = f'array_agg({pk})' if return_ids else 'count(*)'
+
+    return f"""
+        WITH src AS (
+            SELECT s.*, {snapshot_hash_sql('s', connection=connection)} AS snapshot_hash
+            FROM ({source_sql}) s
+        ),
+        uniq AS (
+            SELECT DISTINCT ON (plan_master_id, snapshot_hash) *
+            FROM src
+            ORDER BY plan_master_id, snapshot_hash, {pk}
+        ),
+        ins AS (
+            INSERT INTO {table} ({insert_cols})
+            SELECT {select_cols}
+            FROM uniq u
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {table} m
+                WHERE m.{qn(item_col)} = u.plan_master_id
+                  AND {snapshot_hash_sql('m', connection=connection)} = u.snapshot_hash
+            )
+            RETURNING {pk}
+        )
+        SELECT (SELECT count(*) FROM src), (SELECT {result_sql} FROM ins)
+    """
+
+
+def copy_history_dedup(slave_ids, master_id, using='default'):
+    """Копирует историю подчиненных товаров на мастер одним INSERT ... SELECT.
+
+    Пропускает снимки, которые у мастера уже есть (тот же analyzed_at, prices,
+    available_type и url), а также повторы среди самих подчиненных.
+    Возвращает (ids скопированных записей, количество пропущенных дубликатов).
+    """
+    if not slave_ids:
+        return [], 0
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    source_sql = f"""
+        SELECT h.*, %(master_id)s::bigint AS plan_master_id
+        FROM {qn(history_table())} h
+        WHERE h.{qn(history_column('item'))} = ANY(%(slave_ids)s)
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            _copy_history_sql(connection, source_sql, return_ids=True),
+            {'slave_ids': list(slave_ids), 'master_id': master_id},
+        )
+        total, inserted_ids = cursor.fetchone()
+
+    inserted_ids = inserted_ids or []
+    return inserted_ids, total - len(inserted_ids)
+
+
+def copy_history_from_staging(staging_table, using='default', return_ids=False):
+    """То же, что copy_history_dedup, но для всех пар (master_id, slave_id)
+    из staging-таблицы сразу. Возвращает (скопировано, пропущено), с
+    return_ids=True - (ids скопированных записей, пропущено).
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    source_sql = f"""
+        SELECT h.*, p.master_id AS plan_master_id
+        FROM {qn(history_table())} h
+        JOIN {staging_table} p ON h.{qn(history_column('item'))} = p.slave_id
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(_copy_history_sql(connection, source_sql, return_ids=return_ids))
+        total, inserted = cursor.fetchone()
+    if return_ids:
+        inserted = inserted or []
+        return inserted, total - len(inserted)
+    return inserted, total - inserted
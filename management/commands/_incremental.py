@@ -0,0 +1,192 @@
+"""
+Инкрементальный поиск дубликатов по водяной отметке date_create.
+
+Новые дубликаты могут появиться только среди товаров, созданных после
+прошлого запуска. Поэтому вместо полного обхода каталога:
+1. берутся товары конкурента новее отметки (date_create или ID больше
+   сохраненных);
+2. по их ключам нормализованного артикула (см. _normalize) из частичного
+   индекса по выражению находятся все товары тех же групп;
+3. после успешного запуска отметка сдвигается на максимум, прочитанный в
+   начале запуска (товары, созданные во время работы, попадут в следующий).
+
+Отметки хранятся в таблице dedupe_watermark (job, competitor_id), индекс -
+на каждого конкурента свой: CREATE INDEX ... ON item ((<ключ>)) WHERE
+competitor_id = <id>. Имя индекса включает хеш выражения, так что при
+изменении правил нормализации создается новый индекс.
+"""
+import hashlib
+from collections import namedtuple
+
+from django.db import connections
+from django.db.models import Max
+from kenny.items.models import Item
+
+from ._normalize import normalizer_for
+
+WATERMARK_TABLE = 'dedupe_watermark'
+
+Watermark = namedtuple('Watermark', ['date_create', 'max_id'])
+
+
+def _item_columns(connection):
+    qn = connection.ops.quote_name
+    meta = Item._meta
+    return (
+        qn(meta.db_table),
+        qn(meta.pk.column),
+        qn(meta.get_field('competitor').column),
+        qn(meta.get_field('article').column),
+        qn(meta.get_field('date_create').column),
+    )
+
+
+def ensure_watermark_table(using='default'):
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+                job text NOT NULL,
+                competitor_id bigint NOT NULL,
+                date_create timestamptz,
+                max_id bigint,
+                updated_at timestamptz NOT NULL DEFAULT now(),
+                PRIMARY KEY (job, competitor_id)
+            )
+        """)
+
+
+def get_watermark(job, competitor_id, using='default'):
+    """Сохраненная отметка или None, если инкрементальных запусков еще не было."""
+    ensure_watermark_table(using)
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f'SELECT date_create, max_id FROM {WATERMARK_TABLE} WHERE job = %s AND competitor_id = %s',
+            [job, competitor_id],
+        )
+        row = cursor.fetchone()
+    return Watermark(*row) if row else None
+
+
+def save_watermark(job, competitor_id, watermark, using='default'):
+    ensure_watermark_table(using)
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {WATERMARK_TABLE} (job, competitor_id, date_create, max_id, updated_at)
+            VALUES (%s, %s, %s, %s, now())
+            ON CONFLICT (job, competitor_id) DO UPDATE SET
+                date_create = EXCLUDED.date_create,
+                max_id = EXCLUDED.max_id,
+                updated_at = EXCLUDED.updated_at
+        """, [job, competitor_id, watermark.date_create, watermark.max_id])
+
+
+def current_watermark(competitor_id, using='default'):
+    """Отметка по текущему состоянию: максимальные date_create и ID товаров конкурента."""
+    bounds = Item.objects.using(using).filter(competitor_id=competitor_id).aggregate(
+        date_create=Max('date_create'), max_id=Max('id'),
+    )
+    return Watermark(bounds['date_create'], bounds['max_id'])
+
+
+def article_key_predicate(competitor_id, unique=False, using='default'):
+    """WHERE-условие частичного индекса по ключу артикула конкурента."""
+    connection = connections[using]
+    _, _, competitor_col, article_col, _ = _item_columns(connection)
+    predicate = f'{competitor_col} = {int(competitor_id)}'
+    if unique:
+        # Товары без артикула уникальностью по ключу не ограничиваются
+        key_sql = normalizer_for(competitor_id).key_sql_inline(article_col)
+        predicate = f"{predicate} AND {key_sql} <> ''"
+    return predicate
+
+
+def article_key_index(competitor_id, unique=False, using='default'):
+    """(имя индекса, DDL) частичного индекса по ключу артикула конкурента."""
+    connection = connections[using]
+    table, _, _, article_col, _ = _item_columns(connection)
+    key_sql = normalizer_for(competitor_id).key_sql_inline(article_col)
+    digest = hashlib.md5(key_sql.encode('utf-8')).hexdigest()[:8]
+    prefix = 'item_article_ukey' if unique else 'item_article_key'
+    name = f'{prefix}_{int(competitor_id)}_{digest}'
+    ddl = (
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY IF NOT EXISTS {name} "
+        f'ON {table} (({key_sql})) WHERE {article_key_predicate(competitor_id, unique, using)}'
+    )
+    return name, ddl
+
+
+def index_state(name, using='default'):
+    """None - индекса нет; True - индекс готов; False - невалидный индекс,
+    оставшийся от прерванного CREATE INDEX CONCURRENTLY (to_regclass его
+    находит, но планировщик и ON CONFLICT его не используют)."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            'SELECT i.indisvalid AND i.indisready FROM pg_index i WHERE i.indexrelid = to_regclass(%s)',
+            [name],
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def index_exists(name, using='default'):
+    """Индекс есть и валиден."""
+    return index_state(name, using) is True
+
+
+def drop_index(name, using='default'):
+    """DROP INDEX CONCURRENTLY - вызывать вне транзакции."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+
+def ensure_article_key_index(competitor_id, using='default'):
+    """Создать индекс по ключу артикула конкурента, если его нет; невалидный
+    индекс пересоздается. Возвращает (имя, создан ли сейчас). CONCURRENTLY -
+    вызывать вне транзакции."""
+    name, ddl = article_key_index(competitor_id, using=using)
+    state = index_state(name, using)
+    if state:
+        return name, False
+    if state is False:
+        # IF NOT EXISTS пропустил бы создание из-за невалидного индекса
+        drop_index(name, using)
+    with connections[using].cursor() as cursor:
+        cursor.execute(ddl)
+    return name, True
+
+
+def delta_group_item_ids(competitor_id, watermark, using='default'):
+    """(количество новых товаров, ID всех товаров групп, где есть новые товары).
+
+    Группы ищутся по индексу: ключи новых товаров сравниваются с тем же
+    выражением, что в индексе, с условием на конкурента константой.
+    """
+    connection = connections[using]
+    table, pk, competitor_col, article_col, date_col = _item_columns(connection)
+    competitor_id = int(competitor_id)
+    # Выражение подставлено литералами, чтобы совпасть с индексом; '%' экранируется для параметров
+    key_sql = normalizer_for(competitor_id).key_sql_inline(article_col).replace('%', '%%')
+    new_key_sql = key_sql.replace(article_col, f'n.{article_col}')
+    old_key_sql = key_sql.replace(article_col, f'i.{article_col}')
+
+    sql = f"""
+        WITH new_items AS (
+            SELECT n.{pk} AS id, {new_key_sql} AS article_key
+            FROM {table} n
+            WHERE n.{competitor_col} = {competitor_id}
+              AND (n.{date_col} > %s OR n.{pk} > %s)
+        ),
+        new_keys AS (
+            SELECT DISTINCT article_key FROM new_items WHERE article_key <> ''
+        )
+        SELECT (SELECT count(*) FROM new_items), array(
+            SELECT i.{pk}
+            FROM new_keys k
+            JOIN {table} i ON {old_key_sql} = k.article_key AND i.{competitor_col} = {competitor_id}
+            ORDER BY i.{pk}
+        )
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [watermark.date_create, watermark.max_id or 0])
+        new_count, item_ids = cursor.fetchone()
+    return new_count, list(item_ids or [])
@@ -0,0 +1,161 @@
+"""
+Запись товаров конкурента из парсеров без создания дубликатов.
+
+Все команды очистки дубликатов существуют потому, что парсер создает новый
+Item, когда у конкурента артикул меняется на ' 12345' вместо '12345'.
+ingest_items() ставится перед созданием товаров:
+- артикул очищается (ArticleNormalizer.clean) перед записью;
+- строки пишутся пачками одним INSERT ... ON CONFLICT по уникальному
+  частичному индексу на ключ нормализованного артикула конкурента: новый
+  товар создается, существующий обновляется (только если поля изменились);
+- внутри пачки повторы по ключу схлопываются (последняя строка побеждает) -
+  иначе ON CONFLICT DO UPDATE не может дважды обновить одну строку.
+
+Уникальный индекс создается командой create_article_unique_index после того,
+как существующие дубликаты конкурента удалены или объединены.
+
+Пример использования в парсере:
+
+    from <app>.management.commands._ingest import ingest_items
+
+    result = ingest_items(competitor.id, [
+        {'article': ' 12345', 'name': 'Ручка шариковая', 'url': 'https://...'},
+        ...
+    ])
+    result.ids['12345']  # ID товара по ключу артикула
+"""
+from collections import namedtuple
+
+from django.db import connections, transaction
+from kenny.items.models import Item
+
+from ._incremental import article_key_index, article_key_predicate, index_exists
+from ._normalize import normalizer_for
+
+# Поля, обновляемые у существующего товара по умолчанию
+DEFAULT_UPDATE_FIELDS = ('name', 'url')
+
+MAX_QUERY_PARAMS = 65535
+
+IngestResult = namedtuple('IngestResult', ['created', 'updated', 'unchanged', 'ids'])
+
+# Индексы, наличие которых уже проверено в этом процессе
+_checked_indexes = set()
+
+
+class IngestError(Exception):
+    """Запись невозможна: нет уникального индекса или неверные данные."""
+
+
+def _check_index(competitor_id, using):
+    name, _ = article_key_index(competitor_id, unique=True, using=using)
+    if (using, name) in _checked_indexes:
+        return
+    if not index_exists(name, using):
+        # Невалидный индекс (прерванное построение) ON CONFLICT не использует
+        raise IngestError(
+            f'Нет валидного уникального индекса {name} по артикулу конкурента {competitor_id}. '
+            f'Создайте его: python manage.py create_article_unique_index {competitor_id}'
+        )
+    _checked_indexes.add((using, name))
+
+
+def _insert_fields():
+    """Поля модели для INSERT - как в bulk_create: без автоинкрементного PK."""
+    meta = Item._meta
+    return [f for f in meta.local_concrete_fields if not (f.primary_key and f.db_returning)]
+
+
+def ingest_items(competitor_id, rows, update_fields=DEFAULT_UPDATE_FIELDS, batch_size=1000, using='default'):
+    """Создать или обновить товары конкурента без дубликатов по артикулу.
+
+    rows - iterable словарей {поле Item: значение}; competitor подставляется.
+    update_fields - поля, которые обновляются у уже существующего товара.
+    Возвращает IngestResult: счетчики и {ключ артикула: ID товара}.
+    """
+    competitor_id = int(competitor_id)
+    _check_index(competitor_id, using)
+    normalizer = normalizer_for(competitor_id)
+    # Не больше 65535 параметров в одном запросе
+    batch_size = max(1, min(batch_size, MAX_QUERY_PARAMS // len(_insert_fields())))
+
+    results = []
+    batch = {}
+    for row in rows:
+        instance = Item(**dict(row, competitor_id=competitor_id))
+        key = normalizer.key(instance.article)
+        if not key:
+            raise IngestError(f'Пустой артикул: {row!r}')
+        # Повтор ключа в пачке - последняя строка побеждает
+        batch.pop(key, None)
+        batch[key] = instance
+        if len(batch) >= batch_size:
+            results.append(_ingest_batch(competitor_id, batch, update_fields, using))
+            batch = {}
+    if batch:
+        results.append(_ingest_batch(competitor_id, batch, update_fields, using))
+
+    ids = {}
+    for result in results:
+        ids.update(result.ids)
+    return IngestResult(
+        sum(r.created for r in results), sum(r.updated for r in results), sum(r.unchanged for r in results), ids,
+    )
+
+
+def _ingest_batch(competitor_id, batch, update_fields, using):
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    meta = Item._meta
+    normalizer = normalizer_for(competitor_id)
+    table = qn(meta.db_table)
+    pk = qn(meta.pk.column)
+    article_col = qn(meta.get_field('article').column)
+
+    fields = _insert_fields()
+    columns = [qn(f.column) for f in fields]
+    values = []
+    for instance in batch.values():
+        instance.article = normalizer.clean(instance.article)
+        values.extend(f.get_db_prep_save(f.pre_save(instance, True), connection) for f in fields)
+
+    # Выражение конфликта должно совпасть с выражением индекса
+    key_sql = normalizer.key_sql_inline(article_col).replace('%', '%%')
+    predicate = article_key_predicate(competitor_id, unique=True, using=using).replace('%', '%%')
+    placeholders = ', '.join(['(' + ', '.join(['%s'] * len(fields)) + ')'] * len(batch))
+    update_columns = [qn(meta.get_field(name).column) for name in update_fields]
+    if update_columns:
+        changed = ' OR '.join(f't.{c} IS DISTINCT FROM EXCLUDED.{c}' for c in update_columns)
+        on_conflict = (
+            f"DO UPDATE SET {', '.join(f'{c} = EXCLUDED.{c}' for c in update_columns)} WHERE {changed}"
+        )
+    else:
+        on_conflict = 'DO NOTHING'
+
+    sql = f"""
+        INSERT INTO {table} AS t ({', '.join(columns)})
+        VALUES {placeholders}
+        ON CONFLICT (({key_sql})) WHERE {predicate}
+        {on_conflict}
+        RETURNING t.{pk}, (t.xmax = 0), {key_sql.replace(article_col, f't.{article_col}')}
+    """
+    created = updated = 0
+    ids = {}
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute(sql, values)
+        for item_id, inserted, key in cursor.fetchall():
+            ids[key] = item_id
+            if inserted:
+                created += 1
+            else:
+                updated += 1
+
+        # Не измененные товары RETURNING не возвращает - их ID берутся по индексу
+        missing = [key for key in batch if key not in ids]
+        if missing:
+            cursor.execute(f"""
+                SELECT {pk}, {key_sql} FROM {table}
+                WHERE {predicate} AND {key_sql} = ANY(%s)
+            """, [missing])
+            ids.update((key, item_id) for item_id, key in cursor.fetchall())
+    return IngestResult(created, updated, len(batch) - created - updated, ids)
@@ -0,0 +1,278 @@
+"""
+Журнал изменений разрушающих команд для быстрой отмены запуска.
+
+Каждый запуск получает run_id (таблица dedupe_journal_run). Перед каждым
+изменением команда записывает в dedupe_journal "снимок до" затронутых строк:
+- delete - строка целиком (to_jsonb), отмена вставляет ее обратно;
+- update - строка целиком до изменения, отмена возвращает все колонки;
+- insert - только PK новой строки, отмена удаляет ее.
+
+Снимки пишутся на стороне БД одним INSERT ... SELECT to_jsonb(t) с тем же
+условием, что и само изменение, - строки не проходят через Python. PK уже
+известных в Python вставленных строк загружаются через COPY.
+
+Однотипные изменения одной модели за запуск объединяются в шаг
+(dedupe_journal_step, порядок первого появления). Отмена (undo_run) идет по
+шагам в обратном порядке, каждый шаг - один set-based запрос через
+jsonb_populate_record; для строки, попавшей в шаг несколько раз, берется
+самый ранний снимок.
+
+Журнал сам не очищается: запуски старше N дней удаляются командой
+undo_run --purge --older-than N (purge_runs).
+"""
+import uuid
+
+from django.apps import apps
+from django.db import connections, models
+
+from ._cascade import _rows_condition, cascade_graph
+from ._db import copy_rows
+
+RUNS_TABLE = 'dedupe_journal_run'
+STEPS_TABLE = 'dedupe_journal_step'
+JOURNAL_TABLE = 'dedupe_journal'
+
+DELETE = 'delete'
+UPDATE = 'update'
+INSERT = 'insert'
+
+
+def ensure_journal_tables(using='default'):
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {RUNS_TABLE} (
+                run_id uuid PRIMARY KEY,
+                command text NOT NULL,
+                competitor_id bigint,
+                started_at timestamptz NOT NULL DEFAULT now(),
+                finished_at timestamptz,
+                undone_at timestamptz
+            )
+        """)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {STEPS_TABLE} (
+                run_id uuid NOT NULL REFERENCES {RUNS_TABLE} ON DELETE CASCADE,
+                step integer NOT NULL,
+                op text NOT NULL,
+                model text NOT NULL,
+                PRIMARY KEY (run_id, step)
+            )
+        """)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {JOURNAL_TABLE} (
+                seq bigserial,
+                run_id uuid NOT NULL,
+                step integer NOT NULL,
+                pk bigint NOT NULL,
+                before jsonb
+            )
+        """)
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {JOURNAL_TABLE}_run_step ON {JOURNAL_TABLE} (run_id, step)')
+
+
+class Journal:
+    """Журнал одного запуска команды.
+
+    Методы capture_* вызываются в той же транзакции, что и само изменение,
+    непосредственно перед ним: откат транзакции откатывает и журнал.
+    """
+
+    def __init__(self, command, competitor_id=None, using='default'):
+        self.using = using
+        self.run_id = str(uuid.uuid4())
+        self._steps = {}
+        ensure_journal_tables(using)
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {RUNS_TABLE} (run_id, command, competitor_id) VALUES (%s, %s, %s)',
+                [self.run_id, command, competitor_id],
+            )
+
+    def _step(self, op, model):
+        key = (op, model._meta.label)
+        step = self._steps.setdefault(key, len(self._steps) + 1)
+        # Строка шага пишется при каждом снимке: если транзакция пачки, где шаг
+        # появился впервые, откатилась, следующая пачка запишет его заново
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {STEPS_TABLE} (run_id, step, op, model) VALUES (%s, %s, %s, %s) '
+                f'ON CONFLICT DO NOTHING',
+                [self.run_id, step, op, model._meta.label],
+            )
+        return step
+
+    def snapshot_sql(self, op, model, source):
+        """INSERT снимков строк model из source - имени CTE со всеми колонками
+        таблицы (например, DELETE ... RETURNING t.*). Для изменений, которые
+        пишут журнал тем же запросом, что и меняют строки: отдельный снимок
+        перед изменением под READ COMMITTED может увидеть другие строки."""
+        qn = connections[self.using].ops.quote_name
+        step = self._step(op, model)
+        before = 'NULL' if op == INSERT else 'to_jsonb(s)'
+        return f"""
+            INSERT INTO {JOURNAL_TABLE} (run_id, step, pk, before)
+            SELECT '{self.run_id}'::uuid, {step}, s.{qn(model._meta.pk.column)}, {before}
+            FROM {source} s
+        """
+
+    def capture(self, op, model, condition, params=None, with_sql=''):
+        """Снимок строк model, удовлетворяющих condition (SQL над алиасом t).
+
+        with_sql - необязательный префикс WITH ... для condition. run_id и шаг
+        подставляются литералами, так что params может быть и списком, и словарем.
+        Возвращает количество записанных строк.
+        """
+        connection = connections[self.using]
+        table = connection.ops.quote_name(model._meta.db_table)
+        sql = f"""
+            {with_sql}
+            {self.snapshot_sql(op, model, f'(SELECT t.* FROM {table} t WHERE {condition})')}
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def capture_ids(self, op, model, ids):
+        qn = connections[self.using].ops.quote_name
+        return self.capture(op, model, f't.{qn(model._meta.pk.column)} = ANY(%s)', [list(ids)])
+
+    def capture_queryset(self, op, queryset):
+        """Снимок строк, которые выберет queryset (до .update()/.delete())."""
+        qn = connections[self.using].ops.quote_name
+        model = queryset.model
+        sql, params = queryset.values('pk').query.sql_with_params()
+        return self.capture(op, model, f't.{qn(model._meta.pk.column)} IN ({sql})', list(params))
+
+    def capture_delete(self, model, ids):
+        """Снимки для удаления ids модели вместе с каскадом - в том же порядке,
+        в каком удаляет _cascade.fast_delete: SET_NULL-обновления, зависимые
+        таблицы от глубоких к корню, сам корень."""
+        connection = connections[self.using]
+        ids = list(ids)
+        edges = cascade_graph(model)
+        captured = 0
+        for edge in edges:
+            if edge.on_delete is models.SET_NULL:
+                captured += self.capture(UPDATE, edge.model, _rows_condition(edge, connection), [ids])
+        cascade_edges = [edge for edge in edges if edge.on_delete is models.CASCADE]
+        for edge in sorted(cascade_edges, key=lambda e: e.depth, reverse=True):
+            captured += self.capture(DELETE, edge.model, _rows_condition(edge, connection), [ids])
+        return captured + self.capture_ids(DELETE, model, ids)
+
+    def record_inserts(self, model, pks):
+        """PK созданных строк - через COPY, без повторного чтения таблицы."""
+        pks = list(pks)
+        if not pks:
+            return 0
+        step = self._step(INSERT, model)
+        with connections[self.using].cursor() as cursor:
+            return copy_rows(cursor, JOURNAL_TABLE, ['run_id', 'step', 'pk'],
+                             ((self.run_id, step, pk) for pk in pks))
+
+    def finish(self):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(f'UPDATE {RUNS_TABLE} SET finished_at = now() WHERE run_id = %s', [self.run_id])
+
+
+def list_runs(limit=20, using='default'):
+    """[(run_id, команда, конкурент, начат, завершен, отменен, строк в журнале)]."""
+    ensure_journal_tables(using)
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"""
+            SELECT r.run_id, r.command, r.competitor_id, r.started_at, r.finished_at, r.undone_at,
+                   (SELECT count(*) FROM {JOURNAL_TABLE} j WHERE j.run_id = r.run_id)
+            FROM {RUNS_TABLE} r
+            ORDER BY r.started_at DESC
+            LIMIT %s
+        """, [limit])
+        return cursor.fetchall()
+
+
+def get_run(run_id, using='default'):
+    ensure_journal_tables(using)
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f'SELECT run_id, command, competitor_id, started_at, finished_at, undone_at '
+            f'FROM {RUNS_TABLE} WHERE run_id = %s',
+            [run_id],
+        )
+        return cursor.fetchone()
+
+
+def run_steps(run_id, using='default'):
+    """[(шаг, операция, модель, строк)] в порядке отмены (обратном)."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"""
+            SELECT s.step, s.op, s.model, (SELECT count(DISTINCT j.pk) FROM {JOURNAL_TABLE} j
+                                           WHERE j.run_id = s.run_id AND j.step = s.step)
+            FROM {STEPS_TABLE} s
+            WHERE s.run_id = %s
+            ORDER BY s.step DESC
+        """, [run_id])
+        return cursor.fetchall()
+
+
+def undo_step(run_id, step, op, model_label, using='default'):
+    """Отменить один шаг запуска одним запросом. Возвращает количество строк."""
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    meta = apps.get_model(model_label)._meta
+    table = qn(meta.db_table)
+    pk = qn(meta.pk.column)
+    # Самый ранний снимок каждой строки шага
+    earliest = f"""
+        SELECT DISTINCT ON (pk) pk, before
+        FROM {JOURNAL_TABLE}
+        WHERE run_id = %s AND step = %s
+        ORDER BY pk, seq
+    """
+    records = f'SELECT (jsonb_populate_record(NULL::{table}, j.before)).* FROM ({earliest}) j'
+
+    if op == DELETE:
+        sql = f'INSERT INTO {table} {records} ON CONFLICT DO NOTHING'
+    elif op == UPDATE:
+        columns = [qn(f.column) for f in meta.concrete_fields if not f.primary_key]
+        sql = f"""
+            UPDATE {table} t
+            SET {', '.join(f'{c} = r.{c}' for c in columns)}
+            FROM ({records}) r
+            WHERE t.{pk} = r.{pk}
+        """
+    elif op == INSERT:
+        sql = f"""
+            DELETE FROM {table}
+            WHERE {pk} IN (SELECT pk FROM {JOURNAL_TABLE} WHERE run_id = %s AND step = %s)
+        """
+    else:
+        raise ValueError(f'Неизвестная операция журнала: {op}')
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [run_id, step])
+        return cursor.rowcount
+
+
+def purgeable_runs(older_than_days, using='default'):
+    """[(run_id, строк в журнале)] запусков, начатых раньше older_than_days дней назад."""
+    ensure_journal_tables(using)
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"""
+            SELECT r.run_id, (SELECT count(*) FROM {JOURNAL_TABLE} j WHERE j.run_id = r.run_id)
+            FROM {RUNS_TABLE} r
+            WHERE r.started_at < now() - make_interval(days => %s)
+            ORDER BY r.started_at
+        """, [older_than_days])
+        return cursor.fetchall()
+
+
+def purge_run(run_id, using='default'):
+    """Удалить запуск и его снимки (шаги - каскадом). Возвращает строк журнала."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {JOURNAL_TABLE} WHERE run_id = %s', [run_id])
+        rows = cursor.rowcount
+        cursor.execute(f'DELETE FROM {RUNS_TABLE} WHERE run_id = %s', [run_id])
+    return rows
+
+
+def mark_undone(run_id, using='default'):
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'UPDATE {RUNS_TABLE} SET undone_at = now() WHERE run_id = %s', [run_id])
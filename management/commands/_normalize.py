@@ -0,0 +1,197 @@
+"""
+Нормализация артикулов товаров конкурентов.
+
+Два уровня:
+- clean(article) - очищенный артикул для хранения в БД: неразрывные и прочие
+  юникодные пробелы -> обычный пробел, невидимые символы (zero-width,
+  soft hyphen, BOM) удаляются, полноширинные символы (１２３ＡＢＣ) -> ASCII,
+  варианты дефиса -> '-', повторные пробелы схлопываются, края обрезаются.
+  Регистр сохраняется. Это то, что записывает article_normalization.
+- key(article) - ключ для поиска дубликатов: clean() плюс правила конкурента
+  (по умолчанию - нижний регистр).
+
+Правила конкурента задаются в settings:
+
+    ARTICLE_NORMALIZATION_RULES = {
+        'default': {'lower': True},
+        142: {'lower': True, 'remove_spaces': True, 'remove_chars': '-./'},
+    }
+
+Для каждого уровня есть SQL-выражение с тем же результатом (translate +
+regexp_replace + btrim), чтобы нормализацию можно было выполнять на стороне
+БД: массовым UPDATE в article_normalization и при группировке дубликатов.
+"""
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import BooleanField, CharField
+from django.db.models.expressions import RawSQL
+from kenny.items.models import Item
+
+from ._journal import UPDATE
+
+DEFAULT_RULES = {'lower': True, 'remove_spaces': False, 'remove_chars': ''}
+
+# Символы, которые заменяются обычным пробелом
+SPACE_CHARS = (
+    '\t\n\v\f\r\u00a0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006'
+    '\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000'
+)
+# Невидимые символы, которые удаляются
+INVISIBLE_CHARS = '\u00ad\u180e\u200b\u200c\u200d\u2060\ufeff'
+# Варианты дефиса и минуса
+DASH_CHARS = '\u2010\u2011\u2012\u2013\u2014\u2015\u2212\ufe63\uff0d'
+# Полноширинные ASCII U+FF01..U+FF5E -> U+0021..U+007E (кроме дефиса - он в DASH_CHARS)
+FULLWIDTH_CHARS = ''.join(chr(code) for code in range(0xFF01, 0xFF5F) if code != 0xFF0D)
+
+MULTIPLE_SPACES = ' {2,}'
+
+
+def _clean_mapping():
+    """(заменяемые символы, замены, удаляемые символы) для clean()."""
+    source = SPACE_CHARS + DASH_CHARS + FULLWIDTH_CHARS
+    target = ' ' * len(SPACE_CHARS) + '-' * len(DASH_CHARS) + ''.join(chr(ord(c) - 0xFEE0) for c in FULLWIDTH_CHARS)
+    return source, target, INVISIBLE_CHARS
+
+
+class ArticleNormalizer:
+    """Нормализатор артикулов с правилами одного конкурента."""
+
+    def __init__(self, rules=None):
+        self.rules = dict(DEFAULT_RULES, **(rules or {}))
+
+        source, target, deleted = _clean_mapping()
+        self._clean_table = str.maketrans(source, target, deleted)
+        # translate() в PostgreSQL удаляет символы "из" без пары в "в"
+        self._clean_from = source + deleted
+        self._clean_to = target
+        self._spaces = re.compile(MULTIPLE_SPACES)
+
+        removed = self.rules['remove_chars'] + (' ' if self.rules['remove_spaces'] else '')
+        self._removed = ''.join(dict.fromkeys(removed))
+        self._key_table = str.maketrans('', '', self._removed) if self._removed else None
+
+    def clean(self, article):
+        """Очищенный артикул для хранения в БД."""
+        if not article:
+            return ''
+        return self._spaces.sub(' ', article.translate(self._clean_table)).strip(' ')
+
+    def key(self, article):
+        """Ключ группировки дубликатов."""
+        value = self.clean(article)
+        if self._key_table:
+            value = value.translate(self._key_table)
+        if self.rules['lower']:
+            value = value.lower()
+        return value
+
+    def clean_sql(self, column):
+        """(SQL, параметры) - то же, что clean(), для выражения column."""
+        sql = f"btrim(regexp_replace(translate(coalesce({column}, ''), %s, %s), %s, ' ', 'g'), ' ')"
+        return sql, [self._clean_from, self._clean_to, MULTIPLE_SPACES]
+
+    def key_sql(self, column):
+        """(SQL, параметры) - то же, что key(), для выражения column."""
+        sql, params = self.clean_sql(column)
+        if self._removed:
+            sql = f"translate({sql}, %s, '')"
+            params = params + [self._removed]
+        if self.rules['lower']:
+            sql = f'lower({sql})'
+        return sql, params
+
+    def key_sql_inline(self, column):
+        """key_sql() с параметрами, подставленными литералами - для выражений
+        индексов и запросов, которые должны совпасть с ними текстуально.
+        В запросе с параметрами '%' в результате нужно удвоить."""
+        sql, params = self.key_sql(column)
+        return sql % tuple(_literal(param) for param in params)
+
+    def key_expression(self, column):
+        """Выражение для QuerySet.annotate(): ключ группировки, посчитанный в БД."""
+        sql, params = self.key_sql(column)
+        return RawSQL(sql, params, output_field=CharField())
+
+
+def _literal(value):
+    # standard_conforming_strings: обратный слеш в '...' не экранирует
+    return "'" + value.replace("'", "''") + "'"
+
+
+def competitor_rules(competitor_id):
+    rules = getattr(settings, 'ARTICLE_NORMALIZATION_RULES', {})
+    return dict(rules.get('default', {}), **rules.get(competitor_id, rules.get(str(competitor_id), {})))
+
+
+@lru_cache(maxsize=None)
+def _normalizer(rules_items):
+    return ArticleNormalizer(dict(rules_items))
+
+
+def normalizer_for(competitor_id):
+    """Нормализатор с правилами конкурента (таблицы компилируются один раз)."""
+    return _normalizer(tuple(sorted(competitor_rules(competitor_id).items())))
+
+
+def with_article_key(queryset, competitor_id):
+    """queryset товаров с аннотацией article_key - ключом группировки дубликатов,
+    посчитанным в БД по правилам конкурента."""
+    column = connections[queryset.db].ops.quote_name(queryset.model._meta.get_field('article').column)
+    return queryset.annotate(article_key=normalizer_for(competitor_id).key_expression(column))
+
+
+def with_key_partition(queryset, competitor_id, part, parts):
+    """queryset товаров, ключ артикула которых попадает в часть part из parts
+    (по hashtext ключа). Группа дубликатов целиком попадает в одну часть,
+    поэтому части можно обрабатывать независимо - на разных воркерах."""
+    column = connections[queryset.db].ops.quote_name(queryset.model._meta.get_field('article').column)
+    sql, params = normalizer_for(competitor_id).key_sql(column)
+    return queryset.filter(RawSQL(
+        f'mod(abs(hashtext({sql})::bigint), %s) = %s', params + [parts, part], output_field=BooleanField(),
+    ))
+
+
+def parse_partition(value):
+    """'P/N' -> (P, N); ValueError при неверном формате."""
+    part, _, parts = value.partition('/')
+    part, parts = int(part), int(parts)
+    if parts < 1 or not 0 <= part < parts:
+        raise ValueError(f'часть должна быть в формате P/N, 0 <= P < N: {value}')
+    return part, parts
+
+
+def normalize_id_range(competitor_id, lo, hi, using='default', journal=None):
+    """UPDATE артикулов товаров конкурента с ID в [lo, hi), у которых артикул
+    не нормализован. Возвращает количество обновленных строк.
+
+    С journal (_journal.Journal) снимки строк до изменения пишутся тем же
+    запросом, что и UPDATE, по заблокированным строкам.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    meta = Item._meta
+    table = qn(meta.db_table)
+    pk = qn(meta.pk.column)
+    article_col = qn(meta.get_field('article').column)
+    clean_sql, clean_params = normalizer_for(competitor_id).clean_sql(f'{table}.{article_col}')
+    condition = (f"{table}.{qn(meta.get_field('competitor').column)} = %s AND {table}.{pk} >= %s "
+                 f'AND {table}.{pk} < %s AND {table}.{article_col} <> {clean_sql}')
+    params = [competitor_id, lo, hi] + clean_params
+    with connection.cursor() as cursor:
+        if journal is None:
+            cursor.execute(f'UPDATE {table} SET {article_col} = {clean_sql} WHERE {condition}',
+                           clean_params + params)
+        else:
+            cursor.execute(f"""
+                WITH target AS (
+                    SELECT {table}.* FROM {table} WHERE {condition} FOR UPDATE
+                ), snapshot AS (
+                    {journal.snapshot_sql(UPDATE, Item, 'target')}
+                )
+                UPDATE {table} SET {article_col} = {clean_sql}
+                FROM target WHERE {table}.{pk} = target.{pk}
+            """, params + clean_params)
+        return cursor.rowcount
@@ -0,0 +1,133 @@
+"""
+Файл плана объединения дубликатов (dedupe_plan -> dedupe_apply).
+
+Формат - JSONL (при расширении .gz - сжатый gzip):
+- первая строка - заголовок: версия формата, конкурент, правило выбора
+  мастера, время создания и отпечаток БД;
+- далее по строке на группу: {"article": ..., "master": id, "slaves": [id, ...]}.
+
+Отпечаток считается по самим товарам плана (id, артикул, конкурент) и
+содержит число найденных товаров. Если после построения плана какой-то из
+этих товаров удален или у него поменялся артикул, отпечаток не совпадет, и
+apply откажется выполняться; план, в котором уже при построении были
+отсутствующие в БД товары, не записывается и не применяется. Новые товары
+конкурента, которые парсеры создают постоянно, на отпечаток не влияют.
+"""
+import gzip
+import json
+from collections import namedtuple
+
+from django.db import connections
+from kenny.items.models import Item
+
+PLAN_FORMAT = 'dedupe-plan'
+PLAN_VERSION = 1
+
+PlanGroup = namedtuple('PlanGroup', ['article', 'master', 'slaves'])
+
+
+class PlanError(Exception):
+    """Файл плана поврежден или не подходит для применения."""
+
+
+def _open(path, mode):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def compute_fingerprint(item_ids, using='default'):
+    """md5 по (id, article, competitor_id) товаров плана, отсортированных по id."""
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    meta = Item._meta
+    article_col = qn(meta.get_field('article').column)
+    competitor_col = qn(meta.get_field('competitor').column)
+    pk = qn(meta.pk.column)
+
+    sql = f"""
+        SELECT count(*), md5(coalesce(string_agg(
+            i.{pk}::text || ':' || coalesce(i.{article_col}, '') || ':' || i.{competitor_col}::text,
+            ',' ORDER BY i.{pk}
+        ), ''))
+        FROM {qn(meta.db_table)} i
+        WHERE i.{pk} = ANY(%s)
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [sorted(item_ids)])
+        found, digest = cursor.fetchone()
+    return f'v{PLAN_VERSION}:{found}:{digest}'
+
+
+def fingerprint_count(fingerprint):
+    """Число товаров, найденных в БД при расчете отпечатка (None - не отпечаток этой версии)."""
+    version, _, rest = (fingerprint or '').partition(':')
+    found, _, _ = rest.partition(':')
+    if version != f'v{PLAN_VERSION}' or not found.isdigit():
+        return None
+    return int(found)
+
+
+def lock_plan_items(item_ids, using='default'):
+    """SELECT ... FOR UPDATE товаров плана (в порядке id - без взаимных
+    блокировок). Вызывается внутри транзакции применения: до ее конца товары
+    плана не изменятся, и сверка отпечатка остается верной."""
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    meta = Item._meta
+    pk = qn(meta.pk.column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT {pk} FROM {qn(meta.db_table)} WHERE {pk} = ANY(%s) ORDER BY {pk} FOR UPDATE',
+            [sorted(item_ids)],
+        )
+        return cursor.rowcount
+
+
+def write_plan(path, header, groups):
+    """Записать план. groups - iterable PlanGroup. Возвращает количество групп."""
+    count = 0
+    with _open(path, 'w') as f:
+        f.write(json.dumps(dict(header, format=PLAN_FORMAT, version=PLAN_VERSION), ensure_ascii=False))
+        f.write('\n')
+        for group in groups:
+            f.write(json.dumps(group._asdict(), ensure_ascii=False))
+            f.write('\n')
+            count += 1
+    return count
+
+
+def read_plan(path):
+    """Прочитать план: (заголовок, список PlanGroup)."""
+    with _open(path, 'r') as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError as e:
+            raise PlanError(f'Не удалось прочитать заголовок плана: {e}')
+
+        if header.get('format') != PLAN_FORMAT:
+            raise PlanError('Файл не является планом объединения дубликатов')
+        if header.get('version') != PLAN_VERSION:
+            raise PlanError(f"Неподдерживаемая версия плана: {header.get('version')} (ожидается {PLAN_VERSION})")
+
+        groups = []
+        for line_number, line in enumerate(f, 2):
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+                groups.append(PlanGroup(data['article'], int(data['master']), [int(i) for i in data['slaves']]))
+            except (ValueError, KeyError, TypeError) as e:
+                raise PlanError(f'Ошибка в строке {line_number}: {e}')
+
+    if header.get('groups') is not None and header['groups'] != len(groups):
+        raise PlanError(f"План неполный: в заголовке {header['groups']} групп, прочитано {len(groups)}")
+    return header, groups
+
+
+def plan_item_ids(groups):
+    ids = []
+    for group in groups:
+        ids.append(group.master)
+        ids.extend(group.slaves)
+    return ids
@@ -0,0 +1,182 @@
+"""
+Общий индикатор прогресса для долгих команд.
+
+- вывод в консоль не чаще, чем раз в interval секунд (и всегда в конце);
+- скорость, процент и оставшееся время;
+- общее количество можно оценить дешево - по плану запроса (EXPLAIN) вместо
+  count();
+- метрики в формате Prometheus textfile collector: если задан каталог
+  PROMETHEUS_TEXTFILE_DIR (в settings или переменной окружения), туда пишется
+  файл <job>_<метки>_<pid>.prom, который node exporter отдает в Prometheus.
+  Метки (конкурент, фаза и т.п.) и pid входят и в имя файла, и в метки
+  метрик, поэтому параллельные запуски не перезаписывают друг друга; файлы
+  завершенных запусков (running=0) остаются до внешней очистки. По метрике
+  django_command_last_progress_timestamp_seconds удобно ловить зависшие запуски.
+"""
+import json
+import os
+import re
+import time
+
+from django.conf import settings
+
+METRIC_PREFIX = 'django_command'
+
+
+def estimate_count(queryset, exact=False):
+    """Количество строк queryset: оценка планировщика PostgreSQL или count().
+
+    Оценка стоит один EXPLAIN без выполнения запроса. Если она недоступна
+    (другая СУБД, ошибка разбора) - делается обычный count().
+    """
+    if not exact:
+        try:
+            plan = json.loads(queryset.explain(format='json'))
+            return int(plan[0]['Plan']['Plan Rows'])
+        except Exception:
+            pass
+    return queryset.count()
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return 'расчет...'
+    if seconds > 3600:
+        return f'{seconds / 3600:.1f} ч'
+    if seconds > 60:
+        return f'{seconds / 60:.1f} мин'
+    return f'{seconds:.1f} сек'
+
+
+def _metrics_dir():
+    return getattr(settings, 'PROMETHEUS_TEXTFILE_DIR', None) or os.getenv('PROMETHEUS_TEXTFILE_DIR')
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def metrics_file_name(job, labels):
+    """Имя файла метрик: задача и значения меток (в порядке имен меток, включая pid)."""
+    parts = [job] + [str(value) for _, value in sorted(labels.items())]
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', '_'.join(parts)) + '.prom'
+
+
+class ProgressReporter:
+    """Прогресс долгой операции: консоль с троттлингом и Prometheus textfile.
+
+    write - функция вывода строки (self.stdout.write или write_output команды).
+    total может быть оценкой: если done его превысит, total подтянется.
+    """
+
+    def __init__(self, write, job, total=None, unit='записей', interval=10.0,
+                 metrics_interval=5.0, labels=None):
+        self.write = write
+        self.job = job
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.metrics_interval = metrics_interval
+        self.labels = dict(labels or {}, pid=os.getpid())
+        self.counters = {}
+
+        self.done = 0
+        self.start_time = time.time()
+        self.last_print_time = self.start_time
+        self.last_metrics_time = 0
+        self.metrics_dir = _metrics_dir()
+        self.write_metrics(running=True)
+
+    def update(self, advance=0, done=None, **counters):
+        """Отметить прогресс: advance - сколько обработано с прошлого вызова
+        (или done - сколько всего), counters - дополнительные счетчики."""
+        self.done = done if done is not None else self.done + advance
+        self.counters.update(counters)
+        if self.total is not None and self.done > self.total:
+            self.total = self.done
+
+        now = time.time()
+        if now - self.last_print_time >= self.interval:
+            self.print_progress(now)
+        if now - self.last_metrics_time >= self.metrics_interval:
+            self.write_metrics(running=True, now=now)
+
+    def finish(self):
+        now = time.time()
+        # Оценка планировщика могла разойтись с фактом - в конце верен done
+        self.total = self.done
+        self.print_progress(now)
+        self.write_metrics(running=False, now=now)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def rate(self, now=None):
+        elapsed = (now or time.time()) - self.start_time
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def eta(self, now=None):
+        rate = self.rate(now)
+        if self.total is None or rate <= 0:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def print_progress(self, now):
+        self.last_print_time = now
+        if self.total:
+            position = f'{self.done}/{self.total} ({self.done / self.total * 100:.1f}%)'
+        else:
+            position = f'{self.done}'
+        parts = [f'Прогресс: {position}']
+        parts.extend(f"{name.replace('_', ' ')}: {value}" for name, value in self.counters.items())
+        parts.append(f'Прошло: {format_duration(now - self.start_time)}')
+        if self.total:
+            parts.append(f'Осталось: {format_duration(self.eta(now))}')
+        parts.append(f'Скорость: {self.rate(now):.1f} {self.unit}/сек')
+        self.write(' | '.join(parts))
+
+    def write_metrics(self, running, now=None):
+        if not self.metrics_dir:
+            return
+        now = now or time.time()
+        self.last_metrics_time = now
+
+        labels = dict(self.labels, job=self.job)
+        label_str = ','.join(f'{key}="{_label_value(value)}"' for key, value in sorted(labels.items()))
+        eta = self.eta(now)
+        metrics = [
+            ('processed', 'Обработано записей', self.done),
+            ('total', 'Всего записей (может быть оценкой)', self.total if self.total is not None else 'NaN'),
+            ('rate_per_second', 'Средняя скорость обработки', round(self.rate(now), 3)),
+            ('eta_seconds', 'Оценка оставшегося времени', round(eta, 1) if eta is not None else 'NaN'),
+            ('running', '1 - команда выполняется, 0 - завершена', int(running)),
+            ('start_timestamp_seconds', 'Время запуска', round(self.start_time, 3)),
+            ('last_progress_timestamp_seconds', 'Время последнего обновления прогресса', round(now, 3)),
+        ]
+
+        lines = []
+        for name, help_text, value in metrics:
+            full_name = f'{METRIC_PREFIX}_{name}'
+            lines.append(f'# HELP {full_name} {help_text}')
+            lines.append(f'# TYPE {full_name} gauge')
+            lines.append(f'{full_name}{{{label_str}}} {value}')
+
+        counter_name = f'{METRIC_PREFIX}_counter'
+        numeric_counters = {k: v for k, v in self.counters.items() if isinstance(v, (int, float))}
+        if numeric_counters:
+            lines.append(f'# HELP {counter_name} Дополнительные счетчики команды')
+            lines.append(f'# TYPE {counter_name} gauge')
+            for key, value in sorted(numeric_counters.items()):
+                lines.append(f'{counter_name}{{{label_str},counter="{_label_value(key)}"}} {value}')
+
+        # Запись через временный файл: node exporter не должен прочитать половину
+        path = os.path.join(self.metrics_dir, metrics_file_name(self.job, self.labels))
+        tmp_path = f'{path}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp_path, path)
+        except OSError:
+            # Метрики не должны ронять команду
+            self.metrics_dir = None
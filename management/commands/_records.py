@@ -0,0 +1,107 @@
+"""
+Компактные записи товаров для группировки дубликатов в памяти.
+
+Полный экземпляр Item (словарь атрибутов, _state, name и прочие поля) занимает
+около килобайта; для группировки и выбора мастера нужны только id, article,
+date_create, url и ключ артикула. ItemRecord со __slots__ хранит только их,
+а артикулы и ключи интернируются: варианты написания одного артикула и ключи
+группы делят одну строку. name нужен только отчету и подгружается отдельным
+запросом для товаров из групп дубликатов (load_names).
+
+MemoryReport - пиковый и текущий RSS процесса по этапам команды (--memory-report).
+"""
+import os
+import sys
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from kenny.items.models import Item
+
+RECORD_FIELDS = ('id', 'article', 'date_create', 'url', 'article_key')
+
+
+class ItemRecord:
+    """Товар для группировки: те же атрибуты, что читают MasterSelector и команды."""
+    __slots__ = RECORD_FIELDS + ('name',)
+
+    def __init__(self, id, article, date_create, url, article_key, name=None):
+        self.id = id
+        self.article = article
+        self.date_create = date_create
+        self.url = url
+        self.article_key = article_key
+        self.name = name
+
+    def __repr__(self):
+        return f'ItemRecord(id={self.id}, article={self.article!r})'
+
+
+def _intern(value):
+    return sys.intern(value) if value is not None else None
+
+
+def iter_item_records(queryset, chunk_size=5000):
+    """ItemRecord по queryset с аннотацией article_key (см. _normalize.with_article_key)."""
+    for item_id, article, date_create, url, article_key in queryset.values_list(
+            *RECORD_FIELDS).iterator(chunk_size=chunk_size):
+        yield ItemRecord(item_id, _intern(article), date_create, url, _intern(article_key))
+
+
+def load_item_records(queryset, chunk_size=5000):
+    return list(iter_item_records(queryset, chunk_size))
+
+
+def load_names(records, chunk_size=5000):
+    """Подгружает name для записей групповыми запросами по chunk_size ID."""
+    by_id = {record.id: record for record in records}
+    ids = list(by_id)
+    for i in range(0, len(ids), chunk_size):
+        for item_id, name in Item.objects.filter(id__in=ids[i:i + chunk_size]).values_list('id', 'name'):
+            by_id[item_id].name = name
+
+
+def _current_rss():
+    """Текущий RSS в байтах (Linux) или None."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss():
+    """Пиковый RSS процесса в байтах или None."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS - байты
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _mb(value):
+    return f'{value / 1024 / 1024:.1f} МБ' if value is not None else 'н/д'
+
+
+class MemoryReport:
+    """Пиковый и текущий RSS по этапам. Без enabled ничего не измеряет."""
+
+    def __init__(self, write, enabled=True):
+        self.write = write
+        self.enabled = enabled
+        self.points = []
+
+    def checkpoint(self, label):
+        if self.enabled:
+            self.points.append((label, _current_rss(), _peak_rss()))
+
+    def finish(self):
+        if not self.enabled or not self.points:
+            return
+        self.write('\nПАМЯТЬ (--memory-report):')
+        first_peak = self.points[0][2]
+        for label, rss, peak in self.points:
+            growth = f' (+{_mb(peak - first_peak)})' if peak is not None and first_peak is not None else ''
+            self.write(f'   {label}: RSS {_mb(rss)}, пик {_mb(peak)}{growth}')
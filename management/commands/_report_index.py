@@ -0,0 +1,167 @@
+"""
+Индекс ID товаров и артикулов по файлам отчетов и логов в SQLite.
+
+Вместо grep по result/**/*.txt|*.log, когда нужно понять, какой запуск
+затронул товар: файлы разбираются _reports.iter_report_events, в индекс
+пишется (ID товара, ключ артикула, файл, смещение строки, роль).
+
+Индекс инкрементальный: для каждого файла хранятся размер и mtime, при
+повторном запуске разбираются только новые и изменившиеся файлы, записи
+удаленных файлов убираются. Роль и файл хранятся числами, поиск по ID и
+по артикулу идет по индексам SQLite.
+"""
+import gzip
+import os
+import sqlite3
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+
+from ._reports import DELETED, DUPLICATE, KEPT, MASTER, SLAVE, iter_report_events
+
+DEFAULT_PATTERNS = ('*.txt', '*.log', '*.jsonl', '*.jsonl.gz')
+INDEX_FILENAME = '.report_index.sqlite3'
+
+ROLES = (MASTER, SLAVE, KEPT, DELETED, DUPLICATE)
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+# Строк индекса в одном executemany
+INSERT_BATCH = 10000
+
+IndexHit = namedtuple('IndexHit', ['path', 'offset', 'role', 'item_id', 'article', 'modified'])
+IndexStats = namedtuple('IndexStats', ['indexed', 'skipped', 'removed', 'entries'])
+
+
+def article_key(article):
+    return article.strip().lower()
+
+
+class ReportIndex:
+    def __init__(self, root, db_path=None):
+        self.root = Path(root)
+        self.db_path = Path(db_path) if db_path else self.root / INDEX_FILENAME
+        self.connection = sqlite3.connect(str(self.db_path))
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                entries INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                item_id INTEGER,
+                article TEXT NOT NULL,
+                file_id INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                role INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_item_id ON entries (item_id) WHERE item_id IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS entries_article ON entries (article);
+            CREATE INDEX IF NOT EXISTS entries_file_id ON entries (file_id);
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def report_files(self, patterns=DEFAULT_PATTERNS):
+        found = set()
+        for pattern in patterns:
+            found.update(p for p in self.root.rglob(pattern) if p.is_file())
+        return sorted(found)
+
+    def update(self, patterns=DEFAULT_PATTERNS, full=False, on_file=None):
+        """Проиндексировать новые и изменившиеся файлы. full=True - все заново.
+        on_file(путь, записей) вызывается после каждого проиндексированного файла."""
+        db = self.connection
+        known = {path: (file_id, size, mtime_ns)
+                 for file_id, path, size, mtime_ns in db.execute('SELECT id, path, size, mtime_ns FROM files')}
+        indexed = skipped = 0
+        seen = set()
+
+        for path in self.report_files(patterns):
+            if path.resolve() == self.db_path.resolve():
+                continue
+            relative = str(path.relative_to(self.root))
+            seen.add(relative)
+            stat = path.stat()
+            previous = known.get(relative)
+            if previous and not full and previous[1:] == (stat.st_size, stat.st_mtime_ns):
+                skipped += 1
+                continue
+
+            with db:
+                if previous:
+                    db.execute('DELETE FROM entries WHERE file_id = ?', [previous[0]])
+                    db.execute('DELETE FROM files WHERE id = ?', [previous[0]])
+                file_id = db.execute(
+                    'INSERT INTO files (path, size, mtime_ns) VALUES (?, ?, ?)',
+                    [relative, stat.st_size, stat.st_mtime_ns],
+                ).lastrowid
+                count = self._index_file(path, file_id)
+                db.execute('UPDATE files SET entries = ? WHERE id = ?', [count, file_id])
+            indexed += 1
+            if on_file:
+                on_file(relative, count)
+
+        removed = [file_id for path, (file_id, _, _) in known.items() if path not in seen]
+        with db:
+            for file_id in removed:
+                db.execute('DELETE FROM entries WHERE file_id = ?', [file_id])
+                db.execute('DELETE FROM files WHERE id = ?', [file_id])
+
+        entries = db.execute('SELECT count(*) FROM entries').fetchone()[0]
+        return IndexStats(indexed, skipped, len(removed), entries)
+
+    def _index_file(self, path, file_id):
+        insert = 'INSERT INTO entries (item_id, article, file_id, offset, role) VALUES (?, ?, ?, ?, ?)'
+        rows = []
+        count = 0
+        for offset, article, item_id, role in iter_report_events(path):
+            rows.append((item_id, article_key(article), file_id, offset, ROLE_CODES[role]))
+            if len(rows) >= INSERT_BATCH:
+                self.connection.executemany(insert, rows)
+                count += len(rows)
+                rows = []
+        if rows:
+            self.connection.executemany(insert, rows)
+            count += len(rows)
+        return count
+
+    def _hits(self, where, params):
+        rows = self.connection.execute(f"""
+            SELECT f.path, e.offset, e.role, e.item_id, e.article, f.mtime_ns
+            FROM entries e JOIN files f ON f.id = e.file_id
+            WHERE {where}
+            ORDER BY f.path, e.offset
+        """, params)
+        return [
+            IndexHit(self.root / path, offset, ROLES[role], item_id, article,
+                     datetime.fromtimestamp(mtime_ns / 1e9))
+            for path, offset, role, item_id, article, mtime_ns in rows
+        ]
+
+    def find_item(self, item_id):
+        """Все упоминания товара в отчетах, в порядке файлов."""
+        return self._hits('e.item_id = ?', [int(item_id)])
+
+    def find_article(self, article):
+        return self._hits('e.article = ?', [article_key(article)])
+
+
+def read_line(path, offset):
+    """Строка файла по смещению (для вывода найденного места)."""
+    if not os.path.exists(path):
+        return ''
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        f.seek(offset)
+        return f.readline().decode('utf-8', 'replace').rstrip()
@@ -0,0 +1,255 @@
+"""
+Потоковый разбор файлов отчетов команд дедупликации.
+
+Поддерживаемые форматы (определяются по строкам, а не по имени файла):
+- preview_merge_*.txt (merge_duplicate_item(s), dedupe_plan):
+  "Артикул: '...'", "Мастер-товар: <id> (...)", "Подчинённый товар: <id> (...)";
+- merge_result_*.txt: "Артикул: ...", "Мастер-товар ID: <id>",
+  "  Подчинённый товар N (ID: <id>): ...", в детальной части
+  "Подчинённый товар ID: <id>" + "Перенесено на мастер-товар ID: <id>";
+- duplicates_report_*.txt (remove_duplicate_items --output):
+  "Артикул: ...", блоки "Оставляем товар:" / "Удаляем товары:" с "  ID: <id>";
+- preview_deletion_*.txt (remove_duplicate_items_test):
+  "Сохраняемый товар (...): <id> - <url>", "К удалению: <id> - <url>";
+- duplicates_report.txt (date_duplicate): "Артикул: <a>, Кол-во с пробелами: ...";
+- check_report_*.log (check_report_items): "  N. ID: <id>, Артикул: '...'";
+- планы dedupe_plan (.jsonl / .jsonl.gz).
+
+Файл читается блоками по целым строкам в бинарном режиме, нужные строки
+находит одно регулярное выражение, декодируются только артикулы. Смещение
+каждой найденной строки в файле известно.
+"""
+import gzip
+import json
+import re
+from array import array
+from collections import namedtuple
+
+from ._plan import PLAN_FORMAT
+
+# Роли товара в отчете
+MASTER = 'master'
+SLAVE = 'slave'
+KEPT = 'kept'
+DELETED = 'deleted'
+DUPLICATE = 'duplicate'
+
+# Роли, означающие "этот товар остается"
+KEEP_ROLES = (MASTER, KEPT)
+
+# Файл читается блоками по целым строкам
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Одна альтернатива на вид строки, номер сработавшей группы (lastindex) -
+# вид строки. Неинтересные строки пропускает движок регулярных выражений.
+LINE_RE = re.compile('|'.join([
+    r'^Артикул: ([^\r\n]*?)(, Кол-во с пробелами: [^\r\n]*)?\r?$',   # 1, 2 - отчет date_duplicate
+    r'^Мастер-товар(?: ID)?: (\d+)',                                  # 3
+    r'^Подчинённый товар: (\d+)',                                     # 4
+    r'^  Подчинённый товар \d+ \(ID: (\d+)\)',                        # 5
+    r'^К удалению: (\d+)',                                            # 6
+    r'^Сохраняемый товар [^\r\n]*?\): (\d+)',                         # 7
+    r'^(Оставляем) товар:',                                           # 8
+    r'^(Удаляем) товары:',                                            # 9
+    r'^  ID: (\d+)',                                                  # 10
+    r'^Подчинённый товар ID: (\d+|None)',                             # 11
+    r'^Перенесено на мастер-товар ID: (\d+)',                         # 12
+    r'^  \d+\. ID: (\d+), Артикул: ([^\r\n]*)',                       # 13, 14 - лог check_report_items
+]).encode(), re.MULTILINE)
+
+# Вид строки -> роль товара в группе текущего артикула
+LINE_ROLES = {3: MASTER, 4: SLAVE, 5: SLAVE, 6: DELETED, 7: KEPT}
+
+
+def _article(data):
+    value = data.decode('utf-8', 'replace').strip()
+    if len(value) >= 2 and value[0] == value[-1] == "'":
+        value = value[1:-1]
+    return value
+
+
+def is_plan_file(path):
+    return str(path).endswith(('.jsonl', '.jsonl.gz'))
+
+
+def _iter_chunks(path):
+    """(смещение блока, блок) - файл целыми строками, блоками около CHUNK_SIZE."""
+    with open(path, 'rb') as f:
+        offset = 0
+        tail = b''
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                if tail:
+                    yield offset, tail
+                return
+            data = tail + data
+            end = data.rfind(b'\n') + 1
+            if not end:
+                tail = data
+                continue
+            yield offset, data[:end]
+            offset += end
+            tail = data[end:]
+
+
+def iter_report_events(path):
+    """(смещение строки, артикул группы, ID товара, роль) для каждой строки
+    отчета, где упомянут товар. В отчете date_duplicate ID товаров нет -
+    там ID равен None, роль DUPLICATE.
+    """
+    if is_plan_file(path):
+        yield from _iter_plan_events(path)
+        return
+
+    article = None
+    block = None
+    master_articles = {}
+    pending_slave = None
+
+    for chunk_offset, chunk in _iter_chunks(path):
+        for match in LINE_RE.finditer(chunk):
+            kind = match.lastindex
+            role = LINE_ROLES.get(kind)
+            if role is not None:
+                if article is not None:
+                    item_id = int(match.group(kind))
+                    if role == MASTER:
+                        master_articles[item_id] = article
+                    yield chunk_offset + match.start(), article, item_id, role
+            elif kind == 1:
+                article = _article(match.group(1))
+                block = None
+            elif kind == 2:
+                # Отчет date_duplicate: одна строка на артикул
+                article = None
+                yield chunk_offset + match.start(), _article(match.group(1)), None, DUPLICATE
+            elif kind == 10:
+                if block is not None and article is not None:
+                    yield chunk_offset + match.start(), article, int(match.group(10)), block
+            elif kind == 8:
+                block = KEPT
+            elif kind == 9:
+                block = DELETED
+            elif kind == 11:
+                value = match.group(11)
+                pending_slave = (chunk_offset + match.start(), int(value)) if value.isdigit() else None
+            elif kind == 12:
+                # Детальная часть merge_result: группа подчинённого - по его мастеру
+                master_article = master_articles.get(int(match.group(12)))
+                if pending_slave is not None and master_article is not None:
+                    yield pending_slave[0], master_article, pending_slave[1], SLAVE
+                pending_slave = None
+            elif kind == 14:
+                # Лог проверки: найденный в базе сохраненный товар со своим артикулом
+                yield chunk_offset + match.start(), _article(match.group(14)), int(match.group(13)), KEPT
+
+
+def _iter_plan_events(path):
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        offset = 0
+        for line_number, line in enumerate(f):
+            start = offset
+            offset += len(line)
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            if line_number == 0:
+                if data.get('format') != PLAN_FORMAT:
+                    return
+                continue
+            yield start, data['article'], int(data['master']), MASTER
+            for slave_id in data['slaves']:
+                yield start, data['article'], int(slave_id), SLAVE
+
+
+class ReportGroups:
+    """Группы отчета в компактном виде.
+
+    Ключи групп (артикул без кавычек и пробелов по краям, в нижнем регистре)
+    отсортированы; для каждой группы - ID сохраняемого товара (0, если его
+    нет в файле) и срез отсортированных ID удаляемых в общем array('q').
+    """
+    __slots__ = ('path', 'keys', 'masters', 'slave_starts', 'slaves')
+
+    def __init__(self, path):
+        self.path = path
+        masters = {}
+        slaves = {}
+        article = key = group_slaves = None
+        for _, event_article, item_id, role in iter_report_events(path):
+            if item_id is None:
+                continue
+            # Строки одной группы идут подряд - ключ считается один раз на группу
+            if event_article is not article:
+                article = event_article
+                key = article.strip().lower()
+                group_slaves = slaves.get(key)
+            if role in KEEP_ROLES:
+                if not masters.get(key):
+                    masters[key] = item_id
+            else:
+                if group_slaves is None:
+                    masters.setdefault(key, 0)
+                    group_slaves = slaves[key] = []
+                group_slaves.append(item_id)
+
+        self.keys = sorted(masters)
+        self.masters = array('q', [masters[key] for key in self.keys])
+        self.slave_starts = array('q', [0])
+        self.slaves = array('q')
+        for key in self.keys:
+            group_slaves = slaves.get(key)
+            if group_slaves:
+                group_slaves.sort()
+                self.slaves.extend(group_slaves)
+            self.slave_starts.append(len(self.slaves))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def slaves_at(self, position):
+        return self.slaves[self.slave_starts[position]:self.slave_starts[position + 1]]
+
+    @property
+    def slave_count(self):
+        return len(self.slaves)
+
+
+ReportDiff = namedtuple('ReportDiff', ['added', 'removed', 'master_changed', 'slaves_changed', 'unchanged'])
+
+
+def diff_groups(old, new):
+    """Сравнение двух ReportGroups слиянием отсортированных ключей за линейное время.
+
+    added/removed - списки ключей; master_changed - (ключ, старый, новый мастер);
+    slaves_changed - (ключ, ушедшие ID, появившиеся ID) при том же мастере.
+    """
+    added, removed, master_changed, slaves_changed = [], [], [], []
+    unchanged = 0
+    i = j = 0
+    old_keys, new_keys = old.keys, new.keys
+    while i < len(old_keys) and j < len(new_keys):
+        old_key, new_key = old_keys[i], new_keys[j]
+        if old_key < new_key:
+            removed.append(old_key)
+            i += 1
+        elif old_key > new_key:
+            added.append(new_key)
+            j += 1
+        else:
+            if old.masters[i] != new.masters[j]:
+                master_changed.append((old_key, old.masters[i], new.masters[j]))
+            else:
+                old_slaves, new_slaves = old.slaves_at(i), new.slaves_at(j)
+                if old_slaves != new_slaves:
+                    old_set, new_set = set(old_slaves), set(new_slaves)
+                    slaves_changed.append((old_key, sorted(old_set - new_set), sorted(new_set - old_set)))
+                else:
+                    unchanged += 1
+            i += 1
+            j += 1
+    removed.extend(old_keys[i:])
+    added.extend(new_keys[j:])
+    return ReportDiff(added, removed, master_changed, slaves_changed, unchanged)
@@ -0,0 +1,116 @@
+"""
+Выбор базы для чтений фазы планирования (--read-from).
+
+Реплика используется, только если она не отстает:
+1. если алиас - реплика в режиме восстановления, отставание воспроизведения
+   (now() - pg_last_xact_replay_timestamp()) не больше DEDUPE_REPLICA_MAX_LAG;
+2. иначе (копия без потоковой репликации, простаивающий мастер, на котором
+   отметка воспроизведения устаревает) - у конкурента на реплике столько же
+   товаров и тот же максимальный ID, что в default. Одного максимального ID
+   мало: backup (источник restore_item) хранит и товары, уже удаленные из
+   default. Правки артикулов не видны и так - команды, удаляющие по плану с
+   реплики, перепроверяют группы в default (revalidate_groups).
+Если реплика отстает или недоступна - чтение идет из default.
+
+Сама маршрутизация - conf.read_routing.route_reads.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.db.models import Count, Max
+from django.db.utils import ConnectionDoesNotExist
+from kenny.items.models import Item
+
+from ._normalize import with_article_key
+
+DEFAULT_MAX_LAG = 60.0
+# Товаров в одном запросе перепроверки групп
+REVALIDATE_CHUNK = 10000
+
+
+def resolve_read_alias(option):
+    """Значение --read-from: None - без маршрутизации, '' - алиас из настроек."""
+    if option is None:
+        return None
+    return option or getattr(settings, 'DEDUPE_READ_ALIAS', None)
+
+
+def replica_lag(alias):
+    """(в режиме восстановления ли, отставание в секундах или None)."""
+    with connections[alias].cursor() as cursor:
+        cursor.execute(
+            'SELECT pg_is_in_recovery(), extract(epoch FROM now() - pg_last_xact_replay_timestamp())'
+        )
+        in_recovery, lag = cursor.fetchone()
+    return in_recovery, float(lag) if lag is not None else None
+
+
+def item_stats(alias, competitor_id=None):
+    """(количество товаров, максимальный ID)."""
+    items = Item.objects.using(alias)
+    if competitor_id is not None:
+        items = items.filter(competitor_id=competitor_id)
+    stats = items.aggregate(count=Count('id'), max_id=Max('id'))
+    return stats['count'], stats['max_id'] or 0
+
+
+def check_replica(alias, competitor_id=None, max_lag=None):
+    """(можно ли читать с alias, причина)."""
+    if max_lag is None:
+        max_lag = getattr(settings, 'DEDUPE_REPLICA_MAX_LAG', DEFAULT_MAX_LAG)
+    try:
+        in_recovery, lag = replica_lag(alias)
+        if in_recovery and lag is not None and lag <= max_lag:
+            return True, f'отставание реплики {lag:.1f} с'
+
+        replica_count, replica_max = item_stats(alias, competitor_id)
+        default_count, default_max = item_stats(DEFAULT_DB_ALIAS, competitor_id)
+    except (ConnectionDoesNotExist, DatabaseError) as e:
+        return False, f'реплика недоступна: {e}'
+
+    if (replica_count, replica_max) == (default_count, default_max):
+        return True, f'количество и максимальный ID товаров совпадают ({replica_count}, {replica_max})'
+    lag_text = f', отставание {lag:.0f} с' if lag is not None else ''
+    return False, (f'реплика расходится с {DEFAULT_DB_ALIAS}: товаров {replica_count} / {default_count}, '
+                   f'максимальный ID {replica_max} / {default_max}{lag_text}')
+
+
+def choose_read_alias(option, competitor_id=None, write=None):
+    """Алиас для чтений планирования по значению --read-from (default, если
+    маршрутизация не запрошена или реплика отстает). write - вывод причины."""
+    alias = resolve_read_alias(option)
+    if not alias or alias == DEFAULT_DB_ALIAS:
+        return DEFAULT_DB_ALIAS
+
+    usable, reason = check_replica(alias, competitor_id)
+    if write:
+        if usable:
+            write(f'Чтение данных для планирования: {alias} ({reason})')
+        else:
+            write(f'Чтение данных для планирования: {DEFAULT_DB_ALIAS} - {reason}')
+    return alias if usable else DEFAULT_DB_ALIAS
+
+
+def revalidate_groups(competitor_id, groups, using=DEFAULT_DB_ALIAS):
+    """Группы дубликатов, найденные по реплике, перепроверенные в using.
+
+    groups - iterable (ключ артикула, ID мастера, [ID остальных]). Группа
+    пропускается целиком, если мастер удален или у кого-то из товаров группы
+    ключ артикула уже другой; удаленные остальные товары просто выпадают.
+    Возвращает (список (ключ, мастер, [оставшиеся ID]), пропущено групп).
+    """
+    groups = list(groups)
+    ids = [item_id for _, master_id, other_ids in groups for item_id in (master_id, *other_ids)]
+    current = {}
+    for start in range(0, len(ids), REVALIDATE_CHUNK):
+        queryset = Item.objects.using(using).filter(id__in=ids[start:start + REVALIDATE_CHUNK])
+        current.update(with_article_key(queryset, competitor_id).values_list('id', 'article_key'))
+
+    valid = []
+    skipped = 0
+    for article_key, master_id, other_ids in groups:
+        changed = any(item_id in current and current[item_id] != article_key for item_id in other_ids)
+        if current.get(master_id) != article_key or changed:
+            skipped += 1
+            continue
+        valid.append((article_key, master_id, [item_id for item_id in other_ids if item_id in current]))
+    return valid, skipped
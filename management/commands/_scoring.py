@@ -0,0 +1,154 @@
+"""
+Выбор мастер-товара в группах дубликатов.
+
+Правило - это цепочка признаков с направлением сортировки. Признаки всех
+товаров всех групп собираются в колонки: базовые (date_create, url, article)
+берутся из уже загруженных товаров, агрегатные (дата последней информации,
+количество истории) - несколькими групповыми запросами на весь набор ID.
+Затем все товары сортируются одним проходом по ключу
+(группа, признак1, признак2, ..., позиция в группе), и первый товар каждой
+группы становится мастером.
+
+При равенстве всех признаков побеждает товар, стоящий в группе раньше, - так
+же, как при стабильной сортировке, которую команды делали раньше.
+"""
+from collections import namedtuple
+
+from django.db.models import Count, Max
+from kenny.items.models import ItemInfo, ItemInfoHistory
+
+ASC = 1
+DESC = -1
+
+# Название правила -> цепочка (признак, направление)
+RULES = {
+    # Самая свежая ItemInfo.analyzed_at (нет информации - дата создания товара)
+    'latest_info': [('latest_info_date', DESC)],
+    # Больше всего записей истории
+    'most_history': [('history_count', DESC)],
+    # Первый товар с пробелом в начале артикула, иначе самый новый
+    'leading_space': [('leading_space', DESC), ('unspaced_recency', DESC)],
+    # Самый новый товар без query-параметров в URL, иначе самый старый
+    'clean_url': [('url_clean', DESC), ('clean_url_recency', DESC)],
+}
+
+Selection = namedtuple('Selection', ['key', 'master', 'slaves'])
+
+
+def _timestamp(value):
+    return value.timestamp() if value is not None else float('-inf')
+
+
+def _is_clean_url(url):
+    return bool(url) and '?' not in url and '%3F' not in url
+
+
+class MasterSelector:
+    """Выбирает мастер-товар для каждой группы дубликатов по правилу."""
+
+    def __init__(self, rule, using=None, chunk_size=5000, extra_features=(), batcher=None):
+        if rule not in RULES:
+            raise ValueError(f'Неизвестное правило выбора мастера: {rule}. Доступны: {", ".join(RULES)}')
+        self.rule = rule
+        self.chain = RULES[rule]
+        # Признаки, которые не участвуют в выборе, но нужны команде для отчета
+        self.extra_features = tuple(extra_features)
+        # None - база выбирается роутерами (в том числе route_reads)
+        self.using = using
+        self.chunk_size = chunk_size
+        # AdaptiveBatcher (_batching) - размер чанка по времени запросов вместо chunk_size
+        self.batcher = batcher
+        # Значения признаков по ID товара - нужны командам для отчетов
+        self.values = {}
+
+    def select(self, groups):
+        """groups - iterable пар (ключ, [товары]). Возвращает список Selection.
+
+        Товар - любой объект с атрибутами id, article, date_create, url
+        (модель Item или компактная запись).
+        """
+        groups = [(key, list(items)) for key, items in groups]
+        flat_items = [item for _, items in groups for item in items]
+        self.load_features(flat_items)
+
+        # Колонки: номер группы, позиция в группе и по колонке на признак цепочки
+        group_column = []
+        position_column = []
+        for group_index, (_, items) in enumerate(groups):
+            group_column.extend([group_index] * len(items))
+            position_column.extend(range(len(items)))
+
+        # Сортировка по возрастанию, поэтому DESC-признаки берутся с обратным знаком
+        feature_columns = [
+            [direction * self.values[name][item.id] for item in flat_items]
+            for name, direction in self.chain
+        ]
+        sort_keys = list(zip(group_column, *feature_columns, position_column))
+        order = sorted(range(len(flat_items)), key=sort_keys.__getitem__)
+
+        selections = []
+        current_group = None
+        for index in order:
+            group_index = group_column[index]
+            if group_index != current_group:
+                current_group = group_index
+                key = groups[group_index][0]
+                selections.append(Selection(key, flat_items[index], []))
+            else:
+                selections[-1].slaves.append(flat_items[index])
+        return selections
+
+    def load_features(self, items):
+        names = {name for name, _ in self.chain} | set(self.extra_features)
+        ids = [item.id for item in items]
+
+        if 'date_create' in names:
+            self.values['date_create'] = {item.id: _timestamp(item.date_create) for item in items}
+        if 'leading_space' in names:
+            self.values['leading_space'] = {
+                item.id: int(bool(item.article) and item.article.startswith(' ')) for item in items
+            }
+        if 'unspaced_recency' in names:
+            # Товары с пробелом равны между собой (решает порядок в группе),
+            # остальные сравниваются по дате создания
+            self.values['unspaced_recency'] = {
+                item.id: 0 if item.article and item.article.startswith(' ') else _timestamp(item.date_create)
+                for item in items
+            }
+        if 'url_clean' in names:
+            self.values['url_clean'] = {item.id: int(_is_clean_url(item.url)) for item in items}
+        if 'clean_url_recency' in names:
+            # Среди "чистых" выигрывает самый новый, среди остальных - самый старый
+            self.values['clean_url_recency'] = {
+                item.id: _timestamp(item.date_create) if _is_clean_url(item.url) else -_timestamp(item.date_create)
+                for item in items
+            }
+        if 'latest_info_date' in names:
+            latest = self.aggregate(ItemInfo, ids, Max('analyzed_at'))
+            self.values['latest_info_date'] = {
+                item.id: _timestamp(latest.get(item.id) or item.date_create) for item in items
+            }
+            # Исходные даты для отчетов
+            self.values['latest_info_datetime'] = {
+                item.id: latest.get(item.id) or item.date_create for item in items
+            }
+        if 'history_count' in names:
+            counts = self.aggregate(ItemInfoHistory, ids, Count('id'))
+            self.values['history_count'] = {item.id: counts.get(item.id, 0) for item in items}
+
+    def value(self, name, item):
+        return self.values[name][item.id]
+
+    def aggregate(self, model, ids, expression):
+        """{item_id: агрегат} групповыми запросами по чанкам ID."""
+        result = {}
+        if self.batcher:
+            chunks = self.batcher.batches(ids)
+        else:
+            chunks = (ids[i:i + self.chunk_size] for i in range(0, len(ids), self.chunk_size))
+        for chunk in chunks:
+            rows = model.objects.using(self.using).filter(
+                item_id__in=chunk,
+            ).values('item_id').annotate(value=expression).values_list('item_id', 'value')
+            result.update(rows)
+        return result
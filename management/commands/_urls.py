@@ -0,0 +1,237 @@
+"""
+Канонический URL товара и индекс по нему.
+
+Один и тот же товар конкурента часто заведен несколько раз под вариантами
+одного адреса: http/https, www, регистр домена, слеш в конце, метки
+utm_*/yclid и т.п., другой порядок параметров. canonical_url() сводит такие
+варианты к одной строке, а md5 от нее хранится в служебной таблице
+item_canonical_url с индексом (competitor_id, url_hash). Тогда группы
+"один товар - разные URL" находятся индексным GROUP BY, без загрузки всех
+товаров в Python.
+
+Таблица не управляется миграциями: создается командой backfill_canonical_urls
+(CREATE TABLE IF NOT EXISTS) и при удалении товаров чистится внешним ключом
+ON DELETE CASCADE.
+"""
+import hashlib
+import uuid
+from urllib.parse import parse_qsl, quote, unquote, urlencode, urlsplit
+
+from django.db import connections, transaction
+from django.db.models import Max, Min
+from kenny.items.models import Item
+
+from ._db import copy_rows
+
+CANONICAL_TABLE = 'item_canonical_url'
+STAGING_TABLE = 'item_canonical_url_staging'
+
+# Параметры, которые не меняют товар: метки рекламных систем и аналитики
+TRACKING_PARAMS = frozenset({
+    'gclid', 'dclid', 'fbclid', 'yclid', 'ymclid', 'msclkid', 'ttclid',
+    '_openstat', 'openstat', 'roistat', 'rs', 'from', 'ref', 'referrer',
+    'frommarket', 'admitad_uid', 'erid', 'etext', 'clid', 'mc_cid', 'mc_eid',
+})
+TRACKING_PREFIXES = ('utm_', 'pm_', 'roistat_')
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Символы пути, которые не перекодируются (RFC 3986 unreserved + sub-delims)
+PATH_SAFE = "/:@!$&'()*+,;=-._~"
+
+
+def is_tracking_param(name):
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+def canonical_url(url):
+    """Каноническая форма URL для сравнения товаров.
+
+    Схема отбрасывается, домен - в нижнем регистре без www и порта по
+    умолчанию, путь без слеша в конце и с единообразным percent-encoding,
+    метки отслеживания удаляются, остальные параметры сортируются, фрагмент
+    отбрасывается. Путь остается чувствительным к регистру.
+    """
+    url = (url or '').strip()
+    if not url:
+        return ''
+    # Закодированный '?' встречается в ссылках из каталогов и значит то же, что '?'
+    if '?' not in url:
+        lowered = url.lower()
+        position = lowered.find('%3f')
+        if position != -1:
+            url = f'{url[:position]}?{url[position + 3:]}'
+    if '://' not in url and not url.startswith('//'):
+        url = f'//{url}'
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').rstrip('.')
+    if host.startswith('www.'):
+        host = host[4:]
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{port}'
+
+    path = quote(unquote(parts.path), safe=PATH_SAFE).rstrip('/') or '/'
+
+    params = [
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not is_tracking_param(name)
+    ]
+    query = urlencode(sorted(params))
+    return f'{host}{path}?{query}' if query else f'{host}{path}'
+
+
+def _md5_uuid(text):
+    # То же, что md5(text)::uuid в PostgreSQL (при кодировке БД UTF8)
+    return str(uuid.UUID(hashlib.md5(text.encode('utf-8')).hexdigest()))
+
+
+def url_hash(url):
+    """md5 канонического URL как UUID - 16 байт в индексе вместо строки."""
+    return _md5_uuid(canonical_url(url))
+
+
+def _item_columns(connection):
+    qn = connection.ops.quote_name
+    meta = Item._meta
+    return (
+        qn(meta.db_table),
+        qn(meta.pk.column),
+        qn(meta.get_field('competitor').column),
+        qn(meta.get_field('url').column),
+    )
+
+
+def ensure_table(using='default'):
+    """Создать таблицу канонических URL и индекс, если их еще нет."""
+    connection = connections[using]
+    item_table, item_pk, _, _ = _item_columns(connection)
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {CANONICAL_TABLE} (
+                item_id bigint PRIMARY KEY REFERENCES {item_table} ({item_pk}) ON DELETE CASCADE,
+                competitor_id bigint NOT NULL,
+                url_hash uuid NOT NULL,
+                source_md5 uuid NOT NULL,
+                canonical_url text NOT NULL
+            )
+        """)
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS {CANONICAL_TABLE}_competitor_hash
+            ON {CANONICAL_TABLE} (competitor_id, url_hash)
+        """)
+
+
+def stale_items_sql(connection):
+    """SELECT товаров конкурента (%s) в диапазоне ID [%s, %s), у которых нет
+    канонического URL или исходный URL изменился после расчета."""
+    item_table, item_pk, competitor_col, url_col = _item_columns(connection)
+    return f"""
+        SELECT i.{item_pk}, i.{url_col}
+        FROM {item_table} i
+        LEFT JOIN {CANONICAL_TABLE} c ON c.item_id = i.{item_pk}
+        WHERE i.{competitor_col} = %s AND i.{item_pk} >= %s AND i.{item_pk} < %s
+          AND (c.item_id IS NULL OR c.source_md5 <> md5(coalesce(i.{url_col}, ''))::uuid)
+    """
+
+
+def backfill_chunk(competitor_id, lo, hi, using='default'):
+    """Посчитать канонические URL для товаров с ID в [lo, hi). Возвращает
+    количество записанных строк. Вызывать внутри транзакции."""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute(stale_items_sql(connection), [competitor_id, lo, hi])
+        rows = [
+            (item_id, competitor_id, url_hash(url), _md5_uuid(url or ''), canonical_url(url))
+            for item_id, url in cursor.fetchall()
+        ]
+        if not rows:
+            return 0
+
+        cursor.execute(f"""
+            CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE}
+            (LIKE {CANONICAL_TABLE}) ON COMMIT DELETE ROWS
+        """)
+        columns = ['item_id', 'competitor_id', 'url_hash', 'source_md5', 'canonical_url']
+        copy_rows(cursor, STAGING_TABLE, columns, rows)
+        cursor.execute(f"""
+            INSERT INTO {CANONICAL_TABLE} ({', '.join(columns)})
+            SELECT {', '.join(columns)} FROM {STAGING_TABLE}
+            ON CONFLICT (item_id) DO UPDATE SET
+                url_hash = EXCLUDED.url_hash,
+                source_md5 = EXCLUDED.source_md5,
+                canonical_url = EXCLUDED.canonical_url
+        """)
+        return cursor.rowcount
+
+
+def id_bounds(competitor_id, using='default'):
+    """(минимальный, максимальный) ID товаров конкурента или None."""
+    bounds = Item.objects.using(using).filter(competitor_id=competitor_id).aggregate(
+        min_id=Min('id'), max_id=Max('id'),
+    )
+    if bounds['min_id'] is None:
+        return None
+    return bounds['min_id'], bounds['max_id']
+
+
+def backfill(competitor_id, chunk_size=10000, using='default', progress=None):
+    """Заполнить таблицу для всех товаров конкурента диапазонами ID по chunk_size.
+
+    Каждый диапазон - отдельная короткая транзакция. Уже посчитанные строки с
+    неизменным URL пропускаются, поэтому повторный запуск дешевый.
+    """
+    ensure_table(using)
+    bounds = id_bounds(competitor_id, using)
+    if bounds is None:
+        return 0
+
+    written = 0
+    for lo in range(bounds[0], bounds[1] + 1, chunk_size):
+        with transaction.atomic(using=using):
+            written += backfill_chunk(competitor_id, lo, lo + chunk_size, using)
+        if progress is not None:
+            progress.update(1, Записано=written)
+    return written
+
+
+def coverage(competitor_id, using='default'):
+    """(товаров конкурента, из них с актуальным каноническим URL)."""
+    connection = connections[using]
+    item_table, item_pk, competitor_col, url_col = _item_columns(connection)
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT count(*),
+                   count(c.item_id) FILTER (WHERE c.source_md5 = md5(coalesce(i.{url_col}, ''))::uuid)
+            FROM {item_table} i
+            LEFT JOIN {CANONICAL_TABLE} c ON c.item_id = i.{item_pk}
+            WHERE i.{competitor_col} = %s
+        """, [competitor_id])
+        return cursor.fetchone()
+
+
+def duplicate_url_groups(competitor_id, using='default'):
+    """[(канонический URL, [ID товаров по возрастанию])] для групп из 2+ товаров.
+
+    Учитываются только актуальные строки индекса: если URL товара изменился
+    после расчета, его старый канонический URL не попадает в группу.
+    """
+    connection = connections[using]
+    item_table, item_pk, competitor_col, url_col = _item_columns(connection)
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT min(c.canonical_url), array_agg(c.item_id ORDER BY c.item_id)
+            FROM {CANONICAL_TABLE} c
+            JOIN {item_table} i ON i.{item_pk} = c.item_id
+            WHERE c.competitor_id = %s AND i.{competitor_col} = %s
+              AND c.source_md5 = md5(coalesce(i.{url_col}, ''))::uuid
+            GROUP BY c.url_hash
+            HAVING count(*) > 1
+        """, [competitor_id, competitor_id])
+        return cursor.fetchall()
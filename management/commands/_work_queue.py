@@ -0,0 +1,230 @@
+"""
+Очередь задач дедупликации для воркеров на нескольких хостах.
+
+dedupe_enqueue делит работу по конкурентам на чанки и кладет их в таблицу
+dedupe_work_queue одной партией (batch_id):
+- normalize - нормализация артикулов товаров с ID в [lo, hi);
+- dedupe    - remove_duplicate_items для части lo из hi по хешу ключа
+              артикула (группа дубликатов целиком в одной части);
+- merge     - dedupe_plan + dedupe_apply для такой же части.
+Виды работы выполняются стадиями: чанк берется, только когда все чанки
+предыдущих стадий того же конкурента и партии выполнены (нормализация до
+поиска дубликатов).
+
+dedupe_worker забирает чанки через SELECT ... FOR UPDATE SKIP LOCKED - каждый
+чанк получает ровно один воркер без блокировок между воркерами. Пока чанк
+выполняется, отдельный поток обновляет heartbeat_at; чанк, у которого
+heartbeat устарел (воркер упал или потерял сеть), любой воркер возвращает
+в очередь, а после max_attempts попыток помечает как failed. Обработчики
+идемпотентны, поэтому повторное выполнение чанка безопасно.
+"""
+import json
+import os
+import socket
+import threading
+import uuid
+from collections import namedtuple
+
+from django.db import connections
+
+QUEUE_TABLE = 'dedupe_work_queue'
+
+KINDS = ('normalize', 'dedupe', 'merge')
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+Chunk = namedtuple('Chunk', ['id', 'batch_id', 'kind', 'competitor_id', 'lo', 'hi', 'params', 'attempts'])
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def ensure_queue_table(using='default'):
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {QUEUE_TABLE} (
+                id bigserial PRIMARY KEY,
+                batch_id uuid NOT NULL,
+                stage integer NOT NULL DEFAULT 0,
+                kind text NOT NULL,
+                competitor_id bigint NOT NULL,
+                lo bigint NOT NULL,
+                hi bigint NOT NULL,
+                params jsonb NOT NULL DEFAULT '{{}}',
+                status text NOT NULL DEFAULT '{PENDING}',
+                attempts integer NOT NULL DEFAULT 0,
+                worker text,
+                created_at timestamptz NOT NULL DEFAULT now(),
+                claimed_at timestamptz,
+                heartbeat_at timestamptz,
+                finished_at timestamptz,
+                result jsonb,
+                error text
+            )
+        """)
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS {QUEUE_TABLE}_pending_idx
+            ON {QUEUE_TABLE} (batch_id, competitor_id, stage, id) WHERE status <> '{DONE}'
+        """)
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS {QUEUE_TABLE}_claimed_idx
+            ON {QUEUE_TABLE} (heartbeat_at) WHERE status = '{CLAIMED}'
+        """)
+
+
+def enqueue(chunks, using='default'):
+    """chunks - iterable (stage, kind, competitor_id, lo, hi, params).
+    Возвращает (batch_id, количество чанков)."""
+    ensure_queue_table(using)
+    batch_id = str(uuid.uuid4())
+    rows = [(batch_id, stage, kind, competitor_id, lo, hi, json.dumps(params or {}))
+            for stage, kind, competitor_id, lo, hi, params in chunks]
+    with connections[using].cursor() as cursor:
+        cursor.executemany(f"""
+            INSERT INTO {QUEUE_TABLE} (batch_id, stage, kind, competitor_id, lo, hi, params)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, rows)
+    return batch_id, len(rows)
+
+
+def reclaim_stale(stale_after, max_attempts, using='default'):
+    """Возвращает в очередь чанки с устаревшим heartbeat (после max_attempts
+    попыток - failed). Возвращает (возвращено, помечено failed)."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"""
+            WITH stale AS (
+                SELECT id FROM {QUEUE_TABLE}
+                WHERE status = '{CLAIMED}' AND heartbeat_at < now() - make_interval(secs => %s)
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE {QUEUE_TABLE} q SET
+                status = CASE WHEN q.attempts >= %s THEN '{FAILED}' ELSE '{PENDING}' END,
+                error = concat_ws(E'\\n', q.error, 'heartbeat lost: ' || q.worker),
+                worker = NULL
+            FROM stale WHERE q.id = stale.id
+            RETURNING q.status
+        """, [stale_after, max_attempts])
+        statuses = [row[0] for row in cursor.fetchall()]
+    return statuses.count(PENDING), statuses.count(FAILED)
+
+
+def claim(worker, kinds=KINDS, batch_id=None, using='default'):
+    """Забирает следующий доступный чанк или возвращает None."""
+    batch_sql = 'AND q.batch_id = %s' if batch_id else ''
+    params = [list(kinds)] + ([batch_id] if batch_id else []) + [worker]
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"""
+            WITH next AS (
+                SELECT q.id FROM {QUEUE_TABLE} q
+                WHERE q.status = '{PENDING}' AND q.kind = ANY(%s) {batch_sql}
+                  AND NOT EXISTS (
+                      SELECT 1 FROM {QUEUE_TABLE} p
+                      WHERE p.batch_id = q.batch_id AND p.competitor_id = q.competitor_id
+                        AND p.stage < q.stage AND p.status <> '{DONE}'
+                  )
+                ORDER BY q.id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE {QUEUE_TABLE} q SET
+                status = '{CLAIMED}', worker = %s, attempts = q.attempts + 1,
+                claimed_at = now(), heartbeat_at = now()
+            FROM next WHERE q.id = next.id
+            RETURNING q.id, q.batch_id, q.kind, q.competitor_id, q.lo, q.hi, q.params, q.attempts
+        """, params)
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    chunk = Chunk(*row)
+    if isinstance(chunk.params, str):
+        chunk = chunk._replace(params=json.loads(chunk.params))
+    return chunk._replace(batch_id=str(chunk.batch_id))
+
+
+def heartbeat(chunk_id, worker, using='default'):
+    """False - чанк у воркера уже забрали (heartbeat опоздал)."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE {QUEUE_TABLE} SET heartbeat_at = now()
+            WHERE id = %s AND worker = %s AND status = '{CLAIMED}'
+        """, [chunk_id, worker])
+        return cursor.rowcount == 1
+
+
+def finish(chunk_id, worker, result=None, error=None, max_attempts=None, using='default'):
+    """Завершает чанк: done с результатом или, при ошибке, снова pending
+    (failed после max_attempts). False - чанк уже переназначен другому воркеру."""
+    if error is None:
+        status_sql, params = f"'{DONE}'", []
+    else:
+        status_sql, params = f"CASE WHEN attempts >= %s THEN '{FAILED}' ELSE '{PENDING}' END", [max_attempts or 1]
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE {QUEUE_TABLE} SET
+                status = {status_sql},
+                finished_at = CASE WHEN %s THEN now() END,
+                result = %s, error = concat_ws(E'\\n', error, %s),
+                worker = CASE WHEN %s THEN worker END
+            WHERE id = %s AND worker = %s AND status = '{CLAIMED}'
+        """, params + [error is None, json.dumps(result) if result is not None else None, error,
+                       error is None, chunk_id, worker])
+        return cursor.rowcount == 1
+
+
+def batch_status(batch_id=None, using='default'):
+    """[(batch_id, stage, kind, status, чанков, попыток)] по партиям."""
+    ensure_queue_table(using)
+    where = 'WHERE batch_id = %s' if batch_id else ''
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"""
+            SELECT batch_id, stage, kind, status, count(*), sum(attempts)
+            FROM {QUEUE_TABLE} {where}
+            GROUP BY batch_id, stage, kind, status
+            ORDER BY min(created_at) DESC, batch_id, stage, status
+        """, [batch_id] if batch_id else [])
+        return cursor.fetchall()
+
+
+def requeue_failed(batch_id, using='default'):
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE {QUEUE_TABLE} SET status = '{PENDING}', attempts = 0
+            WHERE batch_id = %s AND status = '{FAILED}'
+        """, [batch_id])
+        return cursor.rowcount
+
+
+class Heartbeat:
+    """Поток, обновляющий heartbeat_at чанка каждые interval секунд.
+    lost - чанк переназначен (воркер слишком долго не отвечал)."""
+
+    def __init__(self, chunk_id, worker, interval, using='default'):
+        self.chunk_id = chunk_id
+        self.worker = worker
+        self.interval = interval
+        self.using = using
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'heartbeat-{chunk_id}', daemon=True)
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                if not heartbeat(self.chunk_id, self.worker, self.using):
+                    self.lost = True
+                    return
+        finally:
+            # У потока свое соединение - закрываем, чтобы не копились
+            connections[self.using].close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
@@ -2,8 +2,9 @@
 Скрипт нормализации артикулов товаров конкурента.
 
 НАЗНАЧЕНИЕ:
-- Нормализует артикулы товаров указанного конкурента путем удаления пробелов
-  в начале и конце артикулов
+- Нормализует артикулы товаров указанного конкурента: убирает пробелы по
+  краям, неразрывные и невидимые символы, полноширинные цифры и буквы,
+  повторные пробелы внутри артикула (см. _normalize)
 - Создает детальный лог выполнения операции
 - Оптимизирован для работы с большими объемами данных
 
@@ -17,19 +18,20 @@
 
 АЛГОРИТМ РАБОТЫ:
 1. Поиск конкурента по ID
-2. Поиск товаров с пробелами в начале или конце артикула
-3. Нормализация артикулов (удаление пробелов по краям)
+2. Поиск товаров, у которых артикул отличается от очищенного
+3. Нормализация артикулов (ArticleNormalizer.clean)
 4. Пакетное обновление записей в базе данных
 5. Создание детального лога выполнения
 
 КРИТЕРИИ ОБРАБОТКИ:
-- Обрабатываются только товары с пробелами в начале или конце артикула
-- Артикулы без пробелов не изменяются
-- Нормализация: article.strip() - удаление пробелов с обеих сторон
+- Обрабатываются только товары с ненормализованным артикулом
+- Нормализованные артикулы не изменяются
+- Нормализация: ArticleNormalizer.clean() в Python или то же выражение в SQL
+  (--server-side); регистр артикула сохраняется
 
 ОСОБЕННОСТИ РЕАЛИЗАЦИИ:
 - Пакетная обработка данных (batch processing) для оптимизации производительности
-- Прогресс-бар с расчетом оставшегося времени
+- Прогресс с расчетом оставшегося времени и метриками Prometheus (_progress)
 - Запись подробных логов в файл
 - Экономия памяти через использование iterator()
 - Загрузка только необходимых полей (id, article)
@@ -37,6 +39,19 @@
 ПАРАМЕТРЫ ЗАПУСКА:
 --batch-size : Размер пакета для обновления (по умолчанию: 1000)
                Рекомендуемые значения: 1000-5000 в зависимости от нагрузки на БД
+--server-side: Нормализация UPDATE-запросами на стороне БД, без загрузки
+               товаров в Python (диапазонами по --chunk-size ID)
+--target-latency: Целевое время одного батча/диапазона: размер подстраивается
+               под него, а при ожиданиях блокировок и отставании реплик
+               уменьшается вдвое (0 - фиксированный размер, см. _batching)
+--lock-timeout / --statement-timeout / --retries : Таймауты одного батча
+               (диапазона); после --retries повторов батч делится пополам,
+               неудавшиеся батчи пишутся в --failed-batches (JSONL), остальные
+               обновляются (см. _guarded)
+               Снимки изменяемых строк пишутся в журнал запуска: отмена -
+               undo_run --run <run_id> (см. _journal)
+--benchmark  : Скорость нормализации в Python и SQL на выборке товаров
+               (--benchmark-rows) и сверка результатов, без изменения данных
 
 ЛОГИРОВАНИЕ:
 - Автоматическое создание файла лога с timestamp в названии
@@ -46,7 +61,7 @@
 
 МЕРЫ ПРЕДОСТОРОЖНОСТИ:
 - Работает только с указанным конкурентом
-- Не затрагивает артикулы без пробелов
+- Не затрагивает уже нормализованные артикулы
 - Создает backup в виде лог-файла
 - Предоставляет возможность предварительного подсчета товаров
 
@@ -76,22 +91,57 @@ import os
 import time
 from datetime import datetime
 from django.core.management.base import BaseCommand
-from django.db.models import Q
+from django.db import connection
+from django.db.models import BooleanField, Max, Min
+from django.db.models.expressions import RawSQL
 from django.conf import settings
 from kenny.items.models import Competitor, Item
 
+from ._batching import DEFAULT_TARGET_SECONDS, AdaptiveBatcher
+from ._guarded import (
+    DEFAULT_LOCK_TIMEOUT, DEFAULT_RETRIES, DEFAULT_STATEMENT_TIMEOUT, GuardedBatches, split_id_range,
+)
+from ._journal import UPDATE, Journal
+from ._normalize import normalize_id_range, normalizer_for
+from ._progress import ProgressReporter
+
 
 class Command(BaseCommand):
-    help = 'Нормализует артикулы (убирает пробелы) у товаров указанного конкурента только если артикул не нормализован'
+    help = 'Нормализует артикулы (пробелы, невидимые и полноширинные символы) у товаров указанного конкурента только если артикул не нормализован'
 
     def add_arguments(self, parser):
         parser.add_argument('competitor_id', type=int, help='ID конкурента')
         parser.add_argument('--batch-size', type=int, default=1000,
-                            help='Размер батча для обновления (по умолчанию: 1000)')
+                            help='Начальный размер батча для обновления (по умолчанию: 1000)')
+        parser.add_argument('--server-side', action='store_true',
+                            help='Нормализовать на стороне БД UPDATE-запросами по диапазонам ID')
+        parser.add_argument('--chunk-size', type=int, default=50000,
+                            help='Начальный размер диапазона ID для --server-side (по умолчанию: 50000)')
+        parser.add_argument('--target-latency', type=float, default=DEFAULT_TARGET_SECONDS,
+                            help='Целевое время одной пачки, секунд: размер пачки подстраивается под него '
+                                 f'и нагрузку на БД; 0 - фиксированный размер (по умолчанию: {DEFAULT_TARGET_SECONDS})')
+        parser.add_argument('--lock-timeout', type=float, default=DEFAULT_LOCK_TIMEOUT,
+                            help=f'lock_timeout батча, секунд (по умолчанию: {DEFAULT_LOCK_TIMEOUT:g})')
+        parser.add_argument('--statement-timeout', type=float, default=DEFAULT_STATEMENT_TIMEOUT,
+                            help=f'statement_timeout батча, секунд (по умолчанию: {DEFAULT_STATEMENT_TIMEOUT:g})')
+        parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                            help=f'Повторов батча после таймаута до его разбиения (по умолчанию: {DEFAULT_RETRIES})')
+        parser.add_argument('--failed-batches', type=str, metavar='FILE',
+                            help='JSONL-файл для неудавшихся батчей (по умолчанию: '
+                                 'failed_batches_article_normalization_<ID>_<время>.jsonl в корне проекта)')
+        parser.add_argument('--benchmark', action='store_true',
+                            help='Сравнить скорость нормализации в Python и в SQL без изменения данных')
+        parser.add_argument('--benchmark-rows', type=int, default=100000,
+                            help='Размер выборки для --benchmark (по умолчанию: 100000)')
 
     def handle(self, *args, **options):
         competitor_id = options['competitor_id']
         batch_size = options['batch_size']
+        server_side = options['server_side']
+        chunk_size = options['chunk_size']
+        target_latency = options['target_latency']
+        benchmark = options['benchmark']
+        benchmark_rows = options['benchmark_rows']
 
         # Создаем автоматическое имя файла с временем
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -132,86 +182,99 @@ class Command(BaseCommand):
                 write_output(self.style.ERROR(f'Конкурент с ID {competitor_id} не найден'))
                 return
 
-            # Используем только для подсчета - более быстрый запрос
+            normalizer = normalizer_for(competitor.id)
+            write_output(f'Правила нормализации: {normalizer.rules}')
+
+            if benchmark:
+                self.run_benchmark(competitor, normalizer, benchmark_rows, write_output)
+                return
+
+            # Товары, у которых артикул отличается от очищенного. Условие
+            # считается в БД тем же выражением, что и серверное обновление
+            items_to_fix = Item.objects.filter(competitor=competitor).filter(self.needs_cleaning(normalizer))
+
             write_output('Подсчет товаров для нормализации...')
-            total_to_fix = Item.objects.filter(
-                competitor=competitor,
-            ).filter(
-                Q(article__startswith=' ') | Q(article__endswith=' '),
-            ).count()
+            total_to_fix = items_to_fix.count()
 
-            write_output(f'Товаров с пробелами в артикулах для нормализации: {total_to_fix}')
+            write_output(f'Товаров с ненормализованными артикулами: {total_to_fix}')
 
             if total_to_fix == 0:
                 write_output(self.style.SUCCESS('Нет товаров для нормализации'))
                 return
 
-            # Основной цикл обработки с батчами
-            updated_count = 0
-            processed_count = 0
-            batch_items = []
-            last_progress_time = time.time()
-
-            # Используем iterator() для экономии памяти
-            items_queryset = Item.objects.filter(
-                competitor=competitor,
-            ).filter(
-                Q(article__startswith=' ') | Q(article__endswith=' '),
-            ).only('id', 'article')  # Загружаем только необходимые поля
-
-            write_output(f'Начинаем обработку батчами по {batch_size} записей...')
-
-            for item in items_queryset.iterator(chunk_size=1000):
-                normalized_article = item.article.strip()
-                if item.article != normalized_article:
-                    item.article = normalized_article
-                    batch_items.append(item)
-                    updated_count += 1
-
-                processed_count += 1
-
-                # Выводим прогресс каждые 1000 записей или каждые 30 секунд
-                current_time = time.time()
-                if (processed_count % 1000 == 0 or
-                        current_time - last_progress_time >= 30 or
-                        processed_count == total_to_fix):
-
-                    progress_percent = (processed_count / total_to_fix) * 100
-                    elapsed_time = current_time - start_time
-
-                    # Расчет оставшегося времени
-                    if processed_count > 0:
-                        items_per_second = processed_count / elapsed_time
-                        remaining_items = total_to_fix - processed_count
-                        if items_per_second > 0:
-                            remaining_time = remaining_items / items_per_second
-                            time_str = f"{remaining_time:.1f} сек"
-                            if remaining_time > 60:
-                                time_str = f"{remaining_time / 60:.1f} мин"
-                        else:
-                            time_str = "расчет..."
-                    else:
-                        time_str = "расчет..."
-
-                    write_output(
-                        f'Прогресс: {processed_count}/{total_to_fix} '
-                        f'({progress_percent:.1f}%) | '
-                        f'Обновлено: {updated_count} | '
-                        f'Прошло: {elapsed_time:.1f} сек | '
-                        f'Осталось: {time_str}'
-                    )
-                    last_progress_time = current_time
-
-                # Обновляем батч
-                if len(batch_items) >= batch_size:
-                    Item.objects.bulk_update(batch_items, ['article'])
-                    write_output(f'Батч обновлен: {len(batch_items)} записей')
-                    batch_items = []
-
-            # Обновляем оставшиеся записи
-            if batch_items:
-                Item.objects.bulk_update(batch_items, ['article'])
-                write_output(f'Финальный батч обновлен: {len(batch_items)} записей')
+            # Каждый батч - своя транзакция с lock_timeout/statement_timeout: при
+            # таймауте повтор, затем разбиение, неудачные батчи - в файл (_guarded)
+            guard = GuardedBatches('article_normalization', options['lock_timeout'], options['statement_timeout'],
+                                   options['retries'], write=write_output,
+                                   failed_file=options['failed_batches'] or os.path.join(
+                                       settings.BASE_DIR,
+                                       f'failed_batches_article_normalization_{competitor_id}_{timestamp}.jsonl'))
+
+            # Снимки строк до изменения - в той же транзакции, что и батч
+            journal = Journal('article_normalization', competitor.id)
+            write_output(f'Журнал запуска: {journal.run_id}')
+
+            if server_side:
+                write_output(f'Обновление на стороне БД диапазонами от {chunk_size} ID товаров...')
+                batcher = AdaptiveBatcher(chunk_size, target_latency, max_size=max(chunk_size, 1000000),
+                                          write=write_output, label='диапазон ID', models=[Item])
+                updated_count = self.normalize_server_side(competitor, batcher, guard, journal, total_to_fix,
+                                                           write_output)
+                processed_count = updated_count
+            else:
+                # Основной цикл обработки с батчами
+                updated_count = 0
+                processed_count = 0
+                batch_items = []
+                progress = ProgressReporter(write_output, 'article_normalization', total=total_to_fix,
+                                            labels={'competitor': competitor.id})
+
+                # Используем iterator() для экономии памяти
+                items_queryset = items_to_fix.only('id', 'article')  # Загружаем только необходимые поля
+
+                write_output(f'Начинаем обработку батчами от {batch_size} записей...')
+                # Размер батча подстраивается под --target-latency и нагрузку на БД (_batching)
+                batcher = AdaptiveBatcher(batch_size, target_latency, write=write_output, label='батч',
+                                          models=[Item])
+
+                def update_batch(items):
+                    journal.capture_ids(UPDATE, Item, [item.id for item in items])
+                    Item.objects.bulk_update(items, ['article'])
+                    return len(items)
+
+                def describe_batch(items):
+                    return [{'id': item.id, 'article': item.article} for item in items]
+
+                for item in items_queryset.iterator(chunk_size=1000):
+                    normalized_article = normalizer.clean(item.article)
+                    if item.article != normalized_article:
+                        item.article = normalized_article
+                        batch_items.append(item)
+                        updated_count += 1
+
+                    processed_count += 1
+
+                    progress.update(1, Обновлено=updated_count)
+
+                    # Обновляем батч
+                    if len(batch_items) >= batcher.size:
+                        with batcher.measure(len(batch_items)):
+                            outcome = guard.run(batch_items, update_batch, describe=describe_batch)
+                        if outcome.timeouts:
+                            batcher.shrink(f'таймаутов батча: {outcome.timeouts}')
+                        updated_count -= len(batch_items) - sum(outcome.results)
+                        write_output(f'Батч обновлен: {sum(outcome.results)} записей')
+                        batch_items = []
+
+                # Обновляем оставшиеся записи
+                if batch_items:
+                    outcome = guard.run(batch_items, update_batch, describe=describe_batch)
+                    updated_count -= len(batch_items) - sum(outcome.results)
+                    write_output(f'Финальный батч обновлен: {sum(outcome.results)} записей')
+                progress.finish()
+                batcher.finish()
+            guard.finish()
+            journal.finish()
 
             end_time = time.time()
             execution_time = end_time - start_time
@@ -223,10 +286,13 @@ class Command(BaseCommand):
             write_output(f'Товаров без изменений: {processed_count - updated_count}')
             if processed_count > 0:
                 write_output(f'Процент изменений: {(updated_count / processed_count) * 100:.1f}%')
+            if guard.failed:
+                write_output(self.style.WARNING(f'Не выполнено батчей: {guard.failed} (см. {guard.failed_file})'))
             write_output(f'Общее время выполнения: {execution_time:.2f} секунд')
             if processed_count > 0:
                 write_output(f'Скорость обработки: {processed_count / execution_time:.1f} записей/сек')
             write_output(f'Время окончания: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+            write_output(f'Отменить нормализацию: python manage.py undo_run --run {journal.run_id}')
             write_output(self.style.SUCCESS('=== ПРОЦЕДУРА НОРМАЛИЗАЦИИ ЗАВЕРШЕНА ==='))
 
         finally:
@@ -234,6 +300,95 @@ class Command(BaseCommand):
             log_file.close()
             self.stdout.write(f'Логи сохранены в файл: {log_file_path}')
 
+    def needs_cleaning(self, normalizer):
+        """Условие фильтра: артикул отличается от очищенного (NULL не трогаем)."""
+        article_col = connection.ops.quote_name(Item._meta.get_field('article').column)
+        sql, params = normalizer.clean_sql(article_col)
+        return RawSQL(f'{article_col} <> {sql}', params, output_field=BooleanField())
+
+    def normalize_server_side(self, competitor, batcher, guard, journal, total, write_output):
+        """UPDATE ... SET article = <выражение> по диапазонам ID, каждый в своей
+        транзакции под guard (при таймаутах диапазон делится пополам) и с
+        записью снимков в journal тем же запросом.
+        Ширина диапазона - batcher.size (подстраивается под время UPDATE)."""
+        bounds = Item.objects.filter(competitor=competitor).aggregate(min_id=Min('id'), max_id=Max('id'))
+        progress = ProgressReporter(write_output, 'article_normalization', total=total,
+                                    labels={'competitor': competitor.id, 'mode': 'server_side'})
+        updated = 0
+        lo = bounds['min_id']
+        while lo <= bounds['max_id']:
+            hi = lo + batcher.size
+            with batcher.measure(hi - lo):
+                outcome = guard.run((lo, hi), lambda bounds: normalize_id_range(competitor.id, *bounds, journal=journal),
+                                    split=split_id_range, describe=lambda bounds: {'lo': bounds[0], 'hi': bounds[1]})
+            if outcome.timeouts:
+                batcher.shrink(f'таймаутов диапазона: {outcome.timeouts}')
+            rowcount = sum(outcome.results)
+            updated += rowcount
+            progress.update(rowcount)
+            lo = hi
+        progress.finish()
+        batcher.finish()
+        return updated
+
+    def run_benchmark(self, competitor, normalizer, rows, write_output):
+        """Скорость key() в Python и того же выражения в SQL на выборке товаров
+        конкурента, плюс сверка результатов обоих путей."""
+        qn = connection.ops.quote_name
+        meta = Item._meta
+        sample_sql = (
+            f'SELECT {qn(meta.pk.column)} AS id, {qn(meta.get_field("article").column)} AS a '
+            f'FROM {qn(meta.db_table)} WHERE {qn(meta.get_field("competitor").column)} = %s '
+            f'ORDER BY {qn(meta.pk.column)} LIMIT %s'
+        )
+        sample_params = [competitor.id, rows]
+        key_sql, key_params = normalizer.key_sql('s.a')
+
+        write_output(f'=== БЕНЧМАРК НОРМАЛИЗАЦИИ (выборка до {rows} товаров) ===')
+        with connection.cursor() as cursor:
+            started = time.perf_counter()
+            cursor.execute(sample_sql, sample_params)
+            sample = cursor.fetchall()
+            fetch_time = time.perf_counter() - started
+            if not sample:
+                write_output('У конкурента нет товаров')
+                return
+
+            started = time.perf_counter()
+            python_keys = {item_id: normalizer.key(article) for item_id, article in sample}
+            python_time = time.perf_counter() - started
+
+            # count(DISTINCT) заставляет вычислить выражение для каждой строки;
+            # время чтения выборки без нормализации вычитается
+            started = time.perf_counter()
+            cursor.execute(f'SELECT count(DISTINCT s.a) FROM ({sample_sql}) s', sample_params)
+            cursor.fetchone()
+            scan_time = time.perf_counter() - started
+
+            started = time.perf_counter()
+            cursor.execute(f'SELECT count(DISTINCT {key_sql}) FROM ({sample_sql}) s', key_params + sample_params)
+            cursor.fetchone()
+            sql_time = time.perf_counter() - started
+
+            cursor.execute(f'SELECT s.id, {key_sql} FROM ({sample_sql}) s', key_params + sample_params)
+            mismatches = [(item_id, python_keys.get(item_id), key) for item_id, key in cursor.fetchall()
+                          if python_keys.get(item_id) != key]
+
+        count = len(sample)
+        sql_normalize_time = max(sql_time - scan_time, 1e-9)
+        write_output(f'Строк в выборке: {count} (загрузка в Python: {fetch_time:.3f} сек)')
+        write_output(f'Python: {python_time:.3f} сек, {count / max(python_time, 1e-9):.0f} строк/сек')
+        write_output(f'SQL:    {sql_time:.3f} сек с чтением выборки ({scan_time:.3f} сек без нормализации), '
+                     f'{count / sql_normalize_time:.0f} строк/сек на нормализацию')
+        if mismatches:
+            write_output(self.style.WARNING(f'Расхождений Python и SQL: {len(mismatches)}'))
+            for item_id, python_key, sql_key in mismatches[:10]:
+                write_output(f'   ID {item_id}: Python {python_key!r}, SQL {sql_key!r}')
+        else:
+            write_output(self.style.SUCCESS('Результаты Python и SQL совпадают'))
+
 # Запустите команду:
 # python manage.py article_normalization <competitor_id> --batch-size 2000
 # python manage.py article_normalization 142 --batch-size 5000
+# python manage.py article_normalization 142 --server-side
+# python manage.py article_normalization 142 --benchmark
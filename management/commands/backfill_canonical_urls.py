@@ -0,0 +1,66 @@
+"""
+Заполнение индекса канонических URL товаров конкурента.
+
+Для каждого товара считается канонический URL (см. _urls.canonical_url) и
+md5 от него; результат пишется в таблицу item_canonical_url с индексом
+(competitor_id, url_hash). Обход идет диапазонами ID товаров по --chunk-size,
+каждый диапазон - отдельная короткая транзакция. Повторный запуск досчитывает
+только новые товары и товары, у которых изменился URL.
+
+После заполнения remove_duplicate_items_test --group-by url находит группы
+"один товар - разные URL" одним GROUP BY по индексу.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from kenny.items.models import Competitor
+
+from ._progress import ProgressReporter
+from ._urls import backfill, coverage, id_bounds
+
+
+class Command(BaseCommand):
+    help = 'Заполняет индекс канонических URL товаров конкурента'
+
+    def add_arguments(self, parser):
+        parser.add_argument('competitor_id', type=int, help='ID конкурента')
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Размер диапазона ID товаров на одну транзакцию (по умолчанию: 10000)')
+
+    def handle(self, *args, **options):
+        competitor_id = options['competitor_id']
+        chunk_size = options['chunk_size']
+
+        self.stdout.write('=== ЗАПОЛНЕНИЕ ИНДЕКСА КАНОНИЧЕСКИХ URL ===')
+
+        try:
+            competitor = Competitor.objects.get(id=competitor_id)
+            self.stdout.write(self.style.SUCCESS(f'Найден конкурент: {competitor.name} (ID: {competitor.id})'))
+        except Competitor.DoesNotExist:
+            self.stdout.write(self.style.ERROR(f'Конкурент с ID {competitor_id} не найден'))
+            return
+
+        bounds = id_bounds(competitor.id)
+        if bounds is None:
+            self.stdout.write('У конкурента нет товаров')
+            return
+
+        total_chunks = (bounds[1] - bounds[0]) // chunk_size + 1
+        self.stdout.write(f'Диапазон ID товаров: {bounds[0]}..{bounds[1]}, чанков: {total_chunks}')
+
+        start_time = time.time()
+        progress = ProgressReporter(self.stdout.write, 'backfill_canonical_urls', total=total_chunks,
+                                    unit='чанков', labels={'competitor': competitor.id})
+        written = backfill(competitor.id, chunk_size=chunk_size, progress=progress)
+        progress.finish()
+
+        total_items, indexed_items = coverage(competitor.id)
+        self.stdout.write('=== ИТОГИ ===')
+        self.stdout.write(f'Записано канонических URL: {written}')
+        self.stdout.write(f'Актуальных записей в индексе: {indexed_items}/{total_items}')
+        self.stdout.write(f'Время выполнения: {time.time() - start_time:.2f} секунд')
+        self.stdout.write(self.style.SUCCESS('=== ЗАПОЛНЕНИЕ ЗАВЕРШЕНО ==='))
+
+# Запустите команду:
+# python manage.py backfill_canonical_urls 142
+# python manage.py backfill_canonical_urls 142 --chunk-size 50000
@@ -0,0 +1,104 @@
+"""
+Сверка таблицы модели между двумя базами по контрольным суммам диапазонов ID.
+
+Вместо выгрузки таблиц целиком (как в update_not_recommend) каждая база
+считает суммы md5 строк по диапазонам первичного ключа; различающиеся
+диапазоны делятся дальше, пока не останутся точные ID (см. _consistency).
+
+Результат:
+- только в первой базе (например, удалены в backup или созданы в default);
+- только во второй базе;
+- есть в обеих, но значения колонок различаются.
+"""
+import time
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from ._consistency import DEFAULT_CHUNKS, DEFAULT_FANOUT, DEFAULT_LEAF_SIZE, compare_model, model_columns
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает таблицу модели в двух базах и выводит ID различающихся строк'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', type=str, help='Модель в формате app_label.Model, например items.Item')
+        parser.add_argument('--left', type=str, default=DEFAULT_DB_ALIAS, help='Первая база (по умолчанию: default)')
+        parser.add_argument('--right', type=str, default='backup', help='Вторая база (по умолчанию: backup)')
+        parser.add_argument('--fields', type=str,
+                            help='Поля через запятую, входящие в сравнение (по умолчанию: все, кроме pk)')
+        parser.add_argument('--competitor', type=int, help='Сравнивать только строки конкурента')
+        parser.add_argument('--chunks', type=int, default=DEFAULT_CHUNKS,
+                            help=f'Диапазонов на первом уровне (по умолчанию: {DEFAULT_CHUNKS})')
+        parser.add_argument('--fanout', type=int, default=DEFAULT_FANOUT,
+                            help=f'На сколько частей делится различающийся диапазон (по умолчанию: {DEFAULT_FANOUT})')
+        parser.add_argument('--leaf-size', type=int, default=DEFAULT_LEAF_SIZE,
+                            help=f'Строк в диапазоне для построчного сравнения (по умолчанию: {DEFAULT_LEAF_SIZE})')
+        parser.add_argument('--limit', type=int, default=20, help='Сколько ID каждого вида вывести (по умолчанию: 20)')
+        parser.add_argument('--output', type=str, help='Записать все различающиеся ID в файл')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            self.stdout.write(self.style.ERROR(f'Модель {options["model"]} не найдена: {e}'))
+            return
+
+        field_names = [name.strip() for name in options['fields'].split(',')] if options['fields'] else None
+        filters = {}
+        try:
+            columns = model_columns(model, field_names)
+            if options['competitor'] is not None:
+                filters[model._meta.get_field('competitor').column] = options['competitor']
+        except FieldDoesNotExist as e:
+            self.stdout.write(self.style.ERROR(f'Поле не найдено: {e}'))
+            return
+
+        left, right = options['left'], options['right']
+        self.stdout.write(f'=== СВЕРКА {model._meta.label}: {left} <-> {right} ===')
+        self.stdout.write(f'Колонки: {", ".join(columns)}')
+        if filters:
+            self.stdout.write(f'Конкурент: {options["competitor"]}')
+
+        def on_level(level, checked, differing):
+            self.stdout.write(f'   Уровень {level}: диапазонов {checked}, различается {differing}')
+
+        started = time.monotonic()
+        diff = compare_model(
+            model, left, right, field_names=field_names, filters=filters,
+            chunks=options['chunks'], fanout=options['fanout'], leaf_size=options['leaf_size'], on_level=on_level,
+        )
+        elapsed = time.monotonic() - started
+
+        limit = options['limit']
+        for title, ids in ((f'Только в {left}', diff.only_left),
+                           (f'Только в {right}', diff.only_right),
+                           ('Значения различаются', diff.changed)):
+            self.stdout.write(f'\n{title}: {len(ids)}')
+            if ids:
+                shown = ', '.join(str(pk) for pk in ids[:limit])
+                self.stdout.write(f'   {shown}{" ..." if len(ids) > limit else ""}')
+
+        self.stdout.write(f'\nЗапросов к каждой базе: {diff.queries}, уровней: {diff.levels}, '
+                          f'строк сумм: {diff.checksum_rows}, строк (pk, md5): {diff.leaf_rows}')
+        self.stdout.write(f'Время: {elapsed:.1f} с')
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                for kind, ids in (('only_left', diff.only_left), ('only_right', diff.only_right),
+                                  ('changed', diff.changed)):
+                    for pk in ids:
+                        f.write(f'{kind}\t{pk}\n')
+            self.stdout.write(self.style.SUCCESS(f'ID сохранены в: {options["output"]}'))
+
+        if diff.total:
+            self.stdout.write(self.style.WARNING(f'Найдено различий: {diff.total}'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Различий нет'))
+
+# Запустите команду:
+# python manage.py check_consistency items.Item
+# python manage.py check_consistency linked.RecommendedLinked --fields not_recommend,nomenclature_code
+# python manage.py check_consistency items.ItemInfo --competitor 142 --output iteminfo_diff.tsv
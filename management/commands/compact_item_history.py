@@ -0,0 +1,196 @@
+"""
+Скрипт сжатия истории цен (ItemInfoHistory) конкурента.
+
+НАЗНАЧЕНИЕ:
+- Большинство записей истории - это подряд идущие снимки, в которых не
+  поменялись ни prices, ни available_type
+- Скрипт схлопывает каждую такую серию до двух записей: первой (с какого
+  момента держится состояние) и последней (до какого момента оно держалось)
+- Промежуточные записи серии удаляются
+
+АЛГОРИТМ РАБОТЫ:
+1. Диапазон ID товаров конкурента делится на чанки (--chunk-size)
+2. Для каждого чанка оконными функциями LAG/LEAD по (item_id, analyzed_at)
+   находятся записи, у которых и предыдущий, и следующий снимок совпадают
+   с текущим по md5(prices, available_type)
+3. Такие записи удаляются одним DELETE в отдельной транзакции на чанк; снимки
+   для журнала пишутся тем же запросом из DELETE ... RETURNING
+
+ПОВТОРНЫЙ ЗАПУСК:
+После сжатия в каждой серии остается не больше двух записей, у которых нет
+"середины", поэтому повторный запуск ничего не удаляет и безопасен.
+
+РЕЖИМЫ РАБОТЫ:
+--dry-run : только оценка - сколько строк и байт будет освобождено
+
+ОТМЕНА:
+Удаляемые записи пишутся в журнал (_journal), запуск отменяется командой
+undo_run --run <run_id>. Журнал хранит каждую удаленную запись целиком
+(to_jsonb) - пока запуск не удален из журнала, место не освобождается, а
+занимает даже больше, чем удалено. Варианты:
+- undo_run --purge --older-than DAYS после проверки результата;
+- --no-journal - без журнала: место освобождается сразу, но запуск нельзя
+  отменить (восстановление - только из backup).
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from kenny.items.models import Competitor, Item, ItemInfoHistory
+
+from ._history import STATE_FIELDS, history_column, snapshot_hash_sql
+from ._journal import DELETE, Journal
+from ._progress import ProgressReporter
+
+# Заголовок кортежа (23 байта + выравнивание) и указатель строки на странице
+ROW_OVERHEAD_BYTES = 28
+
+
+class Command(BaseCommand):
+    help = 'Схлопывает серии неизменившихся снимков ItemInfoHistory до первой и последней записи'
+
+    def add_arguments(self, parser):
+        parser.add_argument('competitor_id', type=int, help='ID конкурента')
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Ширина диапазона ID товаров в одном чанке (по умолчанию: 10000)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только показать оценку экономии, без удаления')
+        parser.add_argument('--no-journal', action='store_true',
+                            help='Не писать удаляемые записи в журнал (запуск нельзя будет отменить)')
+
+    def handle(self, *args, **options):
+        competitor_id = options['competitor_id']
+        chunk_size = options['chunk_size']
+        dry_run = options['dry_run']
+
+        self.stdout.write('=== НАЧАЛО ПРОЦЕДУРЫ СЖАТИЯ ИСТОРИИ ===')
+        if dry_run:
+            self.stdout.write(self.style.WARNING('РЕЖИМ ПРОСМОТРА (dry-run) - удаление не будет выполнено'))
+
+        try:
+            competitor = Competitor.objects.get(id=competitor_id)
+            self.stdout.write(self.style.SUCCESS(f'Найден конкурент: {competitor.name} (ID: {competitor.id})'))
+        except Competitor.DoesNotExist:
+            self.stdout.write(self.style.ERROR(f'Конкурент с ID {competitor_id} не найден'))
+            return
+
+        bounds = Item.objects.filter(competitor=competitor).aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            self.stdout.write('У конкурента нет товаров')
+            return
+
+        min_id, max_id = bounds['min_id'], bounds['max_id']
+        total_chunks = (max_id - min_id) // chunk_size + 1
+        self.stdout.write(f'Диапазон ID товаров: {min_id}..{max_id}, чанков: {total_chunks}')
+
+        start_time = time.time()
+        total_rows = 0
+        total_bytes = 0
+        progress = ProgressReporter(self.stdout.write, 'compact_item_history', total=total_chunks,
+                                    unit='чанков', labels={'competitor': competitor.id})
+        journal = None
+        if not dry_run and options['no_journal']:
+            self.stdout.write(self.style.WARNING('Без журнала (--no-journal): запуск нельзя будет отменить'))
+        elif not dry_run:
+            journal = Journal('compact_item_history', competitor.id)
+            self.stdout.write(f'Журнал запуска: {journal.run_id}')
+
+        for lo in range(min_id, max_id + 1, chunk_size):
+            hi = lo + chunk_size
+            if dry_run:
+                rows, size = self.estimate_chunk(competitor.id, lo, hi)
+                total_bytes += size
+            else:
+                with transaction.atomic():
+                    rows = self.compact_chunk(competitor.id, lo, hi, journal)
+            total_rows += rows
+
+            progress.update(1, **{'Можно удалить' if dry_run else 'Удалено': total_rows})
+        progress.finish()
+        if journal:
+            journal.finish()
+
+        execution_time = time.time() - start_time
+        self.stdout.write('=== ИТОГИ СЖАТИЯ ===')
+        if dry_run:
+            self.stdout.write(f'Записей к удалению: {total_rows}')
+            self.stdout.write(f'Ориентировочно освободится: {total_bytes / (1024 * 1024):.1f} МБ '
+                              f'(без учета индексов)')
+        else:
+            self.stdout.write(f'Удалено записей истории: {total_rows}')
+            if journal:
+                self.stdout.write(f'Отменить: python manage.py undo_run --run {journal.run_id}')
+        self.stdout.write(f'Время выполнения: {execution_time:.2f} секунд')
+        self.stdout.write(self.style.SUCCESS('=== ПРОЦЕДУРА СЖАТИЯ ЗАВЕРШЕНА ==='))
+
+    def redundant_rows_sql(self):
+        """CTE с ID записей-"середин" серий неизменившихся снимков."""
+        qn = connection.ops.quote_name
+        table = qn(ItemInfoHistory._meta.db_table)
+        pk = qn(ItemInfoHistory._meta.pk.column)
+        item_col = qn(history_column('item'))
+        competitor_col = qn(history_column('competitor'))
+        analyzed_col = qn(history_column('analyzed_at'))
+
+        return f"""
+            WITH hashed AS (
+                SELECT h.{pk} AS id, h.{item_col} AS item_id, h.{analyzed_col} AS analyzed_at,
+                       {snapshot_hash_sql('h', fields=STATE_FIELDS, connection=connection)} AS state_hash
+                FROM {table} h
+                WHERE h.{competitor_col} = %(competitor_id)s
+                  AND h.{item_col} >= %(lo)s AND h.{item_col} < %(hi)s
+            ),
+            marked AS (
+                SELECT id, state_hash,
+                       LAG(state_hash) OVER w AS prev_hash,
+                       LEAD(state_hash) OVER w AS next_hash
+                FROM hashed
+                WINDOW w AS (PARTITION BY item_id ORDER BY analyzed_at, id)
+            ),
+            redundant AS (
+                SELECT id FROM marked
+                WHERE prev_hash = state_hash AND next_hash = state_hash
+            )
+        """
+
+    def estimate_chunk(self, competitor_id, lo, hi):
+        qn = connection.ops.quote_name
+        table = qn(ItemInfoHistory._meta.db_table)
+        pk = qn(ItemInfoHistory._meta.pk.column)
+        sql = self.redundant_rows_sql() + f"""
+            SELECT count(*), coalesce(sum(pg_column_size(t.*)), 0)
+            FROM {table} t JOIN redundant r ON t.{pk} = r.id
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {'competitor_id': competitor_id, 'lo': lo, 'hi': hi})
+            rows, size = cursor.fetchone()
+        return rows, int(size) + rows * ROW_OVERHEAD_BYTES
+
+    def compact_chunk(self, competitor_id, lo, hi, journal):
+        qn = connection.ops.quote_name
+        table = qn(ItemInfoHistory._meta.db_table)
+        pk = qn(ItemInfoHistory._meta.pk.column)
+        params = {'competitor_id': competitor_id, 'lo': lo, 'hi': hi}
+        if journal:
+            # Один запрос: отдельный снимок и DELETE посчитали бы CTE дважды и
+            # под READ COMMITTED могли бы затронуть разные строки
+            sql = self.redundant_rows_sql() + f"""
+                , gone AS (
+                    DELETE FROM {table} t USING redundant r WHERE t.{pk} = r.id
+                    RETURNING t.*
+                )
+                {journal.snapshot_sql(DELETE, ItemInfoHistory, 'gone')}
+            """
+        else:
+            sql = self.redundant_rows_sql() + f"""
+                DELETE FROM {table} t USING redundant r WHERE t.{pk} = r.id
+            """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+# Запустите команду:
+# python manage.py compact_item_history 142 --dry-run
+# python manage.py compact_item_history 142 --chunk-size 20000
+# python manage.py compact_item_history 142 --no-journal
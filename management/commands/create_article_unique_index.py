@@ -0,0 +1,87 @@
+"""
+Создание уникального индекса по нормализованному артикулу конкурента.
+
+Индекс нужен ingest_items (_ingest): запись товаров из парсеров идет через
+INSERT ... ON CONFLICT по этому индексу, и дубликаты по артикулу больше не
+появляются. Индекс частичный (WHERE competitor_id = <id>) и строится по тому
+же выражению ключа, что и поиск дубликатов (_normalize).
+
+Построить уникальный индекс можно только когда дубликатов уже нет, поэтому
+команда сначала проверяет группы с одинаковым ключом и при их наличии
+отказывается, предлагая сначала объединить или удалить дубликаты.
+Индекс строится CONCURRENTLY, не блокируя запись парсеров. Невалидный
+индекс, оставшийся от прерванного построения, удаляется и строится заново.
+"""
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+from kenny.items.models import Competitor, Item
+
+from ._incremental import article_key_index, drop_index, index_state
+from ._normalize import normalizer_for
+
+
+class Command(BaseCommand):
+    help = 'Создает уникальный индекс по нормализованному артикулу для записи товаров без дубликатов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('competitor_id', type=int, help='ID конкурента')
+
+    def handle(self, *args, **options):
+        competitor_id = options['competitor_id']
+
+        try:
+            competitor = Competitor.objects.get(id=competitor_id)
+            self.stdout.write(self.style.SUCCESS(f'Найден конкурент: {competitor.name} (ID: {competitor.id})'))
+        except Competitor.DoesNotExist:
+            self.stdout.write(self.style.ERROR(f'Конкурент с ID {competitor_id} не найден'))
+            return
+
+        name, ddl = article_key_index(competitor.id, unique=True)
+        state = index_state(name)
+        if state:
+            self.stdout.write(self.style.SUCCESS(f'Индекс {name} уже существует'))
+            return
+        if state is False:
+            self.stdout.write(self.style.WARNING(
+                f'Индекс {name} невалиден (построение было прервано), он будет удален и создан заново'))
+            drop_index(name)
+
+        self.stdout.write('Проверка дубликатов по нормализованному артикулу...')
+        duplicates = self.duplicate_keys(competitor.id)
+        if duplicates:
+            self.stdout.write(self.style.ERROR(f'Найдено артикулов с дубликатами: {len(duplicates)}'))
+            for key, count in duplicates[:10]:
+                self.stdout.write(f"   '{key}': {count} товаров")
+            self.stdout.write(f'Сначала объедините или удалите дубликаты: python manage.py dedupe_plan {competitor.id}')
+            return
+
+        self.stdout.write(f'Создание индекса {name} (CONCURRENTLY)...')
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(ddl)
+        except DatabaseError as e:
+            # Неудачный CREATE INDEX CONCURRENTLY оставляет невалидный индекс
+            self.stdout.write(self.style.ERROR(f'Не удалось создать индекс: {e}'))
+            drop_index(name)
+            return
+
+        self.stdout.write(self.style.SUCCESS(f'Индекс {name} создан, ingest_items может записывать товары'))
+
+    def duplicate_keys(self, competitor_id):
+        """[(ключ, товаров)] для непустых ключей, которые встречаются больше одного раза."""
+        qn = connection.ops.quote_name
+        meta = Item._meta
+        key_sql, params = normalizer_for(competitor_id).key_sql(qn(meta.get_field('article').column))
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT {key_sql} AS article_key, count(*)
+                FROM {qn(meta.db_table)}
+                WHERE {qn(meta.get_field('competitor').column)} = %s AND {key_sql} <> ''
+                GROUP BY 1
+                HAVING count(*) > 1
+                ORDER BY 2 DESC
+            """, params + [competitor_id] + params)
+            return cursor.fetchall()
+
+# Запустите команду:
+# python manage.py create_article_unique_index 142
@@ -1,19 +1,46 @@
+from collections import Counter
+from datetime import datetime
+
 from django.core.management.base import BaseCommand
-from django.db.models import F, Count, Min
-from django.db.models.functions import Lower, Trim
+from django.db import connections
+from django.utils import timezone
 
 from kenny.items.models import Item, Competitor
 
+from ._normalize import normalizer_for
+from ._routing import choose_read_alias
+
+# Сколько строк забирать с сервера за раз
+FETCH_SIZE = 2000
+HISTOGRAM_WIDTH = 50
+
+
+def bucket_start(value, bucket):
+    """Начало интервала гистограммы (в локальном времени) для даты появления."""
+    if isinstance(value, datetime):
+        if timezone.is_aware(value):
+            value = timezone.localtime(value)
+        if bucket == 'hour':
+            return value.replace(minute=0, second=0, microsecond=0)
+        return value.date()
+    return value
+
+
 class Command(BaseCommand):
     help = 'Находит дубликаты артикулов с пробелами и выводит дату их первого появления в отсортированном виде'
 
     def add_arguments(self, parser):
         parser.add_argument('competitor_id', type=int, help='ID конкурента для поиска дубликатов')
         parser.add_argument('--output', type=str, default='duplicates_report.txt', help='Файл для сохранения отчёта')
+        parser.add_argument('--bucket', choices=['day', 'hour'], default='day',
+                            help='Интервал гистограммы появления дубликатов (по умолчанию: day)')
+        parser.add_argument('--read-from', nargs='?', const='', default=None, metavar='ALIAS',
+                            help='Выполнить запрос на реплике (без значения - DEDUPE_READ_ALIAS)')
 
     def handle(self, *args, **options):
         competitor_id = options['competitor_id']
         output_file = options['output']
+        bucket = options['bucket']
 
         try:
             competitor = Competitor.objects.get(id=competitor_id)
@@ -22,40 +49,82 @@ class Command(BaseCommand):
             return
 
         self.stdout.write(f'Поиск дубликатов для конкурента: {competitor}')
-
-        items = Item.objects.filter(competitor=competitor).annotate(
-            normalized_article=Lower(Trim(F('article')))
-        )
-
-        duplicate_articles = items.values('normalized_article').annotate(
-            count=Count('id')
-        ).filter(count__gt=1).values_list('normalized_article', flat=True)
-
-        if not duplicate_articles:
-            self.stdout.write('Дубликатов не найдено.')
-            return
-
-        duplicates_with_spaces = items.filter(normalized_article__in=duplicate_articles).exclude(
-            article__iexact=F('normalized_article')
-        )
-
-        grouped = duplicates_with_spaces.values('normalized_article').annotate(
-            count=Count('id'),
-            first_date=Min('date_create')
-        ).order_by('first_date')
-
-        lines = ['Артикулы с дубликатами и даты первого появления (от ранней к поздней):\n']
-
-        for dup in grouped:
-            line = f"Артикул: {dup['normalized_article']}, Кол-во с пробелами: {dup['count']}, С даты: {dup['first_date']}"
+        # Отчет только читает - с --read-from запрос уходит на реплику
+        connection = connections[choose_read_alias(options['read_from'], competitor.id, write=self.stdout.write)]
+
+        # Один проход по товарам конкурента: размер группы считается оконной
+        # функцией, в отчет идут ненормализованные варианты из групп 2+ товаров
+        qn = connection.ops.quote_name
+        meta = Item._meta
+        article_col = qn(meta.get_field('article').column)
+        date_col = qn(meta.get_field('date_create').column)
+        normalizer = normalizer_for(competitor.id)
+        key_sql, key_params = normalizer.key_sql(article_col)
+        clean_sql, clean_params = normalizer.clean_sql(article_col)
+
+        sql = f"""
+            SELECT article_key, count(*), min(date_create)
+            FROM (
+                SELECT article_key, not_normalized, date_create,
+                       count(*) OVER (PARTITION BY article_key) AS group_size
+                FROM (
+                    SELECT {key_sql} AS article_key,
+                           {article_col} <> {clean_sql} AS not_normalized,
+                           {date_col} AS date_create
+                    FROM {qn(meta.db_table)}
+                    WHERE {qn(meta.get_field('competitor').column)} = %s
+                ) keyed
+            ) grouped
+            WHERE group_size > 1 AND not_normalized
+            GROUP BY article_key
+            ORDER BY 3, 1
+        """
+        params = key_params + clean_params + [competitor.id]
+
+        histogram = Counter()
+        total_groups = 0
+        total_items = 0
+
+        with open(output_file, 'w', encoding='utf-8') as f, connection.chunked_cursor() as cursor:
+            f.write('Артикулы с дубликатами и даты первого появления (от ранней к поздней):\n')
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                for article_key, count, first_date in rows:
+                    f.write(f'Артикул: {article_key}, Кол-во с пробелами: {count}, С даты: {first_date}\n')
+                    histogram[bucket_start(first_date, bucket)] += 1
+                    total_groups += 1
+                    total_items += count
+
+            if not total_groups:
+                self.stdout.write('Дубликатов не найдено.')
+                return
+
+            histogram_lines = self.histogram_lines(histogram, bucket)
+            f.write(f'\nПоявление дубликатов по интервалам ({bucket}):\n')
+            f.write('\n'.join(histogram_lines) + '\n')
+
+        self.stdout.write(f'Артикулов с дубликатами: {total_groups}, товаров с пробелами: {total_items}')
+        self.stdout.write(f'Появление дубликатов по интервалам ({bucket}):')
+        for line in histogram_lines:
             self.stdout.write(line)
-            lines.append(line)
-
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(lines))
-
         self.stdout.write(self.style.SUCCESS(f'Отчёт сохранён в файл: {output_file}'))
 
+    def histogram_lines(self, histogram, bucket):
+        peak = max(histogram.values())
+        fmt = '%Y-%m-%d %H:00' if bucket == 'hour' else '%Y-%m-%d'
+        lines = []
+        for start in sorted(histogram):
+            count = histogram[start]
+            label = start.strftime(fmt) if hasattr(start, 'strftime') else str(start)
+            bar = '#' * max(1, round(count / peak * HISTOGRAM_WIDTH))
+            lines.append(f'{label}  {count:>7}  {bar}')
+        return lines
+
 
 # python manage.py date_duplicate 142
-# python manage.py date_duplicate <ID_конкурента> --output файл.txt
\ No newline at end of file
+# python manage.py date_duplicate <ID_конкурента> --output файл.txt
+# python manage.py date_duplicate 142 --bucket hour
+# python manage.py date_duplicate 142 --read-from backup
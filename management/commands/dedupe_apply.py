@@ -0,0 +1,219 @@
+"""
+Применение плана объединения дубликатов, построенного dedupe_plan.
+
+АЛГОРИТМ РАБОТЫ:
+1. Чтение плана и проверка версии формата
+2. Сверка отпечатка БД: если товары плана удалены или изменились после
+   построения плана - выполнение отменяется. После подтверждения, уже в
+   транзакции применения, товары плана блокируются (SELECT ... FOR UPDATE)
+   и отпечаток сверяется повторно - изменения, сделанные парсерами, пока
+   оператор подтверждал запуск, тоже отменяют выполнение
+3. Загрузка пар (master_id, slave_id) во временную staging-таблицу через COPY
+4. Объединение set-based запросами с JOIN на staging-таблицу:
+   - история подчиненных копируется на мастеров без одинаковых снимков
+   - рекомендации переносятся на мастеров одним UPDATE
+   - ItemInfo мастера обновляется самой свежей информацией подчиненных
+     (или создается, если у мастера ее нет)
+   - подчиненные товары удаляются пачками
+Все шаги выполняются в одной транзакции. Снимки изменяемых строк пишутся в
+журнал (_journal): запуск отменяется командой undo_run --run <run_id>.
+"""
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from kenny.items.models import Item, ItemInfo, ItemInfoHistory
+
+from linked.models import RecommendedLinked
+
+from ._db import copy_rows
+from ._history import copy_history_from_staging
+from ._journal import UPDATE, Journal
+from ._plan import PlanError, compute_fingerprint, fingerprint_count, lock_plan_items, plan_item_ids, read_plan
+from ._progress import ProgressReporter
+
+STAGING_TABLE = 'dedupe_plan_staging'
+
+# Поля ItemInfo, которые переносятся с подчиненного товара (как в merge_duplicate_item)
+INFO_FIELDS = ('analyzed_at', 'url', 'catalog_url', 'prices', 'available_type')
+
+
+class Command(BaseCommand):
+    help = 'Применяет план объединения дубликатов, построенный командой dedupe_plan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('plan_file', type=str, help='Путь к файлу плана')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Размер пачки при удалении подчинённых товаров (по умолчанию: 1000)')
+        parser.add_argument('--force', action='store_true', help='Выполнить без подтверждения')
+
+    def handle(self, *args, **options):
+        plan_file = options['plan_file']
+        batch_size = options['batch_size']
+        force = options['force']
+
+        self.stdout.write('=== ПРИМЕНЕНИЕ ПЛАНА ОБЪЕДИНЕНИЯ ДУБЛИКАТОВ ===')
+
+        try:
+            header, groups = read_plan(plan_file)
+        except (OSError, PlanError) as e:
+            self.stdout.write(self.style.ERROR(f'Не удалось прочитать план: {e}'))
+            return
+
+        self.stdout.write(f"Конкурент: {header.get('competitor_name')} (ID: {header.get('competitor_id')})")
+        self.stdout.write(f"План построен: {header.get('created_at')}, правило: {header.get('master_rule')}")
+        self.stdout.write(f'Групп: {len(groups)}')
+
+        if not groups:
+            self.stdout.write('План пуст')
+            return
+
+        # Проверка, что товары плана не изменились (до подтверждения - чтобы
+        # не спрашивать об устаревшем плане; окончательная - в транзакции)
+        plan_ids = plan_item_ids(groups)
+        if fingerprint_count(header.get('fingerprint')) != len(plan_ids):
+            self.stdout.write(self.style.ERROR(
+                f"Отпечаток плана покрывает {fingerprint_count(header.get('fingerprint'))} товаров из "
+                f'{len(plan_ids)}: часть товаров отсутствовала в БД уже при построении плана'))
+            self.stdout.write(f"Постройте план заново: python manage.py dedupe_plan {header.get('competitor_id')}")
+            return
+        fingerprint = compute_fingerprint(plan_ids)
+        if fingerprint != header.get('fingerprint'):
+            self.report_fingerprint_mismatch(header, fingerprint)
+            return
+        self.stdout.write(self.style.SUCCESS('Отпечаток БД совпадает'))
+
+        pairs = [(group.master, slave_id) for group in groups for slave_id in group.slaves]
+
+        if not force:
+            self.stdout.write(f"Для подтверждения объединения {len(groups)} артикулов "
+                              f"({len(pairs)} подчинённых товаров) введите 'y':")
+            try:
+                confirm = input().strip().lower()
+            except UnicodeDecodeError:
+                self.stdout.write(
+                    'Обнаружена проблема с кодировкой ввода. Используйте параметр --force для выполнения без подтверждения.')
+                return
+            if confirm != 'y':
+                self.stdout.write('Объединение отменено.')
+                return
+
+        with transaction.atomic():
+            # Пока оператор подтверждал, парсеры могли изменить товары: строки
+            # плана блокируются до конца транзакции, и отпечаток сверяется заново
+            lock_plan_items(plan_ids)
+            fingerprint = compute_fingerprint(plan_ids)
+            if fingerprint != header.get('fingerprint'):
+                self.report_fingerprint_mismatch(header, fingerprint)
+                return
+
+            journal = Journal('dedupe_apply', header.get('competitor_id'))
+            self.stdout.write(f'Журнал запуска: {journal.run_id}')
+
+            with connection.cursor() as cursor:
+                cursor.execute(f"""
+                    CREATE TEMP TABLE {STAGING_TABLE} (
+                        master_id bigint NOT NULL,
+                        slave_id bigint PRIMARY KEY
+                    ) ON COMMIT DROP
+                """)
+                loaded = copy_rows(cursor, STAGING_TABLE, ['master_id', 'slave_id'], pairs)
+                cursor.execute(f'ANALYZE {STAGING_TABLE}')
+            self.stdout.write(f'Загружено пар в staging-таблицу: {loaded}')
+
+            history_ids, history_skipped = copy_history_from_staging(STAGING_TABLE, return_ids=True)
+            journal.record_inserts(ItemInfoHistory, history_ids)
+            self.stdout.write(f'Скопировано записей истории: {len(history_ids)} '
+                              f'(пропущено дубликатов: {history_skipped})')
+
+            recommendations_moved = self.move_recommendations(journal)
+            self.stdout.write(f'Перенесено рекомендаций: {recommendations_moved}')
+
+            infos_updated, infos_created = self.merge_item_info(journal)
+            self.stdout.write(f'Обновлено ItemInfo мастеров: {infos_updated}, создано: {infos_created}')
+
+            slave_ids = [slave_id for _, slave_id in pairs]
+            deleted_items = 0
+            deleted_objects = 0
+            progress = ProgressReporter(self.stdout.write, 'dedupe_apply', total=len(slave_ids), unit='товаров',
+                                        labels={'competitor': header.get('competitor_id')})
+            # Размер пачки фиксированный: все пачки - в одной транзакции применения,
+            # уменьшение пачки при ожиданиях блокировок не отпустило бы ни одной
+            # блокировки, только удлинило бы транзакцию (см. _batching)
+            for i in range(0, len(slave_ids), batch_size):
+                batch_ids = slave_ids[i:i + batch_size]
+                journal.capture_delete(Item, batch_ids)
+                deleted_info = Item.objects.filter(id__in=batch_ids).delete()
+                deleted_items += deleted_info[1].get(Item._meta.label, 0)
+                deleted_objects += deleted_info[0]
+                progress.update(len(batch_ids), Удалено_объектов=deleted_objects)
+            progress.finish()
+        journal.finish()
+
+        self.stdout.write(self.style.SUCCESS(f'План применен. Удалено товаров: {deleted_items}, '
+                                             f'всего объектов в БД: {deleted_objects}'))
+        self.stdout.write(f'Отменить: python manage.py undo_run --run {journal.run_id}')
+
+    def report_fingerprint_mismatch(self, header, fingerprint):
+        self.stdout.write(self.style.ERROR('База данных изменилась после построения плана'))
+        self.stdout.write(self.style.ERROR(f"  в плане:  {header.get('fingerprint')}"))
+        self.stdout.write(self.style.ERROR(f'  сейчас:   {fingerprint}'))
+        self.stdout.write('Постройте план заново: python manage.py dedupe_plan '
+                          f"{header.get('competitor_id')}")
+
+    def move_recommendations(self, journal):
+        qn = connection.ops.quote_name
+        meta = RecommendedLinked._meta
+        item_col = qn(meta.get_field('item').column)
+        journal.capture(UPDATE, RecommendedLinked, f't.{item_col} IN (SELECT slave_id FROM {STAGING_TABLE})')
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {qn(meta.db_table)} r
+                SET {item_col} = p.master_id
+                FROM {STAGING_TABLE} p
+                WHERE r.{item_col} = p.slave_id
+            """)
+            return cursor.rowcount
+
+    def merge_item_info(self, journal):
+        """Самая свежая ItemInfo подчиненных -> мастер. Возвращает (обновлено, создано)."""
+        qn = connection.ops.quote_name
+        meta = ItemInfo._meta
+        table = qn(meta.db_table)
+        item_col = qn(meta.get_field('item').column)
+        competitor_col = qn(meta.get_field('competitor').column)
+        analyzed_col = qn(meta.get_field('analyzed_at').column)
+        pk = qn(meta.pk.column)
+        info_cols = [qn(meta.get_field(name).column) for name in INFO_FIELDS]
+
+        newest_sql = f"""
+            SELECT DISTINCT ON (p.master_id) p.master_id, s.{competitor_col}, {', '.join(f's.{c}' for c in info_cols)}
+            FROM {table} s
+            JOIN {STAGING_TABLE} p ON s.{item_col} = p.slave_id
+            ORDER BY p.master_id, s.{analyzed_col} DESC
+        """
+        journal.capture(UPDATE, ItemInfo, f"""
+            EXISTS (SELECT 1 FROM ({newest_sql}) n
+                    WHERE t.{item_col} = n.master_id AND n.{analyzed_col} > t.{analyzed_col})
+        """)
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {table} m
+                SET {', '.join(f'{c} = n.{c}' for c in info_cols)}
+                FROM ({newest_sql}) n
+                WHERE m.{item_col} = n.master_id AND n.{analyzed_col} > m.{analyzed_col}
+            """)
+            updated = cursor.rowcount
+
+            cursor.execute(f"""
+                INSERT INTO {table} ({competitor_col}, {item_col}, {', '.join(info_cols)})
+                SELECT n.{competitor_col}, n.master_id, {', '.join(f'n.{c}' for c in info_cols)}
+                FROM ({newest_sql}) n
+                WHERE NOT EXISTS (SELECT 1 FROM {table} m WHERE m.{item_col} = n.master_id)
+                RETURNING {pk}
+            """)
+            created_ids = [row[0] for row in cursor.fetchall()]
+        journal.record_inserts(ItemInfo, created_ids)
+        return updated, len(created_ids)
+
+# Запустите команду:
+# python manage.py dedupe_apply dedupe_plan_142_20250904_104732.jsonl
+# python manage.py dedupe_apply plan_142.jsonl.gz --force
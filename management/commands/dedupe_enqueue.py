@@ -0,0 +1,109 @@
+"""
+Постановка работы по дедупликации в очередь для dedupe_worker (см. _work_queue).
+
+Для каждого конкурента создаются чанки по стадиям в порядке --kinds:
+- normalize - диапазоны ID товаров по --range-size;
+- dedupe / merge - --partitions частей по хешу ключа артикула.
+Воркеры на любых хостах забирают чанки через SKIP LOCKED; стадия конкурента
+начинается, только когда выполнены все чанки предыдущей.
+
+РЕЖИМЫ РАБОТЫ:
+--status [BATCH]        : состояние партий очереди (или одной партии)
+--requeue-failed BATCH  : вернуть упавшие чанки партии в очередь
+"""
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+from kenny.items.models import Competitor, Item
+
+from ._scoring import RULES
+from ._work_queue import KINDS, batch_status, enqueue, requeue_failed
+
+
+class Command(BaseCommand):
+    help = 'Ставит нормализацию и дедупликацию конкурентов в очередь для dedupe_worker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('competitor_ids', type=int, nargs='*', help='ID конкурентов')
+        parser.add_argument('--kinds', type=str, default='normalize,merge',
+                            help=f'Виды работы через запятую, в порядке выполнения: {", ".join(KINDS)} '
+                                 '(по умолчанию: normalize,merge)')
+        parser.add_argument('--range-size', type=int, default=50000,
+                            help='Размер диапазона ID для normalize (по умолчанию: 50000)')
+        parser.add_argument('--partitions', type=int, default=16,
+                            help='Частей по хешу ключа артикула для dedupe/merge (по умолчанию: 16)')
+        parser.add_argument('--master-rule', choices=sorted(RULES),
+                            help='Правило выбора мастер-товара для dedupe/merge (по умолчанию - как в командах)')
+        parser.add_argument('--status', nargs='?', const='', default=None, metavar='BATCH',
+                            help='Показать состояние очереди (всех партий или одной)')
+        parser.add_argument('--requeue-failed', type=str, metavar='BATCH',
+                            help='Вернуть чанки партии со статусом failed в очередь')
+
+    def handle(self, *args, **options):
+        if options['status'] is not None:
+            self.print_status(options['status'] or None)
+            return
+        if options['requeue_failed']:
+            count = requeue_failed(options['requeue_failed'])
+            self.stdout.write(self.style.SUCCESS(f'Возвращено в очередь чанков: {count}'))
+            return
+
+        kinds = [kind.strip() for kind in options['kinds'].split(',') if kind.strip()]
+        unknown = [kind for kind in kinds if kind not in KINDS]
+        if unknown:
+            self.stdout.write(self.style.ERROR(f'Неизвестные виды работы: {", ".join(unknown)}. '
+                                               f'Доступны: {", ".join(KINDS)}'))
+            return
+        if not options['competitor_ids']:
+            self.stdout.write(self.style.ERROR('Укажите ID конкурентов'))
+            return
+
+        range_size = options['range_size']
+        partitions = options['partitions']
+        params = {'master_rule': options['master_rule']} if options['master_rule'] else {}
+
+        chunks = []
+        for competitor_id in options['competitor_ids']:
+            if not Competitor.objects.filter(id=competitor_id).exists():
+                self.stdout.write(self.style.ERROR(f'Конкурент с ID {competitor_id} не найден - пропущен'))
+                continue
+            bounds = Item.objects.filter(competitor_id=competitor_id).aggregate(min_id=Min('id'), max_id=Max('id'))
+            if bounds['min_id'] is None:
+                self.stdout.write(f'У конкурента {competitor_id} нет товаров - пропущен')
+                continue
+
+            count_before = len(chunks)
+            for stage, kind in enumerate(kinds):
+                if kind == 'normalize':
+                    for lo in range(bounds['min_id'], bounds['max_id'] + 1, range_size):
+                        chunks.append((stage, kind, competitor_id, lo, lo + range_size, {}))
+                else:
+                    for part in range(partitions):
+                        chunks.append((stage, kind, competitor_id, part, partitions, params))
+            self.stdout.write(f'Конкурент {competitor_id}: чанков {len(chunks) - count_before} '
+                              f'(ID {bounds["min_id"]}..{bounds["max_id"]})')
+
+        if not chunks:
+            self.stdout.write('Нечего ставить в очередь')
+            return
+
+        batch_id, count = enqueue(chunks)
+        self.stdout.write(self.style.SUCCESS(f'Поставлено в очередь чанков: {count}, партия: {batch_id}'))
+        self.stdout.write(f'Запустить воркеры: python manage.py dedupe_worker --batch {batch_id} --processes 4')
+        self.stdout.write(f'Состояние: python manage.py dedupe_enqueue --status {batch_id}')
+
+    def print_status(self, batch_id):
+        rows = batch_status(batch_id)
+        if not rows:
+            self.stdout.write('Очередь пуста')
+            return
+        current = None
+        for batch, stage, kind, status, count, attempts in rows:
+            if batch != current:
+                current = batch
+                self.stdout.write(f'\nПартия {batch}:')
+            self.stdout.write(f'   {stage}. {kind:<9} {status:<8} чанков: {count:>6}, попыток: {attempts}')
+
+# Запустите команду:
+# python manage.py dedupe_enqueue 142 143 --kinds normalize,merge --partitions 32
+# python manage.py dedupe_enqueue --status
+# python manage.py dedupe_enqueue --requeue-failed 3f0c2d9e-...
@@ -0,0 +1,200 @@
+"""
+Построение плана объединения дубликатов товаров конкурента.
+
+Это первая стадия двухэтапного процесса:
+1. dedupe_plan  - один раз группирует товары, выбирает мастеров и сохраняет
+                  план (все ID мастеров и подчиненных + отпечаток БД) в файл.
+                  Рядом пишется текстовый предпросмотр в привычном формате.
+2. dedupe_apply - загружает план в staging-таблицу через COPY и выполняет
+                  объединение set-based запросами.
+
+План можно спокойно проверить offline: повторно группировать товары перед
+применением не нужно.
+
+С --read-from группировка и выбор мастеров читают с реплики (по умолчанию
+алиас DEDUPE_READ_ALIAS), если она не отстает. Перед записью плана группы
+перепроверяются в default (мастер существует, ключ артикула прежний), а
+отпечаток БД всегда считается по default, чтобы dedupe_apply сверялся с тем,
+что будет изменено.
+"""
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from kenny.items.models import Competitor, Item
+
+from conf.read_routing import route_reads
+
+from ._grouping import BACKENDS, DEFAULT_MEMORY_BUDGET_MB, group_duplicates
+from ._normalize import normalizer_for, parse_partition, with_article_key, with_key_partition
+from ._plan import PlanGroup, compute_fingerprint, fingerprint_count, plan_item_ids, write_plan
+from ._progress import ProgressReporter, estimate_count
+from ._records import iter_item_records
+from ._routing import choose_read_alias, revalidate_groups
+from ._scoring import RULES, MasterSelector
+
+
+class Command(BaseCommand):
+    help = 'Строит план объединения дубликатов и сохраняет его в файл для dedupe_apply'
+
+    def add_arguments(self, parser):
+        parser.add_argument('competitor_id', type=int, help='ID конкурента')
+        parser.add_argument('--output', type=str, help='Путь к файлу плана (.jsonl или .jsonl.gz)')
+        parser.add_argument('--preview-file', type=str, help='Путь к текстовому предпросмотру')
+        parser.add_argument('--article', type=str, help='Конкретный артикул для обработки')
+        parser.add_argument('--master-rule', choices=sorted(RULES), default='latest_info',
+                            help='Правило выбора мастер-товара (по умолчанию: latest_info)')
+        parser.add_argument('--read-from', nargs='?', const='', default=None, metavar='ALIAS',
+                            help='Читать товары для планирования с реплики (без значения - DEDUPE_READ_ALIAS)')
+        parser.add_argument('--grouping', choices=BACKENDS, default='memory',
+                            help='Группировка в памяти или внешней сортировкой с диском (по умолчанию: memory)')
+        parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET_MB,
+                            help=f'Память под пачку внешней сортировки, МБ (по умолчанию: {DEFAULT_MEMORY_BUDGET_MB})')
+        parser.add_argument('--partition', type=str, metavar='P/N',
+                            help='Только часть P из N по хешу ключа артикула (для dedupe_worker)')
+
+    def handle(self, *args, **options):
+        competitor_id = options['competitor_id']
+        specific_article = options.get('article')
+        master_rule = options['master_rule']
+        partition = None
+        if options['partition']:
+            try:
+                partition = parse_partition(options['partition'])
+            except ValueError as e:
+                self.stdout.write(self.style.ERROR(f'Неверный --partition: {e}'))
+                return
+
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        plan_file_path = options.get('output') or f'dedupe_plan_{competitor_id}_{timestamp}.jsonl'
+        preview_file_path = options.get('preview_file') or f'preview_merge_{competitor_id}_{timestamp}.txt'
+
+        self.stdout.write('=== ПОСТРОЕНИЕ ПЛАНА ОБЪЕДИНЕНИЯ ДУБЛИКАТОВ ===')
+
+        try:
+            competitor = Competitor.objects.get(id=competitor_id)
+            self.stdout.write(self.style.SUCCESS(f'Найден конкурент: {competitor.name}'))
+        except Competitor.DoesNotExist:
+            self.stdout.write(self.style.ERROR(f'Конкурент с ID {competitor_id} не найден'))
+            return
+
+        read_alias = choose_read_alias(options['read_from'], competitor.id, write=self.stdout.write)
+        with route_reads(read_alias):
+            groups, duplicate_articles, selector = self.build_groups(
+                competitor, specific_article, master_rule, options['grouping'], options['memory_budget'], partition)
+        if groups and read_alias != DEFAULT_DB_ALIAS:
+            groups = self.revalidate(competitor, groups)
+        if not groups:
+            self.stdout.write('Нет дубликатов для обработки')
+            return
+
+        plan_ids = plan_item_ids(groups)
+        fingerprint = compute_fingerprint(plan_ids)
+        if fingerprint_count(fingerprint) != len(plan_ids):
+            self.stdout.write(self.style.ERROR(
+                f'Товаров плана в {DEFAULT_DB_ALIAS}: {fingerprint_count(fingerprint)} из {len(plan_ids)} - '
+                f'товары изменились во время построения, запустите dedupe_plan заново'))
+            return
+        header = {
+            'competitor_id': competitor.id,
+            'competitor_name': competitor.name,
+            'master_rule': master_rule,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'fingerprint': fingerprint,
+            'groups': len(groups),
+            'slaves': sum(len(group.slaves) for group in groups),
+        }
+
+        try:
+            write_plan(plan_file_path, header, groups)
+            self.stdout.write(self.style.SUCCESS(f'План сохранен в: {plan_file_path}'))
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f'Ошибка при записи плана: {e}'))
+            return
+
+        # Текстовый предпросмотр в том же формате, что у merge_duplicate_item
+        items_by_id = {item.id: item for items_list in duplicate_articles.values() for item in items_list}
+        try:
+            with open(preview_file_path, 'w', encoding='utf-8') as f:
+                f.write('=== ПРЕДВАРИТЕЛЬНЫЙ ПРОСМОТР ОБЪЕДИНЕНИЯ ===\n\n')
+                f.write(f'Конкурент: {competitor.name}\n')
+                f.write(f'Дата формирования отчета: {datetime.now()}\n')
+                f.write(f'План: {plan_file_path}\n\n')
+                f.write(f'Всего артикулов для объединения: {len(groups)}\n\n')
+
+                for group in groups:
+                    master_item = items_by_id[group.master]
+                    f.write(f"Артикул: '{group.article}'\n")
+                    f.write(f'Мастер-товар: {group.master} (последнее обновление: '
+                            f"{selector.value('latest_info_datetime', master_item)})\n")
+                    for slave_id in group.slaves:
+                        f.write(f'Подчинённый товар: {slave_id} (последнее обновление: '
+                                f"{selector.value('latest_info_datetime', items_by_id[slave_id])})\n")
+                    f.write('\n')
+
+            self.stdout.write(self.style.SUCCESS(f'Предварительный просмотр сохранен в: {preview_file_path}'))
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f'Ошибка при записи файла: {e}'))
+
+        self.stdout.write(f"Групп: {header['groups']}, подчинённых товаров: {header['slaves']}")
+        self.stdout.write(f'Отпечаток БД: {fingerprint}')
+        self.stdout.write(f'Для применения: python manage.py dedupe_apply {plan_file_path}')
+
+    def build_groups(self, competitor, specific_article, master_rule, grouping, memory_budget, partition=None):
+        """Группировка товаров по ключу артикула и выбор мастеров.
+        Возвращает (группы плана, {ключ: [ItemRecord]}, selector)."""
+        normalizer = normalizer_for(competitor.id)
+        queryset = Item.objects.filter(competitor=competitor)
+        if partition:
+            self.stdout.write(f'Часть {partition[0]} из {partition[1]} по хешу ключа артикула')
+            queryset = with_key_partition(queryset, competitor.id, *partition)
+        items = with_article_key(queryset, competitor.id)
+        if specific_article:
+            items = items.filter(article_key=normalizer.key(specific_article))
+
+        # Группируем по ключу нормализованного артикула, посчитанному в БД
+        # (в памяти или внешней сортировкой, см. _grouping)
+        progress = ProgressReporter(self.stdout.write, 'dedupe_plan', total=estimate_count(items),
+                                    unit='товаров', labels={'competitor': competitor.id})
+        duplicate_articles, grouping_stats = group_duplicates(
+            self.tracked(iter_item_records(items), progress), grouping, memory_budget)
+        progress.finish()
+        if grouping_stats.runs:
+            self.stdout.write(f'Пачек внешней сортировки: {grouping_stats.runs} '
+                              f'({grouping_stats.spilled_bytes / 1024 / 1024:.1f} МБ на диске)')
+        if specific_article:
+            normalized_specific = normalizer.key(specific_article)
+            duplicate_articles = {k: v for k, v in duplicate_articles.items() if k == normalized_specific}
+
+        self.stdout.write(f'Найдено артикулов с дубликатами: {len(duplicate_articles)}')
+        if not duplicate_articles:
+            return [], {}, None
+
+        self.stdout.write(f'Правило выбора мастер-товара: {master_rule}')
+        selector = MasterSelector(master_rule, extra_features=('latest_info_date',))
+        groups = [
+            PlanGroup(article, master.id, [slave.id for slave in slaves])
+            for article, master, slaves in selector.select(duplicate_articles.items())
+        ]
+        return groups, duplicate_articles, selector
+
+    def revalidate(self, competitor, groups):
+        """Группы, построенные по реплике, без изменившихся в default."""
+        self.stdout.write(f'Проверка {len(groups)} групп в {DEFAULT_DB_ALIAS} (построены по реплике)...')
+        valid_groups, skipped = revalidate_groups(competitor.id, groups)
+        if skipped:
+            self.stdout.write(self.style.WARNING(
+                f'Пропущено групп: {skipped} (мастер удален или артикул изменился в {DEFAULT_DB_ALIAS})'))
+        return [PlanGroup(*group) for group in valid_groups if group[2]]
+
+    def tracked(self, records, progress):
+        """Записи без изменений, с обновлением прогресса по мере чтения."""
+        for record in records:
+            progress.update(1)
+            yield record
+
+# Запустите команду:
+# python manage.py dedupe_plan 142
+# python manage.py dedupe_plan 142 --output plan_142.jsonl.gz --master-rule most_history
+# python manage.py dedupe_plan 142 --read-from
+# python manage.py dedupe_plan 142 --grouping external --memory-budget 128
@@ -0,0 +1,150 @@
+"""
+Воркер очереди дедупликации (см. _work_queue, dedupe_enqueue).
+
+Забирает чанки через SELECT ... FOR UPDATE SKIP LOCKED и выполняет их:
+- normalize - UPDATE артикулов диапазона ID (_normalize.normalize_id_range);
+- dedupe    - remove_duplicate_items --partition P/N --force;
+- merge     - dedupe_plan --partition P/N и dedupe_apply --force.
+Пока чанк выполняется, heartbeat обновляется отдельным потоком. Перед каждым
+захватом воркер возвращает в очередь чанки с устаревшим heartbeat.
+
+Воркеры можно запускать на нескольких хостах; --processes N запускает N
+процессов на одном хосте (для локальной проверки хватает его).
+Без --wait воркер завершается, когда доступных чанков не осталось.
+"""
+import multiprocessing
+import os
+import tempfile
+import time
+import traceback
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from ._normalize import normalize_id_range
+from ._work_queue import KINDS, Heartbeat, claim, ensure_queue_table, finish, reclaim_stale, worker_name
+
+# Сколько последних строк вывода команды сохранять в result чанка
+OUTPUT_TAIL = 5
+
+
+class Command(BaseCommand):
+    help = 'Выполняет чанки очереди дедупликации, поставленные dedupe_enqueue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help='Процессов-воркеров на хосте (по умолчанию: 1)')
+        parser.add_argument('--kinds', type=str, default=','.join(KINDS),
+                            help=f'Какие виды работы брать (по умолчанию: {",".join(KINDS)})')
+        parser.add_argument('--batch', type=str, help='Брать чанки только этой партии')
+        parser.add_argument('--heartbeat', type=float, default=10,
+                            help='Интервал heartbeat, секунд (по умолчанию: 10)')
+        parser.add_argument('--stale-after', type=float, default=120,
+                            help='Через сколько секунд без heartbeat чанк переназначается (по умолчанию: 120)')
+        parser.add_argument('--max-attempts', type=int, default=3,
+                            help='Попыток на чанк до статуса failed (по умолчанию: 3)')
+        parser.add_argument('--wait', type=float,
+                            help='Ждать новых чанков, опрашивая очередь раз в N секунд, вместо завершения')
+
+    def handle(self, *args, **options):
+        kinds = [kind.strip() for kind in options['kinds'].split(',') if kind.strip()]
+        unknown = [kind for kind in kinds if kind not in KINDS]
+        if unknown:
+            self.stdout.write(self.style.ERROR(f'Неизвестные виды работы: {", ".join(unknown)}'))
+            return
+        options['kinds'] = kinds
+        ensure_queue_table()
+
+        processes = options['processes']
+        if processes <= 1:
+            self.run_worker(options)
+            return
+
+        # Соединения не должны переходить в дочерние процессы
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=self.run_worker_process, args=(options,), name=f'dedupe-worker-{i}')
+                   for i in range(processes)]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f'Запущено процессов: {processes}')
+        for worker in workers:
+            worker.join()
+        failed = [worker.name for worker in workers if worker.exitcode]
+        if failed:
+            self.stdout.write(self.style.ERROR(f'Процессы завершились с ошибкой: {", ".join(failed)}'))
+
+    def run_worker_process(self, options):
+        try:
+            self.run_worker(options)
+        finally:
+            connections.close_all()
+
+    def run_worker(self, options):
+        worker = worker_name()
+        done = failed = 0
+        self.stdout.write(f'[{worker}] воркер запущен')
+        while True:
+            returned, given_up = reclaim_stale(options['stale_after'], options['max_attempts'])
+            if returned or given_up:
+                self.stdout.write(f'[{worker}] возвращено чанков без heartbeat: {returned}, failed: {given_up}')
+
+            chunk = claim(worker, options['kinds'], options['batch'])
+            if chunk is None:
+                if options['wait']:
+                    time.sleep(options['wait'])
+                    continue
+                break
+
+            label = f'#{chunk.id} {chunk.kind} конкурент {chunk.competitor_id} [{chunk.lo}, {chunk.hi})'
+            self.stdout.write(f'[{worker}] {label}, попытка {chunk.attempts}')
+            started = time.monotonic()
+            result = error = None
+            with Heartbeat(chunk.id, worker, options['heartbeat']) as beat:
+                try:
+                    result = self.run_chunk(chunk)
+                except Exception:
+                    error = traceback.format_exc(limit=5)
+            elapsed = time.monotonic() - started
+
+            if beat.lost:
+                self.stdout.write(self.style.WARNING(f'[{worker}] {label}: чанк переназначен, результат не записан'))
+                continue
+            if error is None:
+                result['seconds'] = round(elapsed, 1)
+            if not finish(chunk.id, worker, result, error, options['max_attempts']):
+                self.stdout.write(self.style.WARNING(f'[{worker}] {label}: чанк переназначен, результат не записан'))
+            elif error is None:
+                done += 1
+                self.stdout.write(self.style.SUCCESS(f'[{worker}] {label}: выполнен за {elapsed:.1f} с'))
+            else:
+                failed += 1
+                self.stdout.write(self.style.ERROR(f'[{worker}] {label}: ошибка\n{error}'))
+
+        self.stdout.write(f'[{worker}] очередь пуста, выполнено чанков: {done}, с ошибкой: {failed}')
+
+    def run_chunk(self, chunk):
+        if chunk.kind == 'normalize':
+            with transaction.atomic():
+                return {'updated': normalize_id_range(chunk.competitor_id, chunk.lo, chunk.hi)}
+
+        output = StringIO()
+        partition = f'{chunk.lo}/{chunk.hi}'
+        extra = ['--master-rule', chunk.params['master_rule']] if chunk.params.get('master_rule') else []
+        if chunk.kind == 'dedupe':
+            call_command('remove_duplicate_items', chunk.competitor_id, '--partition', partition, '--force',
+                         *extra, stdout=output)
+        else:
+            with tempfile.TemporaryDirectory(prefix='dedupe_worker_') as directory:
+                plan_file = os.path.join(directory, 'plan.jsonl.gz')
+                call_command('dedupe_plan', chunk.competitor_id, '--partition', partition, '--output', plan_file,
+                             '--preview-file', os.path.join(directory, 'preview.txt'), *extra, stdout=output)
+                # dedupe_plan не пишет план, если дубликатов нет
+                if os.path.exists(plan_file):
+                    call_command('dedupe_apply', plan_file, '--force', stdout=output)
+        return {'output': output.getvalue().strip().splitlines()[-OUTPUT_TAIL:]}
+
+# Запустите команду:
+# python manage.py dedupe_worker --processes 4
+# python manage.py dedupe_worker --batch 3f0c2d9e-... --kinds normalize --wait 30
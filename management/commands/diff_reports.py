@@ -0,0 +1,86 @@
+"""
+Сравнение двух отчетов или планов дедупликации между запусками.
+
+Вместо сравнения preview_merge_*.txt "на глаз" команда разбирает оба файла
+потоково (_reports) в компактные отсортированные массивы ID и за один проход
+слиянием ключей выводит:
+- группы (артикулы), которые появились во втором файле;
+- группы, которых во втором файле нет;
+- группы, у которых сменился мастер-товар;
+- группы с тем же мастером, но другим набором подчинённых товаров.
+
+Файлы могут быть разных форматов: например, превью merge_duplicate_items
+и план dedupe_plan.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from ._reports import ReportGroups, diff_groups
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает два отчета/плана дедупликации: новые, исчезнувшие группы и смена мастера'
+
+    def add_arguments(self, parser):
+        parser.add_argument('old_file', type=str, help='Предыдущий отчет или план')
+        parser.add_argument('new_file', type=str, help='Новый отчет или план')
+        parser.add_argument('--limit', type=int, default=20,
+                            help='Сколько групп каждого вида показывать в консоли (по умолчанию: 20)')
+        parser.add_argument('--output', type=str, help='Сохранить полный список различий в файл')
+
+    def handle(self, *args, **options):
+        limit = options['limit']
+
+        started = time.monotonic()
+        old = ReportGroups(options['old_file'])
+        new = ReportGroups(options['new_file'])
+        parsed = time.monotonic()
+        diff = diff_groups(old, new)
+        finished = time.monotonic()
+
+        self.stdout.write('=== СРАВНЕНИЕ ОТЧЕТОВ ===')
+        for label, report in (('Было', old), ('Стало', new)):
+            self.stdout.write(f'{label}: {report.path} - групп: {len(report)}, подчинённых товаров: {report.slave_count}')
+
+        sections = self.sections(diff)
+        for title, lines in sections:
+            self.stdout.write(f'\n{title}: {len(lines)}')
+            for line in lines[:limit]:
+                self.stdout.write(f'   {line}')
+            if len(lines) > limit:
+                self.stdout.write(f'   ... и еще {len(lines) - limit}')
+
+        self.stdout.write('\n=== ИТОГ ===')
+        self.stdout.write(f'Новых групп: {len(diff.added)}')
+        self.stdout.write(f'Исчезнувших групп: {len(diff.removed)}')
+        self.stdout.write(f'Сменился мастер: {len(diff.master_changed)}')
+        self.stdout.write(f'Изменились подчинённые: {len(diff.slaves_changed)}')
+        self.stdout.write(f'Без изменений: {diff.unchanged}')
+        self.stdout.write(f'Разбор: {parsed - started:.3f} с, сравнение: {finished - parsed:.3f} с')
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(f'Было: {old.path}\nСтало: {new.path}\n')
+                for title, lines in sections:
+                    f.write(f'\n{title}: {len(lines)}\n')
+                    for line in lines:
+                        f.write(f'{line}\n')
+            self.stdout.write(self.style.SUCCESS(f'Различия сохранены в файл: {options["output"]}'))
+
+    def sections(self, diff):
+        def ids(values):
+            return ', '.join(map(str, values)) or '-'
+
+        return [
+            ('Новые группы', [f"'{key}'" for key in diff.added]),
+            ('Исчезнувшие группы', [f"'{key}'" for key in diff.removed]),
+            ('Сменился мастер', [f"'{key}': {old} -> {new}" for key, old, new in diff.master_changed]),
+            ('Изменились подчинённые', [
+                f"'{key}': ушли {ids(gone)}; добавились {ids(came)}" for key, gone, came in diff.slaves_changed
+            ]),
+        ]
+
+
+# python manage.py diff_reports result/preview_merge_142_20250903_192714.txt result/preview_merge_142_20250903_194330.txt
+# python manage.py diff_reports old_plan.jsonl.gz new_plan.jsonl.gz --output plan_diff.txt --limit 50
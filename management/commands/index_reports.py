@@ -0,0 +1,70 @@
+"""
+Поиск запусков, которые затронули товар или артикул, по индексу отчетов.
+
+Команда обновляет индекс (_report_index) по каталогу отчетов - разбираются
+только новые и изменившиеся файлы - и, если указан --item или --article,
+выводит все упоминания: файл, роль товара (мастер/подчинённый/сохранен/удален)
+и строку отчета.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from ._report_index import ReportIndex, read_line
+
+ROLE_LABELS = {
+    'master': 'мастер-товар',
+    'slave': 'подчинённый товар',
+    'kept': 'сохранен',
+    'deleted': 'удален',
+    'duplicate': 'дубликат артикула',
+}
+
+
+class Command(BaseCommand):
+    help = 'Индексирует отчеты и логи дедупликации и ищет, какие запуски затронули товар'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--root', type=str, default='result', help='Каталог с отчетами (по умолчанию: result)')
+        parser.add_argument('--db', type=str, help='Файл индекса (по умолчанию: <root>/.report_index.sqlite3)')
+        parser.add_argument('--item', type=int, action='append', default=[], help='ID товара (можно несколько раз)')
+        parser.add_argument('--article', type=str, action='append', default=[], help='Артикул (можно несколько раз)')
+        parser.add_argument('--full', action='store_true', help='Переиндексировать все файлы')
+        parser.add_argument('--no-update', action='store_true', help='Искать по индексу без обновления')
+
+    def handle(self, *args, **options):
+        with ReportIndex(options['root'], options['db']) as index:
+            if not options['no_update']:
+                started = time.monotonic()
+                stats = index.update(
+                    full=options['full'],
+                    on_file=lambda path, count: self.stdout.write(f'   {path}: {count} записей'),
+                )
+                self.stdout.write(
+                    f'Индекс {index.db_path}: проиндексировано файлов {stats.indexed}, '
+                    f'без изменений {stats.skipped}, удалено {stats.removed}, '
+                    f'записей {stats.entries} ({time.monotonic() - started:.2f} с)'
+                )
+
+            for item_id in options['item']:
+                self.show(f'Товар {item_id}', index.find_item(item_id))
+            for article in options['article']:
+                self.show(f"Артикул '{article}'", index.find_article(article))
+
+    def show(self, title, hits):
+        if not hits:
+            self.stdout.write(self.style.WARNING(f'\n{title}: в отчетах не найден'))
+            return
+        files = len({hit.path for hit in hits})
+        self.stdout.write(self.style.SUCCESS(f'\n{title}: упоминаний {len(hits)} в файлах: {files}'))
+        for hit in hits:
+            self.stdout.write(
+                f'   {hit.path} ({hit.modified:%Y-%m-%d %H:%M}) @{hit.offset}: '
+                f'{ROLE_LABELS[hit.role]}, артикул \'{hit.article}\''
+            )
+            self.stdout.write(f'      {read_line(hit.path, hit.offset)}')
+
+
+# python manage.py index_reports
+# python manage.py index_reports --item 10583447
+# python manage.py index_reports --root result --article 1375258 --no-update
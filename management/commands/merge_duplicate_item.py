@@ -5,12 +5,20 @@
 from datetime import datetime
 
 from django.core.management.base import BaseCommand
-from django.db import transaction
-from django.db.models import Max
+from django.db import DEFAULT_DB_ALIAS, transaction
 from kenny.items.models import Competitor, Item, ItemInfo, ItemInfoHistory
 
+from conf.read_routing import route_reads
 from linked.models import RecommendedLinked
 
+from ._history import copy_history_dedup
+from ._journal import UPDATE, Journal
+from ._normalize import normalizer_for, with_article_key
+from ._plan import lock_plan_items
+from ._progress import ProgressReporter
+from ._routing import choose_read_alias, revalidate_groups
+from ._scoring import RULES, MasterSelector
+
 
 class Command(BaseCommand):
     help = 'Объединяет дубликаты товаров, перенося историю на товар с самой свежей информацией'
@@ -20,12 +28,17 @@ class Command(BaseCommand):
         parser.add_argument('--preview-file', type=str, help='Путь к файлу для сохранения предварительного просмотра')
         parser.add_argument('--article', type=str, help='Конкретный артикул для обработки')
         parser.add_argument('--force', action='store_true', help='Выполнить без подтверждения')
+        parser.add_argument('--master-rule', choices=sorted(RULES), default='latest_info',
+                            help='Правило выбора мастер-товара (по умолчанию: latest_info)')
+        parser.add_argument('--read-from', nargs='?', const='', default=None, metavar='ALIAS',
+                            help='Читать товары для планирования с реплики (без значения - DEDUPE_READ_ALIAS)')
 
     def handle(self, *args, **options):
         competitor_id = options['competitor_id']
         preview_file_path = options.get('preview_file')
         specific_article = options.get('article')
         force = options.get('force', False)
+        master_rule = options['master_rule']
 
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         if not preview_file_path:
@@ -42,77 +55,66 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR(f'Конкурент с ID {competitor_id} не найден'))
             return
 
-        # Получаем все товары конкурента
-        items = Item.objects.filter(competitor=competitor)
-
-        # Если указан конкретный артикул, фильтруем товары
-        if specific_article:
-            self.stdout.write(f'Поиск товаров с артикулом: {specific_article}')
-            items = items.filter(article__icontains=specific_article)
-            self.stdout.write(f'Найдено товаров: {items.count()}')
-
-        # Группируем по нормализованным артикулам в памяти
-        normalized_articles = {}
-        for item in items:
-            normalized_article = item.article.strip().lower()
-            if normalized_article not in normalized_articles:
-                normalized_articles[normalized_article] = []
-            normalized_articles[normalized_article].append(item)
-
-        # Фильтруем только дубликаты
-        duplicate_articles = {k: v for k, v in normalized_articles.items() if len(v) > 1}
-
-        # Если указан конкретный артикул, ищем его нормализованную версию
-        if specific_article:
-            normalized_specific = specific_article.strip().lower()
-            if normalized_specific in duplicate_articles:
-                duplicate_articles = {normalized_specific: duplicate_articles[normalized_specific]}
-                self.stdout.write(
-                    f'Найдены дубликаты для артикула {specific_article}: {len(duplicate_articles[normalized_specific])} товаров')
-            else:
-                self.stdout.write(f'Дубликаты для артикула {specific_article} не найдены')
-                if normalized_specific in normalized_articles:
-                    self.stdout.write(f'Найден 1 товар с артикулом {specific_article}, дубликатов нет')
+        # Группировка и выбор мастеров - с реплики, если указан --read-from;
+        # объединение ниже всегда пишет в default, перепроверив группы в нем
+        read_alias = choose_read_alias(options['read_from'], competitor.id, write=self.stdout.write)
+        with route_reads(read_alias):
+            # Получаем все товары конкурента с ключом нормализованного артикула, посчитанным в БД
+            normalizer = normalizer_for(competitor.id)
+            items = with_article_key(Item.objects.filter(competitor=competitor), competitor.id)
+
+            # Если указан конкретный артикул, фильтруем товары
+            if specific_article:
+                self.stdout.write(f'Поиск товаров с артикулом: {specific_article}')
+                items = items.filter(article_key=normalizer.key(specific_article))
+                self.stdout.write(f'Найдено товаров: {items.count()}')
+
+            # Группируем по нормализованным артикулам
+            normalized_articles = {}
+            for item in items:
+                normalized_article = item.article_key
+                if normalized_article not in normalized_articles:
+                    normalized_articles[normalized_article] = []
+                normalized_articles[normalized_article].append(item)
+
+            # Фильтруем только дубликаты
+            duplicate_articles = {k: v for k, v in normalized_articles.items() if len(v) > 1}
+
+            # Если указан конкретный артикул, ищем его нормализованную версию
+            if specific_article:
+                normalized_specific = normalizer.key(specific_article)
+                if normalized_specific in duplicate_articles:
+                    duplicate_articles = {normalized_specific: duplicate_articles[normalized_specific]}
+                    self.stdout.write(
+                        f'Найдены дубликаты для артикула {specific_article}: {len(duplicate_articles[normalized_specific])} товаров')
                 else:
-                    self.stdout.write(f'Товаров с артикулом {specific_article} не найдено')
-                return
-
-        total_duplicates = len(duplicate_articles)
-        self.stdout.write(f'Найдено артикулов с дубликатами: {total_duplicates}')
-
-        if total_duplicates == 0:
-            self.stdout.write('Нет дубликатов для обработки')
-            return
+                    self.stdout.write(f'Дубликаты для артикула {specific_article} не найдены')
+                    if normalized_specific in normalized_articles:
+                        self.stdout.write(f'Найден 1 товар с артикулом {specific_article}, дубликатов нет')
+                    else:
+                        self.stdout.write(f'Товаров с артикулом {specific_article} не найдено')
+                    return
 
-        # Получаем ID всех товаров, которые могут быть дубликатами
-        all_item_ids = []
-        for items_list in duplicate_articles.values():
-            all_item_ids.extend([item.id for item in items_list])
+            total_duplicates = len(duplicate_articles)
+            self.stdout.write(f'Найдено артикулов с дубликатами: {total_duplicates}')
 
-        # Получаем самую свежую дату обновления для каждого товара
-        latest_info_dates = ItemInfo.objects.filter(
-            item_id__in=all_item_ids,
-        ).values('item_id').annotate(
-            latest_date=Max('analyzed_at'),
-        )
+            if total_duplicates == 0:
+                self.stdout.write('Нет дубликатов для обработки')
+                return
 
-        # Создаем словарь для быстрого доступа
-        latest_date_map = {info['item_id']: info['latest_date'] for info in latest_info_dates}
+            # Выбираем мастер-товар во всех группах сразу; дата последнего
+            # обновления нужна для отчета при любом правиле
+            self.stdout.write(f'Правило выбора мастер-товара: {master_rule}')
+            selector = MasterSelector(master_rule, extra_features=('latest_info_date',))
+            selections = selector.select(duplicate_articles.items())
 
         # Формируем список для объединения
         merge_candidates = []
         detailed_article_info = []
 
-        for article, items_list in duplicate_articles.items():
-            # Добавляем дату последнего обновления к каждому товару
-            for item in items_list:
-                item.latest_date = latest_date_map.get(item.id, item.date_create)
-
-            # Сортируем по дате последнего обновления (по убыванию)
-            sorted_items = sorted(items_list, key=lambda x: x.latest_date, reverse=True)
-
-            master_item = sorted_items[0]
-            slave_items = sorted_items[1:]
+        for article, master_item, slave_items in selections:
+            for item in [master_item] + slave_items:
+                item.latest_date = selector.value('latest_info_datetime', item)
 
             merge_candidates.append((master_item, slave_items))
 
@@ -157,11 +159,21 @@ class Command(BaseCommand):
         # Шаг 3: Объединение данных
         self.stdout.write('Начинаем объединение...')
 
+        # Снимки изменяемых строк для отмены запуска командой undo_run
+        journal = Journal('merge_duplicate_item', competitor.id)
+        self.stdout.write(f'Журнал запуска: {journal.run_id}')
+
         with transaction.atomic():
+            if read_alias != DEFAULT_DB_ALIAS:
+                merge_candidates = self.revalidate(competitor, merge_candidates)
+
             total_merged = 0
+            total_history_skipped = 0
             results = []
+            progress = ProgressReporter(self.stdout.write, 'merge_duplicate_item', total=len(merge_candidates),
+                                        unit='артикулов', labels={'competitor': competitor_id})
 
-            for i, (master_item, slave_items) in enumerate(merge_candidates):
+            for master_item, slave_items in merge_candidates:
                 # Сохраняем информацию ДО объединения
                 master_before = {
                     'history_count': ItemInfoHistory.objects.filter(item=master_item).count(),
@@ -178,26 +190,19 @@ class Command(BaseCommand):
                         'info_count': ItemInfo.objects.filter(item=slave_item).count(),
                     })
 
-                for slave_item in slave_items:
-                    # ВАЖНОЕ ИЗМЕНЕНИЕ: Сначала получаем все записи истории подчиненного товара
-                    slave_history = list(ItemInfoHistory.objects.filter(item=slave_item))
-
-                    # Переносим каждую запись истории по отдельности
-                    for history_item in slave_history:
-                        # Создаем новую запись истории для мастера
-                        ItemInfoHistory.objects.create(
-                            item=master_item,
-                            analyzed_at=history_item.analyzed_at,
-                            url=history_item.url,
-                            catalog_url=history_item.catalog_url,
-                            prices=history_item.prices,
-                            competitor=history_item.competitor,
-                            available_type=history_item.available_type,
-                            item_info=history_item.item_info,
-                        )
+                # Копируем историю всех подчиненных одним запросом на стороне БД,
+                # пропуская снимки, которые у мастера уже есть
+                history_ids, history_skipped = copy_history_dedup(
+                    [slave_item.id for slave_item in slave_items], master_item.id,
+                )
+                journal.record_inserts(ItemInfoHistory, history_ids)
+                total_history_skipped += history_skipped
 
+                for slave_item in slave_items:
                     # Перенос рекомендаций
-                    recommendations_count = RecommendedLinked.objects.filter(item=slave_item).update(item=master_item)
+                    slave_recommendations = RecommendedLinked.objects.filter(item=slave_item)
+                    journal.capture_queryset(UPDATE, slave_recommendations)
+                    recommendations_count = slave_recommendations.update(item=master_item)
 
                     # Перенос актуальной информации
                     slave_infos = ItemInfo.objects.filter(item=slave_item).order_by('-analyzed_at')
@@ -217,11 +222,12 @@ class Command(BaseCommand):
                                 master_info.catalog_url = newest_slave_info.catalog_url
                                 master_info.prices = newest_slave_info.prices
                                 master_info.available_type = newest_slave_info.available_type
+                                journal.capture_ids(UPDATE, ItemInfo, [master_info.pk])
                                 master_info.save()
                         else:
                             # Если записи нет, создаем новую на основе самой новой информации подчиненного
                             newest_slave_info = slave_infos.first()
-                            ItemInfo.objects.create(
+                            master_info = ItemInfo.objects.create(
                                 competitor=master_item.competitor,
                                 item=master_item,
                                 analyzed_at=newest_slave_info.analyzed_at,
@@ -230,6 +236,7 @@ class Command(BaseCommand):
                                 prices=newest_slave_info.prices,
                                 available_type=newest_slave_info.available_type,
                             )
+                            journal.record_inserts(ItemInfo, [master_info.pk])
 
                     # Удаляем все записи ItemInfo для подчиненного товара
                     # ItemInfo.objects.filter(item=slave_item).delete()
@@ -238,6 +245,7 @@ class Command(BaseCommand):
                     # ItemInfoHistory.objects.filter(item=slave_item).delete()
 
                     # Удаление подчинённого товара
+                    journal.capture_delete(Item, [slave_item.id])
                     slave_item.delete()
                     total_merged += 1
 
@@ -254,12 +262,17 @@ class Command(BaseCommand):
                     'slaves_before': slaves_before,
                     'master_before': master_before,
                     'master_after': master_after,
+                    'history_skipped': history_skipped,
                 })
 
-                # Выводим прогресс
-                self.stdout.write(f'Объединено артикулов: {i + 1}/{len(merge_candidates)}')
+                progress.update(1, Объединено_товаров=total_merged)
+
+            progress.finish()
+        journal.finish()
 
         self.stdout.write(self.style.SUCCESS(f'Все дубликаты успешно объединены! Объединено товаров: {total_merged}'))
+        self.stdout.write(f'Отменить объединение: python manage.py undo_run --run {journal.run_id}')
+        self.stdout.write(f'Пропущено дубликатов истории: {total_history_skipped}')
 
         # Шаг 4: Проверка результатов и вывод истории
         self.stdout.write('\nПроверка результатов объединения и вывод истории...')
@@ -270,7 +283,8 @@ class Command(BaseCommand):
                 f.write('=== РЕЗУЛЬТАТЫ ОБЪЕДИНЕНИЯ ДУБЛИКАТОВ ===\n\n')
                 f.write(f'Конкурент: {competitor.name}\n')
                 f.write(f'Дата формирования отчета: {datetime.now()}\n\n')
-                f.write(f'Всего объединено товаров: {total_merged}\n\n')
+                f.write(f'Всего объединено товаров: {total_merged}\n')
+                f.write(f'Пропущено дубликатов истории: {total_history_skipped}\n\n')
 
                 for result in results:
                     master_item = result['master_item']
@@ -295,9 +309,11 @@ class Command(BaseCommand):
                     f.write(f"{result['master_after']['recommendations_count']} рекомендаций, ")
                     f.write(f"{result['master_after']['info_count']} записей информации\n")
 
-                    # Проверяем, что история была перенесена
+                    # Проверяем, что история была перенесена (без уже имевшихся у мастера снимков)
                     expected_history = result['master_before']['history_count'] + sum(
-                        s['history_count'] for s in result['slaves_before'])
+                        s['history_count'] for s in result['slaves_before']) - result['history_skipped']
+                    if result['history_skipped']:
+                        f.write(f"  Пропущено дубликатов истории: {result['history_skipped']}\n")
                     if result['master_after']['history_count'] == expected_history:
                         f.write(f'  ✓ История успешно перенесена: {expected_history} записей\n')
                     else:
@@ -325,7 +341,7 @@ class Command(BaseCommand):
             for result in results:
                 master_item = result['master_item']
                 expected = result['master_before']['history_count'] + sum(
-                    s['history_count'] for s in result['slaves_before'])
+                    s['history_count'] for s in result['slaves_before']) - result['history_skipped']
                 actual = result['master_after']['history_count']
 
                 self.stdout.write(f'Товар {master_item.id} ({master_item.article}):')
@@ -340,5 +356,30 @@ class Command(BaseCommand):
         except Exception as e:
             self.stdout.write(self.style.ERROR(f'Ошибка при записи результатов: {e}'))
 
+    def revalidate(self, competitor, merge_candidates):
+        """Группы, выбранные по реплике, без изменившихся в default.
+
+        Вызывается в транзакции объединения: товары групп блокируются, и до ее
+        конца мастер и ключи артикулов не изменятся.
+        """
+        self.stdout.write(f'Проверка {len(merge_candidates)} групп в {DEFAULT_DB_ALIAS} (выбраны по реплике)...')
+        lock_plan_items([item.id for master_item, slave_items in merge_candidates
+                         for item in [master_item] + slave_items])
+        valid_groups, skipped = revalidate_groups(competitor.id, [
+            (master_item.article_key, master_item.id, [item.id for item in slave_items])
+            for master_item, slave_items in merge_candidates
+        ])
+        if skipped:
+            self.stdout.write(self.style.WARNING(
+                f'Пропущено групп: {skipped} (мастер удален или артикул изменился в {DEFAULT_DB_ALIAS})'))
+
+        remaining = {master_id: set(slave_ids) for _, master_id, slave_ids in valid_groups if slave_ids}
+        return [
+            (master_item, [item for item in slave_items if item.id in remaining[master_item.id]])
+            for master_item, slave_items in merge_candidates
+            if master_item.id in remaining
+        ]
+
 # python manage.py merge_duplicate_item 142 --article 1375258
 # python manage.py merge_duplicate_item 142 --article 2081057 --force
+# python manage.py merge_duplicate_item 142 --read-from backup
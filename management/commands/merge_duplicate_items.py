@@ -1,9 +1,20 @@
 from datetime import datetime
 
 from django.core.management.base import BaseCommand
-from django.db.models import Count
+from django.db import DEFAULT_DB_ALIAS
 from kenny.items.models import Competitor, Item
 
+from conf.read_routing import route_reads
+
+from ._normalize import with_article_key
+from ._plan import PlanGroup, compute_fingerprint, fingerprint_count, plan_item_ids, write_plan
+from ._batching import DEFAULT_TARGET_SECONDS, AdaptiveBatcher
+from ._grouping import BACKENDS, DEFAULT_MEMORY_BUDGET_MB, group_duplicates
+from ._progress import ProgressReporter, estimate_count
+from ._records import MemoryReport, iter_item_records
+from ._routing import choose_read_alias, revalidate_groups
+from ._scoring import RULES, MasterSelector
+
 
 class Command(BaseCommand):
     help = 'Объединяет дубликаты товаров, перенося историю на товар с наибольшим количеством записей'
@@ -11,14 +22,31 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('competitor_id', type=int, help='ID конкурента')
         parser.add_argument('--preview-file', type=str, help='Путь к файлу для сохранения предварительного просмотра')
-        parser.add_argument('--batch-size', type=int, default=500, help='Размер батча для обработки')
+        parser.add_argument('--batch-size', type=int, default=500, help='Начальный размер батча для обработки')
+        parser.add_argument('--target-latency', type=float, default=DEFAULT_TARGET_SECONDS,
+                            help='Целевое время одной пачки, секунд: размер пачки подстраивается под него '
+                                 f'и нагрузку на БД; 0 - фиксированный размер (по умолчанию: {DEFAULT_TARGET_SECONDS})')
         parser.add_argument('--limit', type=int, help='Ограничение количества обрабатываемых артикулов')
+        parser.add_argument('--master-rule', choices=sorted(RULES), default='most_history',
+                            help='Правило выбора мастер-товара (по умолчанию: most_history)')
+        parser.add_argument('--plan-file', type=str,
+                            help='Сохранить результат как план для dedupe_apply (.jsonl или .jsonl.gz)')
+        parser.add_argument('--read-from', nargs='?', const='', default=None, metavar='ALIAS',
+                            help='Читать товары для планирования с реплики (без значения - DEDUPE_READ_ALIAS)')
+        parser.add_argument('--memory-report', action='store_true',
+                            help='Показать пиковый RSS процесса по этапам сканирования и выбора мастеров')
+        parser.add_argument('--grouping', choices=BACKENDS, default='memory',
+                            help='Группировка в памяти или внешней сортировкой с диском (по умолчанию: memory)')
+        parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET_MB,
+                            help=f'Память под пачку внешней сортировки, МБ (по умолчанию: {DEFAULT_MEMORY_BUDGET_MB})')
 
     def handle(self, *args, **options):
         competitor_id = options['competitor_id']
         preview_file_path = options.get('preview_file')
         batch_size = options.get('batch_size', 500)
         limit = options.get('limit')
+        master_rule = options['master_rule']
+        plan_file_path = options.get('plan_file')
 
         if not preview_file_path:
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -35,76 +63,73 @@ class Command(BaseCommand):
 
         # Шаг 1: Находим артикулы с дубликатами
         self.stdout.write('Поиск артикулов с дубликатами...')
-
-        # Получаем все товары конкурента
-        items = Item.objects.filter(competitor=competitor)
-
-        # Группируем по нормализованным артикулам в памяти
-        normalized_articles = {}
-        for item in items:
-            # Нормализуем артикул в Python
-            normalized_article = item.article.strip().lower()
-            if normalized_article not in normalized_articles:
-                normalized_articles[normalized_article] = []
-            normalized_articles[normalized_article].append(item)
-
-        # Фильтруем только дубликаты
-        duplicate_articles = {k: v for k, v in normalized_articles.items() if len(v) > 1}
-
-        if limit:
-            # Берем только первые limit артикулов
-            duplicate_articles = dict(list(duplicate_articles.items())[:limit])
-
-        total_duplicates = len(duplicate_articles)
-        self.stdout.write(f'Найдено артикулов с дубликатами: {total_duplicates}')
-
-        if total_duplicates == 0:
-            self.stdout.write('Нет дубликатов для обработки')
-            return
-
-        # Шаг 2: Для каждого артикула определяем товар с наибольшей историей
-        self.stdout.write('Определение товаров с наибольшей историей...')
-
-        merge_candidates = []
-        detailed_article_info = []
-
-        # Получаем ID всех товаров, которые могут быть дубликатами
-        all_item_ids = []
-        for items_list in duplicate_articles.values():
-            all_item_ids.extend([item.id for item in items_list])
-
-        # Получаем количество истории для каждого товара одним запросом
-        items_with_history = Item.objects.filter(id__in=all_item_ids).annotate(
-            history_count=Count('history_info'),
-        )
-
-        # Создаем словарь для быстрого доступа
-        history_count_map = {item.id: item.history_count for item in items_with_history}
+        memory = MemoryReport(self.stdout.write, options['memory_report'])
+        memory.checkpoint('до сканирования')
+
+        # Сканирование и выбор мастеров - только чтение, с --read-from идут на реплику
+        read_alias = choose_read_alias(options['read_from'], competitor.id, write=self.stdout.write)
+        with route_reads(read_alias):
+            # Получаем все товары конкурента
+            items = with_article_key(Item.objects.filter(competitor=competitor), competitor.id)
+
+            # Группируем по нормализованным артикулам (в памяти или внешней сортировкой, см. _grouping)
+            progress = ProgressReporter(self.stdout.write, 'merge_duplicate_items', total=estimate_count(items),
+                                        unit='товаров', labels={'competitor': competitor_id, 'phase': 'scan'})
+            # Компактные записи вместо экземпляров Item (см. _records)
+            records = iter_item_records(items, chunk_size=batch_size)
+            duplicate_articles, grouping_stats = group_duplicates(
+                self.tracked(records, progress), options['grouping'], options['memory_budget'])
+            progress.finish()
+            if grouping_stats.runs:
+                self.stdout.write(f'Пачек внешней сортировки: {grouping_stats.runs} '
+                                  f'({grouping_stats.spilled_bytes / 1024 / 1024:.1f} МБ на диске)')
+            memory.checkpoint('после группировки')
+
+            if limit:
+                # Берем только первые limit артикулов
+                duplicate_articles = dict(list(duplicate_articles.items())[:limit])
+
+            total_duplicates = len(duplicate_articles)
+            self.stdout.write(f'Найдено артикулов с дубликатами: {total_duplicates}')
+
+            if total_duplicates == 0:
+                self.stdout.write('Нет дубликатов для обработки')
+                return
+
+            # Шаг 2: Для каждого артикула определяем мастер-товар
+            self.stdout.write(f'Определение мастер-товаров (правило: {master_rule})...')
+
+            merge_candidates = []
+            detailed_article_info = []
+
+            # Количество истории считается групповыми запросами по пачкам ID
+            # (размер подстраивается под --target-latency) и нужно для отчета при любом правиле
+            batcher = AdaptiveBatcher(batch_size, options['target_latency'], write=self.stdout.write,
+                                      label='признаки', using=read_alias)
+            selector = MasterSelector(master_rule, chunk_size=batch_size, extra_features=('history_count',),
+                                      batcher=batcher)
+            selections = selector.select(duplicate_articles.items())
+            batcher.finish()
+        progress = ProgressReporter(self.stdout.write, 'merge_duplicate_items', total=total_duplicates,
+                                    unit='артикулов', labels={'competitor': competitor_id, 'phase': 'select'})
 
         # Формируем список для объединения
-        for article, items_list in duplicate_articles.items():
-            # Добавляем количество истории к каждому товару
-            for item in items_list:
-                item.history_count = history_count_map.get(item.id, 0)
-
-            # Сортируем по количеству истории (по убыванию)
-            sorted_items = sorted(items_list, key=lambda x: x.history_count, reverse=True)
-
-            master_item = sorted_items[0]
-            slave_items = sorted_items[1:]
-
+        for article, master_item, slave_items in selections:
             merge_candidates.append((master_item, slave_items))
 
             # Добавляем информацию для отчета
             detailed_article_info.append(f"Артикул: '{article}'")
-            detailed_article_info.append(f'Мастер-товар: {master_item.id} (историй: {master_item.history_count})')
+            detailed_article_info.append(
+                f"Мастер-товар: {master_item.id} (историй: {selector.value('history_count', master_item)})")
             for item in slave_items:
-                detailed_article_info.append(f'Подчинённый товар: {item.id} (историй: {item.history_count})')
+                detailed_article_info.append(
+                    f"Подчинённый товар: {item.id} (историй: {selector.value('history_count', item)})")
             detailed_article_info.append('')
 
-            # Выводим прогресс
-            if len(merge_candidates) % 100 == 0:
-                self.stdout.write(f'Обработано артикулов: {len(merge_candidates)}/{total_duplicates}')
+            progress.update(1)
+        progress.finish()
+        memory.checkpoint('после выбора мастер-товаров')
+        memory.finish()
 
         # Запись предварительного просмотра
         try:
@@ -122,6 +147,37 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR(f'Ошибка при записи файла: {e}'))
             return
 
+        # Сохраняем вычисленный результат как план, чтобы не группировать заново при применении
+        if plan_file_path:
+            groups = [
+                PlanGroup(master_item.article_key, master_item.id, [item.id for item in slave_items])
+                for master_item, slave_items in merge_candidates
+            ]
+            if read_alias != DEFAULT_DB_ALIAS:
+                # План по реплике: группы перепроверяются в default, куда его применит dedupe_apply
+                valid_groups, skipped = revalidate_groups(competitor.id, groups)
+                groups = [PlanGroup(*group) for group in valid_groups if group[2]]
+                if skipped:
+                    self.stdout.write(self.style.WARNING(
+                        f'Пропущено групп: {skipped} (мастер удален или артикул изменился в {DEFAULT_DB_ALIAS})'))
+            plan_ids = plan_item_ids(groups)
+            fingerprint = compute_fingerprint(plan_ids)
+            if fingerprint_count(fingerprint) != len(plan_ids):
+                self.stdout.write(self.style.ERROR(
+                    f'План не сохранен: товаров плана в {DEFAULT_DB_ALIAS} {fingerprint_count(fingerprint)} '
+                    f'из {len(plan_ids)} - товары изменились во время построения'))
+                return
+            write_plan(plan_file_path, {
+                'competitor_id': competitor.id,
+                'competitor_name': competitor.name,
+                'master_rule': master_rule,
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'fingerprint': fingerprint,
+                'groups': len(groups),
+                'slaves': sum(len(group.slaves) for group in groups),
+            }, groups)
+            self.stdout.write(self.style.SUCCESS(f'План сохранен в: {plan_file_path}'))
+
         # Подтверждение выполнения
         # confirm = input(f"Вы уверены, что хотите объединить {len(merge_candidates)} артикулов? (y/n): ")
         # if confirm.lower() != 'y':
@@ -151,7 +207,16 @@ class Command(BaseCommand):
         #
         # self.stdout.write(self.style.SUCCESS(f"Все дубликаты успешно объединены! Объединено товаров: {total_merged}"))
 
+    def tracked(self, records, progress):
+        """Записи без изменений, с обновлением прогресса по мере чтения."""
+        for record in records:
+            progress.update(1)
+            yield record
+
 
 # Запустите команду:
 # python manage.py merge_duplicate_items 1  # где 1 - ID конкурента
 # python manage.py merge_duplicate_items 142  # где 142 - ID Комус
+# python manage.py merge_duplicate_items 142 --read-from  # чтения с реплики DEDUPE_READ_ALIAS
+# python manage.py merge_duplicate_items 142 --memory-report  # расход памяти по этапам
+# python manage.py merge_duplicate_items 142 --grouping external --memory-budget 128
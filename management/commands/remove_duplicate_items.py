@@ -12,7 +12,8 @@
 сопоставлению товаров и анализу цен.
 
 АЛГОРИТМ РАБОТЫ:
-1. Группировка товаров по нормализованному артикулу (без пробелов по краям)
+1. Группировка товаров по нормализованному артикулу (_normalize: пробелы,
+   невидимые и полноширинные символы, правила конкурента)
 2. Поиск артикулов с дубликатами (> 1 товара)
 3. Для каждой группы дубликатов:
    - При наличии товара с пробелом в начале: оставить его, удалить остальные
@@ -27,11 +28,36 @@
 РЕЖИМЫ РАБОТЫ:
 --dry-run     : Предварительный просмотр без реального удаления
 --output      : Сохранение детального отчета в файл
+--estimate    : Оценка затрат без удаления: строк по таблицам с учетом каскада,
+                объем освобождаемых данных и WAL, ориентировочное время
+--incremental : Проверка только товаров, созданных после прошлого успешного
+                запуска (водяная отметка по date_create), и товаров с теми же
+                нормализованными артикулами - через частичный индекс по
+                выражению (см. _incremental)
+--memory-report: Пиковый RSS процесса по этапам загрузки и группировки
+--grouping    : memory (по умолчанию) или external - внешняя сортировка:
+                пачки по --memory-budget МБ сбрасываются во временные файлы
+                и сливаются (см. _grouping) - для конкурентов, не
+                помещающихся в память
+--partition P/N : Только часть P из N по хешу ключа артикула - группы
+                дубликатов не разрываются между частями (dedupe_worker)
+--force       : Удаление без подтверждения
+--lock-timeout / --statement-timeout / --retries : Таймауты пачки удаления;
+                после --retries повторов пачка делится пополам, неудаленные ID
+                пишутся в --failed-batches (JSONL), остальное удаляется (см. _guarded)
+--target-latency : Целевое время пачки удаления (начальный размер - --batch-size):
+                пачка растет или уменьшается, а при ожиданиях блокировок и
+                отставании реплик уменьшается вдвое (см. _batching)
+--read-from   : Чтение товаров и признаков для анализа с реплики (DEDUPE_READ_ALIAS
+                или указанный алиас), если она не отстает; удаление - в default,
+                перед ним группы перечитываются в default и пропускаются, если
+                сохраняемого товара там нет или ключ артикула изменился
 Без параметров: Реальное выполнение удаления с подтверждением
 
 МЕРЫ ПРЕДОСТОРОЖНОСТИ:
 - Требует подтверждения перед удалением
 - Создает резервную копию в виде отчета
+- Пишет журнал удаленных строк: запуск отменяется командой undo_run
 - Предоставляет возможность предварительного просмотра (dry-run)
 - Точечно удаляет только дубликаты, не затрагивая уникальные товары
 
@@ -55,10 +81,36 @@
 
 import os
 import sys
+import time
 from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
 from kenny.items.models import Competitor, Item
 from datetime import datetime
 
+from conf.read_routing import route_reads
+
+from ._batching import DEFAULT_TARGET_SECONDS, AdaptiveBatcher
+from ._cascade import (
+    can_fast_delete, cascade_graph, count_cascade, estimate_volume, fast_delete, load_throughput, save_throughput,
+)
+from ._grouping import BACKENDS, DEFAULT_MEMORY_BUDGET_MB, group_duplicates
+from ._guarded import DEFAULT_LOCK_TIMEOUT, DEFAULT_RETRIES, DEFAULT_STATEMENT_TIMEOUT, GuardedBatches
+from ._incremental import (
+    current_watermark, delta_group_item_ids, ensure_article_key_index, get_watermark, save_watermark,
+)
+from ._journal import Journal
+from ._normalize import parse_partition, with_article_key, with_key_partition
+from ._progress import ProgressReporter
+from ._records import MemoryReport, iter_item_records, load_item_records, load_names
+from ._routing import choose_read_alias, revalidate_groups
+from ._scoring import RULES, MasterSelector
+
+# Файл со скоростью удаления последних запусков (для --estimate)
+THROUGHPUT_FILENAME = 'remove_duplicate_items_throughput.json'
+
+# Имя задачи для водяной отметки --incremental
+WATERMARK_JOB = 'remove_duplicate_items'
+
 
 class Command(BaseCommand):
     help = 'Удаляет дубликаты товаров по артикулу у указанного конкурента, оставляя товар с пробелом в начале артикула'
@@ -67,6 +119,39 @@ class Command(BaseCommand):
         parser.add_argument('competitor_id', type=int, help='ID конкурента')
         parser.add_argument('--dry-run', action='store_true', help='Только показать что будет удалено, без удаления')
         parser.add_argument('--output', action='store_true', help='Сохранить отчет в файл в корне проекта')
+        parser.add_argument('--estimate', action='store_true',
+                            help='Оценить объем каскадного удаления и время выполнения, без удаления')
+        parser.add_argument('--orm-delete', action='store_true',
+                            help='Удалять через Django Collector вместо быстрого set-based удаления')
+        parser.add_argument('--master-rule', choices=sorted(RULES), default='leading_space',
+                            help='Правило выбора сохраняемого товара (по умолчанию: leading_space)')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Проверять только товары, созданные после прошлого запуска, и их группы')
+        parser.add_argument('--read-from', nargs='?', const='', default=None, metavar='ALIAS',
+                            help='Читать товары для анализа с реплики (без значения - DEDUPE_READ_ALIAS)')
+        parser.add_argument('--memory-report', action='store_true',
+                            help='Показать пиковый RSS процесса по этапам загрузки и группировки')
+        parser.add_argument('--grouping', choices=BACKENDS, default='memory',
+                            help='Группировка в памяти или внешней сортировкой с диском (по умолчанию: memory)')
+        parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET_MB,
+                            help=f'Память под пачку внешней сортировки, МБ (по умолчанию: {DEFAULT_MEMORY_BUDGET_MB})')
+        parser.add_argument('--partition', type=str, metavar='P/N',
+                            help='Только часть P из N по хешу ключа артикула (для dedupe_worker)')
+        parser.add_argument('--force', action='store_true', help='Удалить без подтверждения')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Начальный размер пачки удаления (по умолчанию: 1000)')
+        parser.add_argument('--target-latency', type=float, default=DEFAULT_TARGET_SECONDS,
+                            help='Целевое время одной пачки, секунд: размер пачки подстраивается под него '
+                                 f'и нагрузку на БД; 0 - фиксированный размер (по умолчанию: {DEFAULT_TARGET_SECONDS})')
+        parser.add_argument('--lock-timeout', type=float, default=DEFAULT_LOCK_TIMEOUT,
+                            help=f'lock_timeout пачки удаления, секунд (по умолчанию: {DEFAULT_LOCK_TIMEOUT:g})')
+        parser.add_argument('--statement-timeout', type=float, default=DEFAULT_STATEMENT_TIMEOUT,
+                            help=f'statement_timeout пачки удаления, секунд (по умолчанию: {DEFAULT_STATEMENT_TIMEOUT:g})')
+        parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                            help=f'Повторов пачки после таймаута до ее разбиения (по умолчанию: {DEFAULT_RETRIES})')
+        parser.add_argument('--failed-batches', type=str, metavar='FILE',
+                            help='JSONL-файл для неудавшихся пачек (по умолчанию: '
+                                 'failed_batches_remove_duplicate_items_<ID>_<время>.jsonl в корне проекта)')
 
     def safe_input(self, prompt):
         """Безопасный ввод с обработкой проблем кодировки"""
@@ -84,6 +169,26 @@ class Command(BaseCommand):
         competitor_id = options['competitor_id']
         dry_run = options['dry_run']
         save_output = options['output']
+        master_rule = options['master_rule']
+        estimate = options['estimate']
+        orm_delete = options['orm_delete']
+        incremental = options['incremental']
+        grouping = options['grouping']
+        memory_budget = options['memory_budget']
+        partition = None
+        if options['partition']:
+            try:
+                partition = parse_partition(options['partition'])
+            except ValueError as e:
+                self.stdout.write(self.style.ERROR(f'Неверный --partition: {e}'))
+                return
+            if incremental:
+                self.stdout.write(self.style.ERROR('--partition не используется вместе с --incremental'))
+                return
+
+        # Корень Django проекта - туда пишутся отчеты и статистика скорости
+        base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        throughput_file = os.path.join(base_dir, THROUGHPUT_FILENAME)
 
         self.stdout.write('=== НАЧАЛО ПРОЦЕДУРЫ УДАЛЕНИЯ ДУБЛИКАТОВ ПО АРТИКУЛУ ===')
         if dry_run:
@@ -98,78 +203,101 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR(f'Конкурент с ID {competitor_id} не найден'))
             return
 
-        # Шаг 2: Получение всех товаров конкурента
-        self.stdout.write('2. Получение всех товаров конкурента...')
-        items = list(Item.objects.filter(competitor=competitor))
-        self.stdout.write(self.style.SUCCESS(f'   Всего товаров у конкурента: {len(items)}'))
-
-        # Шаг 3: Нормализация артикула и группировка
-        self.stdout.write('3. Нормализация и группировка товаров по артикулу...')
-        normalized_articles = {}
-        article_variations = {}  # Для отслеживания всех вариантов написания
-
-        for item in items:
-            # Нормализуем артикул - убираем пробелы с обеих сторон для группировки
-            normalized_article = item.article.strip() if item.article else ''
-
-            if not normalized_article:
-                continue  # Пропускаем товары без артикула
-
-            if normalized_article not in normalized_articles:
-                normalized_articles[normalized_article] = []
-                article_variations[normalized_article] = set()
-
-            normalized_articles[normalized_article].append(item)
-            # Сохраняем оригинальное написание для анализа пробелов
-            article_variations[normalized_article].add(item.article)
+        # Чтения для анализа - с реплики (--read-from); --incremental читает из
+        # default, чтобы отметка новых товаров не опережала данные
+        read_alias = None
+        if options['read_from'] is not None:
+            if incremental:
+                self.stdout.write(self.style.WARNING('   --read-from не используется вместе с --incremental'))
+            else:
+                read_alias = choose_read_alias(options['read_from'], competitor.id, write=self.stdout.write)
+
+        memory = MemoryReport(self.stdout.write, options['memory_report'])
+        memory.checkpoint('до загрузки товаров')
+
+        # Шаг 2: Получение товаров конкурента (всех или только затронутых новыми товарами).
+        # Товары читаются компактными записями (_records), а не экземплярами Item;
+        # полный обход читается потоком прямо в группировку
+        next_watermark = None
+        if incremental:
+            self.stdout.write('2. Получение новых товаров и их групп (--incremental)...')
+            items, next_watermark = self.load_incremental_items(competitor)
+            self.stdout.write(self.style.SUCCESS(f'   Товаров для проверки: {len(items)}'))
+        else:
+            self.stdout.write('2. Получение всех товаров конкурента...')
+            queryset = Item.objects.filter(competitor=competitor)
+            if partition:
+                self.stdout.write(f'   Часть {partition[0]} из {partition[1]} по хешу ключа артикула')
+                queryset = with_key_partition(queryset, competitor.id, *partition)
+            items = iter_item_records(with_article_key(queryset, competitor.id))
+
+        # Шаг 3: Группировка по ключу артикула, посчитанному в БД по правилам
+        # конкурента (см. _normalize); товары без артикула пропускаются
+        self.stdout.write(f'3. Группировка товаров по артикулу (бэкенд: {grouping})...')
+        with route_reads(read_alias):
+            duplicate_articles, grouping_stats = group_duplicates(
+                items, grouping, memory_budget, skip_empty=True, on_spill=self.report_spill)
+        del items
+        if not incremental:
+            self.stdout.write(self.style.SUCCESS(f'   Всего товаров у конкурента: {grouping_stats.items}'))
+        if grouping_stats.runs:
+            self.stdout.write(f'   Пачек сброшено на диск: {grouping_stats.runs} '
+                              f'({grouping_stats.spilled_bytes / 1024 / 1024:.1f} МБ)')
+        memory.checkpoint(f'после группировки {grouping_stats.items} товаров')
+
+        # Оригинальные написания артикула - для анализа пробелов
+        article_variations = {article: {item.article for item in lst} for article, lst in duplicate_articles.items()}
 
         # Шаг 4: Поиск дубликатов
-        duplicate_articles = {article: lst for article, lst in normalized_articles.items() if len(lst) > 1}
         self.stdout.write(f'4. Найдено артикулов с дубликатами: {len(duplicate_articles)}')
 
         if not duplicate_articles:
             self.stdout.write('Дубликатов не найдено.')
+            memory.finish()
+            if next_watermark and not dry_run and not estimate:
+                self.advance_watermark(competitor, next_watermark)
             return
 
+        # Названия нужны только отчету - подгружаются для товаров из групп дубликатов
+        if save_output:
+            with route_reads(read_alias):
+                load_names([item for lst in duplicate_articles.values() for item in lst])
+
         items_to_delete = []
         report_data = []
+        # (ключ артикула, ID сохраняемого, ID к удалению) - для перепроверки в default
+        planned_groups = []
 
         # Шаг 5: Для каждого дублирующего артикула определяем что удалять
-        self.stdout.write('5. Анализ дубликатов...')
-        for article, duplicates_list in duplicate_articles.items():
-            # Ищем товар С пробелом в начале артикула (который нужно оставить)
-            items_with_leading_space = []
-            items_without_leading_space = []
-
-            for item in duplicates_list:
-                if item.article and item.article.startswith(' '):
-                    items_with_leading_space.append(item)
-                else:
-                    items_without_leading_space.append(item)
+        self.stdout.write(f'5. Анализ дубликатов (правило выбора: {master_rule})...')
+        selector = MasterSelector(master_rule)
+        with route_reads(read_alias):
+            selections = selector.select(duplicate_articles.items())
+        for article, item_to_keep, other_items in selections:
+            duplicates_list = duplicate_articles[article]
+            keep_has_space = bool(item_to_keep.article) and item_to_keep.article.startswith(' ')
 
             # Логика удаления:
-            # 1. Если есть товар с пробелом - оставляем его, удаляем все без пробела
-            # 2. Если нет товара с пробелом, но есть несколько без пробела - оставляем самый новый
-
-            if items_with_leading_space:
-                # Оставляем первый товар с пробелом (обычно он один)
-                item_to_keep = items_with_leading_space[0]
-                items_to_delete.extend(items_without_leading_space)
+            # 1. Если сохраняется товар с пробелом - удаляем только товары без пробела
+            # 2. Иначе удаляем все товары, кроме выбранного правилом
+            if master_rule == 'leading_space' and keep_has_space:
+                delete_list = [item for item in other_items if not (item.article and item.article.startswith(' '))]
                 delete_reason = "не имеет пробела в начале артикула"
-            else:
-                # Если все товары без пробела в начале, оставляем самый новый
-                sorted_items = sorted(duplicates_list, key=lambda x: x.date_create, reverse=True)
-                item_to_keep = sorted_items[0]
-                items_to_delete.extend(sorted_items[1:])
+            elif master_rule == 'leading_space':
+                delete_list = other_items
                 delete_reason = "более старый товар без пробела в артикуле"
+            else:
+                delete_list = other_items
+                delete_reason = f"не выбран правилом {master_rule}"
+            items_to_delete.extend(delete_list)
+            planned_groups.append((article, item_to_keep.id, [item.id for item in delete_list]))
 
             # Собираем информацию для отчета
             variations = list(article_variations[article])
             report_entry = {
                 'article': article,
                 'total_count': len(duplicates_list),
-                'delete_count': len(items_without_leading_space) if items_with_leading_space else len(
-                    duplicates_list) - 1,
+                'delete_count': len(delete_list),
                 'variations': variations,
                 'keep_item': {
                     'id': item_to_keep.id,
@@ -184,28 +312,27 @@ class Command(BaseCommand):
             }
 
             # Добавляем товары для удаления в отчет
-            for item in items_without_leading_space if items_with_leading_space else duplicates_list[1:]:
-                if item.id != item_to_keep.id:  # Убедимся, что не добавляем товар для сохранения
-                    report_entry['delete_items'].append({
-                        'id': item.id,
-                        'article': item.article,
-                        'date_create': item.date_create,
-                        'name': item.name[:50] + '...' if item.name and len(item.name) > 50 else item.name,
-                        'has_leading_space': item.article.startswith(' ') if item.article else False,
-                        'reason': "не имеет пробела в начале артикула" if item.article and not item.article.startswith(
-                            ' ') else "более старый товар"
-                    })
+            for item in delete_list:
+                report_entry['delete_items'].append({
+                    'id': item.id,
+                    'article': item.article,
+                    'date_create': item.date_create,
+                    'name': item.name[:50] + '...' if item.name and len(item.name) > 50 else item.name,
+                    'has_leading_space': item.article.startswith(' ') if item.article else False,
+                    'reason': "не имеет пробела в начале артикула" if item.article and not item.article.startswith(
+                        ' ') else "более старый товар"
+                })
 
             report_data.append(report_entry)
 
         self.stdout.write(self.style.SUCCESS(f'   Проанализировано дубликатов: {len(duplicate_articles)}'))
         self.stdout.write(self.style.SUCCESS(f'   Товаров к удалению: {len(items_to_delete)}'))
+        memory.checkpoint('после выбора сохраняемых товаров')
+        memory.finish()
 
         # Шаг 6: Создание отчета
         output_file = None
         if save_output:
-            # Определяем корень Django проекта
-            base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             filename = f"duplicates_report_{competitor_id}_{timestamp}.txt"
             output_file = os.path.join(base_dir, filename)
@@ -217,6 +344,7 @@ class Command(BaseCommand):
                     f.write(f'Дата создания: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\n')
                     f.write(f'Всего дубликатов для удаления: {len(items_to_delete)}\n')
                     f.write('Критерий: удаляем товары БЕЗ пробела в начале артикула\n')
+                    f.write(f'Правило выбора сохраняемого товара: {master_rule}\n')
                     f.write('=' * 80 + '\n\n')
 
                     for entry in report_data:
@@ -259,48 +387,113 @@ class Command(BaseCommand):
         # Шаг 7: Подтверждение и удаление
         self.stdout.write(f'\n7. Итого товаров к удалению: {len(items_to_delete)}')
 
+        if estimate:
+            self.print_estimate([item.id for item in items_to_delete], throughput_file)
+            return
+
         if dry_run:
             self.stdout.write(self.style.WARNING('Режим dry-run: удаление не выполнено'))
             return
 
         if not items_to_delete:
             self.stdout.write('Нет товаров для удаления.')
+            if next_watermark:
+                self.advance_watermark(competitor, next_watermark)
             return
 
         # Используем безопасный ввод
-        confirm = self.safe_input('Вы уверены, что хотите удалить эти товары? (y/n): ')
+        confirm = 'y' if options['force'] else self.safe_input('Вы уверены, что хотите удалить эти товары? (y/n): ')
         if confirm.lower() != 'y':
             self.stdout.write('Удаление отменено.')
             return
 
+        delete_ids = [item.id for item in items_to_delete]
+
+        # План построен по реплике (--read-from): backup может хранить товары,
+        # уже удаленные из default, и не видит правок артикулов. Группы
+        # перепроверяются в default прямо перед удалением
+        if read_alias and read_alias != DEFAULT_DB_ALIAS:
+            delete_ids = self.revalidate_on_default(competitor, planned_groups)
+            if not delete_ids:
+                self.stdout.write('Нет товаров для удаления после проверки в default.')
+                return
+
         # Удаление
         self.stdout.write('8. Выполнение удаления...')
-        delete_ids = [item.id for item in items_to_delete]
 
-        # Удаляем порциями, чтобы избежать проблем с большим количеством записей
-        batch_size = 1000
+        # Быстрое удаление: DELETE ... WHERE item_id = ANY(...) по графу зависимостей,
+        # без загрузки связанных объектов в Python. Collector нужен, только если
+        # на моделях есть сигналы или связи, которые умеет обработать лишь он.
+        use_fast_delete = not orm_delete and can_fast_delete(Item)
+        if use_fast_delete:
+            self.stdout.write('   Режим удаления: set-based DELETE по графу зависимостей')
+        else:
+            self.stdout.write('   Режим удаления: Django Collector')
+
+        # Удаляем порциями, чтобы избежать проблем с большим количеством записей;
+        # размер пачки подстраивается под --target-latency и нагрузку на БД (_batching)
+        batcher = AdaptiveBatcher(options['batch_size'], options['target_latency'],
+                                  write=self.stdout.write, label='удаление',
+                                  models=[Item] + [edge.model for edge in cascade_graph(Item)])
         deleted_items_count = 0
         total_deleted_objects = 0  # для отслеживания общего количества удаленных объектов
-
-        for i in range(0, len(delete_ids), batch_size):
-            batch_ids = delete_ids[i:i + batch_size]
-            deleted_info = Item.objects.filter(id__in=batch_ids).delete()
+        delete_start = time.time()
+        progress = ProgressReporter(self.stdout.write, 'remove_duplicate_items', total=len(delete_ids),
+                                    unit='товаров', labels={'competitor': competitor_id})
+        # Снимки удаляемых строк для отмены запуска командой undo_run
+        journal = Journal('remove_duplicate_items', competitor_id)
+        self.stdout.write(f'   Журнал запуска: {journal.run_id}')
+
+        # Каждая пачка - своя транзакция с lock_timeout/statement_timeout: при
+        # таймауте повтор, затем разбиение, неудачные ID - в файл (_guarded)
+        guard = GuardedBatches('remove_duplicate_items', options['lock_timeout'], options['statement_timeout'],
+                               options['retries'], write=self.stdout.write,
+                               failed_file=options['failed_batches'] or os.path.join(
+                                   base_dir, f'failed_batches_remove_duplicate_items_{competitor_id}_'
+                                             f'{datetime.now():%Y%m%d_%H%M%S}.jsonl'))
+
+        def delete_batch(batch_ids):
+            journal.capture_delete(Item, batch_ids)
+            if use_fast_delete:
+                return fast_delete(Item, batch_ids)
+            return Item.objects.filter(id__in=batch_ids).delete()
+
+        for batch_ids in batcher.batches(delete_ids):
+            outcome = guard.run(batch_ids, delete_batch)
+            if outcome.timeouts:
+                batcher.shrink(f'таймаутов пачки: {outcome.timeouts}')
 
             # deleted_info[0] - общее количество удаленных объектов
             # deleted_info[1] - словарь с количеством по моделям
-            items_deleted_in_batch = deleted_info[1].get('kenny.items.Item', 0)
-
-            deleted_items_count += items_deleted_in_batch
-            total_deleted_objects += deleted_info[0]
+            for deleted_info in outcome.results:
+                deleted_items_count += deleted_info[1].get(Item._meta.label, 0)
+                total_deleted_objects += deleted_info[0]
 
-            self.stdout.write(f'   Удалено товаров: {deleted_items_count}/{len(delete_ids)}')
-            self.stdout.write(f'   Всего удалено объектов: {total_deleted_objects}')
-
-        self.stdout.write(self.style.SUCCESS(f'Удалено товаров: {deleted_items_count}'))
-        self.stdout.write(self.style.SUCCESS(f'Всего удалено объектов в БД: {total_deleted_objects}'))
+            progress.update(len(batch_ids), Удалено_товаров=deleted_items_count,
+                            Удалено_объектов=total_deleted_objects)
+        progress.finish()
+        batcher.finish()
+        guard.finish()
+        journal.finish()
 
         self.stdout.write(self.style.SUCCESS(f'Удалено товаров: {deleted_items_count}'))
         self.stdout.write(self.style.SUCCESS(f'Всего удалено объектов в БД: {total_deleted_objects}'))
+        self.stdout.write(f'Отменить удаление: python manage.py undo_run --run {journal.run_id}')
+
+        if guard.failed:
+            self.stdout.write(self.style.WARNING(
+                f'Не удалено пачек: {guard.failed} (ID в {guard.failed_file}); повторите запуск позже'))
+        if next_watermark and guard.failed:
+            # Иначе дубликаты из неудавшихся пачек выпадут из следующей проверки --incremental
+            self.stdout.write(self.style.WARNING('Отметка --incremental не сдвинута из-за неудавшихся пачек'))
+        elif next_watermark:
+            self.advance_watermark(competitor, next_watermark)
+
+        # Скорость этого запуска - основа для ETA в --estimate
+        try:
+            save_throughput(throughput_file, total_deleted_objects, time.time() - delete_start)
+        except OSError as e:
+            self.stdout.write(self.style.WARNING(f'Не удалось сохранить статистику скорости: {e}'))
 
         ## Сохранение информации об удалении в лог
         if output_file:
@@ -313,7 +506,106 @@ class Command(BaseCommand):
             except Exception as e:
                 self.stdout.write(self.style.WARNING(f'Не удалось добавить результат в отчет: {e}'))
 
+    def revalidate_on_default(self, competitor, planned_groups):
+        """ID к удалению из групп, не изменившихся в default: сохраняемый товар
+        существует и ключ артикула у товаров группы прежний. Группа, где это не
+        так, пропускается целиком; уже удаленные дубликаты просто выпадают."""
+        self.stdout.write(f'   Проверка {len(planned_groups)} групп в {DEFAULT_DB_ALIAS} (план построен по реплике)...')
+        valid_groups, skipped = revalidate_groups(competitor.id, planned_groups)
+        delete_ids = [item_id for _, _, group_ids in valid_groups for item_id in group_ids]
+
+        if skipped:
+            self.stdout.write(self.style.WARNING(
+                f'   Пропущено групп: {skipped} (сохраняемый товар удален или артикул изменился в default)'))
+        self.stdout.write(f'   Товаров к удалению после проверки: {len(delete_ids)}')
+        return delete_ids
+
+    def load_incremental_items(self, competitor):
+        """(товары групп, где появились новые товары, отметка для сохранения).
+
+        Без сохраненной отметки выполняется полный обход. Новая отметка
+        читается до поиска: товары, созданные во время работы, попадут в
+        следующий запуск.
+        """
+        next_watermark = current_watermark(competitor.id)
+
+        index_name, created = ensure_article_key_index(competitor.id)
+        if created:
+            self.stdout.write(f'   Создан индекс по нормализованному артикулу: {index_name}')
+
+        watermark = get_watermark(WATERMARK_JOB, competitor.id)
+        if watermark is None:
+            self.stdout.write('   Отметки прошлого запуска нет - выполняется полный обход')
+            items = load_item_records(with_article_key(Item.objects.filter(competitor=competitor), competitor.id))
+            return items, next_watermark
+
+        self.stdout.write(f'   Отметка прошлого запуска: date_create > {watermark.date_create} '
+                          f'или ID > {watermark.max_id}')
+        new_count, item_ids = delta_group_item_ids(competitor.id, watermark)
+        self.stdout.write(f'   Новых товаров: {new_count}, товаров в их группах: {len(item_ids)}')
+        if not item_ids:
+            return [], next_watermark
+        items = load_item_records(with_article_key(Item.objects.filter(id__in=item_ids), competitor.id))
+        return items, next_watermark
+
+    def report_spill(self, runs, spilled_bytes):
+        self.stdout.write(f'   Сброшена пачка {runs} ({spilled_bytes / 1024 / 1024:.1f} МБ на диске)')
+
+    def advance_watermark(self, competitor, watermark):
+        save_watermark(WATERMARK_JOB, competitor.id, watermark)
+        self.stdout.write(f'Отметка инкрементального режима сдвинута: date_create {watermark.date_create}, '
+                          f'ID {watermark.max_id}')
+
+    def print_estimate(self, delete_ids, throughput_file):
+        """Оценка затрат удаления: строки по таблицам, объем данных и WAL, ETA."""
+        self.stdout.write('\nОЦЕНКА УДАЛЕНИЯ (--estimate):')
+        if not delete_ids:
+            self.stdout.write('   Нет товаров для удаления.')
+            return
+
+        counts = count_cascade(Item, delete_ids)
+        models_by_label = {model._meta.label: model for model in self.cascade_models()}
+        total_rows = 0
+        total_bytes = 0
+        total_wal = 0
+        actions = {'delete': 'удаление', 'update': 'обновление', 'protect': 'ЗАПРЕЩЕНО (PROTECT)', 'none': 'без изменений'}
+
+        for label, (rows, action) in sorted(counts.items(), key=lambda x: -x[1][0]):
+            if not rows:
+                continue
+            line = f'   {label}: {rows} строк ({actions[action]})'
+            if action in ('delete', 'update') and label in models_by_label:
+                freed, wal = estimate_volume(models_by_label[label], rows)
+                total_wal += wal
+                if action == 'delete':
+                    total_rows += rows
+                    total_bytes += freed
+                line += f', WAL до {wal / (1024 * 1024):.1f} МБ'
+            self.stdout.write(line)
+            if action == 'protect':
+                self.stdout.write(self.style.ERROR('   Удаление упадет: есть защищенные связи'))
+
+        self.stdout.write(f'   Всего строк к удалению: {total_rows}')
+        self.stdout.write(f'   Освободится данных (с индексами): ~{total_bytes / (1024 * 1024):.1f} МБ')
+        self.stdout.write(f'   Ожидаемый объем WAL (оценка сверху): ~{total_wal / (1024 * 1024):.1f} МБ')
+
+        throughput = load_throughput(throughput_file)
+        if throughput:
+            eta = total_rows / throughput
+            eta_str = f'{eta / 60:.1f} мин' if eta > 60 else f'{eta:.1f} сек'
+            self.stdout.write(f'   Скорость последних запусков: {throughput:.0f} объектов/сек')
+            self.stdout.write(f'   Ориентировочное время удаления: {eta_str}')
+        else:
+            self.stdout.write('   Нет данных о скорости прошлых запусков - ETA не рассчитан')
+
+    def cascade_models(self):
+        return [Item] + [edge.model for edge in cascade_graph(Item)]
+
 # Запустите команду:
 # python manage.py remove_duplicate_items 1  # где 1 - ID конкурента
 # python manage.py remove_duplicate_items 142  # где 142 - ID Комус
 # python manage.py remove_duplicate_items 142 --output  # для сохранения отчета
+# python manage.py remove_duplicate_items 142 --estimate  # оценка объема и времени удаления
+# python manage.py remove_duplicate_items 142 --dry-run --read-from  # анализ по реплике
+# python manage.py remove_duplicate_items 142 --dry-run --memory-report  # расход памяти по этапам
+# python manage.py remove_duplicate_items 142 --dry-run --grouping external --memory-budget 128
@@ -1,10 +1,17 @@
 from datetime import datetime
 
 from django.core.management.base import BaseCommand
+from django.db import DatabaseError, transaction
 from kenny.items.models import Competitor, Item
 
 from linked.models import RecommendedLinked
 
+from ._journal import DELETE, Journal
+from ._normalize import with_article_key
+from ._progress import ProgressReporter
+from ._scoring import RULES, MasterSelector
+from ._urls import coverage, duplicate_url_groups
+
 
 class Command(BaseCommand):
     help = 'Удаляет товары с query-параметрами в URL, имеющие дубликаты по артикулу у указанного конкурента'
@@ -12,10 +19,17 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('competitor_id', type=int, help='ID конкурента')
         parser.add_argument('--preview-file', type=str, help='Путь к файлу для сохранения предварительного просмотра')
+        parser.add_argument('--master-rule', choices=sorted(RULES), default='clean_url',
+                            help='Правило выбора сохраняемого товара (по умолчанию: clean_url)')
+        parser.add_argument('--group-by', choices=['article', 'url'], default='article',
+                            help='Группировать по артикулу или по каноническому URL из индекса '
+                                 'backfill_canonical_urls (по умолчанию: article)')
 
     def handle(self, *args, **options):
         competitor_id = options['competitor_id']
         preview_file_path = options.get('preview_file')
+        master_rule = options['master_rule']
+        group_by = options['group_by']
 
         # Если путь к файлу не указан, создаем автоматическое имя
         if not preview_file_path:
@@ -33,33 +47,44 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR(f'Конкурент с ID {competitor_id} не найден'))
             return
 
-        # Шаг 2: Получение всех товаров конкурента
-        self.stdout.write('\n2. Получение всех товаров конкурента...')
-        items = Item.objects.filter(competitor=competitor)
-        self.stdout.write(f'   Всего товаров у конкурента: {items.count()}')
+        if group_by == 'url':
+            # Шаги 2-4: группы с одинаковым каноническим URL из индекса
+            duplicate_articles = self.url_duplicate_groups(competitor)
+            if duplicate_articles is None:
+                return
+        else:
+            # Шаг 2: Получение всех товаров конкурента
+            self.stdout.write('\n2. Получение всех товаров конкурента...')
+            items = with_article_key(Item.objects.filter(competitor=competitor), competitor.id)
+            total_items = items.count()
+            self.stdout.write(f'   Всего товаров у конкурента: {total_items}')
 
-        # Шаг 3: Группировка товаров по нормализованным артикулам (без пробелов)
-        self.stdout.write('\n3. Группировка товаров по нормализованным артикулам...')
-        normalized_articles = {}
+            # Шаг 3: Группировка товаров по нормализованным артикулам (без пробелов)
+            self.stdout.write('\n3. Группировка товаров по нормализованным артикулам...')
+            normalized_articles = {}
+            progress = ProgressReporter(self.stdout.write, 'remove_duplicate_items_test', total=total_items,
+                                        unit='товаров', labels={'competitor': competitor_id})
 
-        for item in items:
-            # Нормализуем артикул - убираем пробелы в начале и конце
-            normalized_article = item.article.strip()
+            for item in items:
+                # Ключ группировки посчитан в БД по правилам конкурента (см. _normalize)
+                normalized_article = item.article_key
 
-            if normalized_article not in normalized_articles:
-                normalized_articles[normalized_article] = []
+                if normalized_article not in normalized_articles:
+                    normalized_articles[normalized_article] = []
 
-            normalized_articles[normalized_article].append(item)
+                normalized_articles[normalized_article].append(item)
+                progress.update(1)
+            progress.finish()
 
-        # Шаг 4: Поиск дубликатов
-        self.stdout.write('\n4. Поиск дубликатов артикулов...')
-        duplicate_articles = {}
+            # Шаг 4: Поиск дубликатов
+            self.stdout.write('\n4. Поиск дубликатов артикулов...')
+            duplicate_articles = {}
 
-        for article, items_list in normalized_articles.items():
-            if len(items_list) > 1:
-                duplicate_articles[article] = items_list
+            for article, items_list in normalized_articles.items():
+                if len(items_list) > 1:
+                    duplicate_articles[article] = items_list
 
-        self.stdout.write(f'   Найдено артикулов с дубликатами: {len(duplicate_articles)}')
+            self.stdout.write(f'   Найдено артикулов с дубликатами: {len(duplicate_articles)}')
 
         # Шаг 5: Поиск товаров с query-параметрами среди дубликатов
         self.stdout.write('\n5. Поиск товаров с query-параметрами среди дубликатов...')
@@ -69,36 +94,36 @@ class Command(BaseCommand):
         # Создаем список для хранения детальной информации о каждом артикуле
         detailed_article_info = []
 
-        for article, items_list in duplicate_articles.items():
-            clean_article = article.strip()
+        # Сохраняемый товар выбирается правилом: по умолчанию самый новый без
+        # параметров в URL, а если таких нет - самый старый
+        selector = MasterSelector(master_rule)
+        for article, kept_item, other_items in selector.select(duplicate_articles.items()):
+            items_list = duplicate_articles[article]
             variants = list(set(i.article for i in items_list))
 
             # Добавляем информацию в список для файла
-            detailed_article_info.append(f"Артикул: '{clean_article}'")
+            if group_by == 'url':
+                url, article_key = article
+                detailed_article_info.append(f"Канонический URL: '{url}'")
+                detailed_article_info.append(f"Артикул: '{article_key.strip()}'")
+            else:
+                detailed_article_info.append(f"Артикул: '{article.strip()}'")
             detailed_article_info.append(f'Варианты написания: {variants}')
             detailed_article_info.append(f'Всего товаров: {len(items_list)}')
 
-            # Сортируем товары по дате создания (новые первыми)
-            sorted_items = sorted(items_list, key=lambda x: x.date_create, reverse=True)
-
-            # Ищем товар без параметров для сохранения
-            kept_item = None
-            for item in sorted_items:
-                if '?' not in item.url and '%3F' not in item.url:
-                    kept_item = item
-                    items_to_keep.append(item)
-                    detailed_article_info.append(f'Сохраняемый товар (без параметров): {item.id} - {item.url}')
-                    break
-
-            # Если нет товара без параметров, сохраняем самый старый
-            if kept_item is None:
-                kept_item = sorted_items[-1]  # Самый старый товар
-                items_to_keep.append(kept_item)
+            items_to_keep.append(kept_item)
+            if '?' not in kept_item.url and '%3F' not in kept_item.url:
+                detailed_article_info.append(f'Сохраняемый товар (без параметров): {kept_item.id} - {kept_item.url}')
+            elif master_rule == 'clean_url':
                 detailed_article_info.append(f'Сохраняемый товар (самый старый): {kept_item.id} - {kept_item.url}')
-
-            # Добавляем товары с параметрами для удаления
-            for item in sorted_items:
-                if ('?' in item.url or '%3F' in item.url) and item != kept_item:
+            else:
+                detailed_article_info.append(f'Сохраняемый товар ({master_rule}): {kept_item.id} - {kept_item.url}')
+
+            # Добавляем товары с параметрами для удаления (новые первыми). При
+            # группировке по каноническому URL остальные товары группы - варианты
+            # того же адреса с тем же артикулом - удаляются целиком
+            for item in sorted(other_items, key=lambda x: x.date_create, reverse=True):
+                if group_by == 'url' or '?' in item.url or '%3F' in item.url:
                     items_to_delete.append(item)
                     detailed_article_info.append(f'К удалению: {item.id} - {item.url}')
 
@@ -174,21 +199,29 @@ class Command(BaseCommand):
             self.stdout.write('   Удаление отменено.')
             return
 
-        # Шаг 9: Удаление рекомендаций
-        self.stdout.write('\n9. УДАЛЕНИЕ РЕКОМЕНДАЦИЙ...')
-        if recommendations_to_delete.exists():
-            rec_deleted_count, _ = recommendations_to_delete.delete()
-            self.stdout.write(f'   Удалено рекомендаций: {rec_deleted_count}')
-        else:
-            self.stdout.write('   Нет рекомендаций для удаления')
-
-        # Шаг 10: Удаление товаров
-        self.stdout.write('\n10. УДАЛЕНИЕ ТОВАРОВ...')
-        if items_to_delete:
-            deleted_count = Item.objects.filter(id__in=item_ids_to_delete).delete()[0]
-            self.stdout.write(f'   Удалено товаров: {deleted_count}')
-        else:
-            self.stdout.write('   Нет товаров для удаления')
+        # Снимки удаляемых строк для отмены запуска командой undo_run
+        journal = Journal('remove_duplicate_items_test', competitor.id)
+        self.stdout.write(f'   Журнал запуска: {journal.run_id}')
+
+        with transaction.atomic():
+            # Шаг 9: Удаление рекомендаций
+            self.stdout.write('\n9. УДАЛЕНИЕ РЕКОМЕНДАЦИЙ...')
+            if recommendations_to_delete.exists():
+                journal.capture_queryset(DELETE, recommendations_to_delete)
+                rec_deleted_count, _ = recommendations_to_delete.delete()
+                self.stdout.write(f'   Удалено рекомендаций: {rec_deleted_count}')
+            else:
+                self.stdout.write('   Нет рекомендаций для удаления')
+
+            # Шаг 10: Удаление товаров
+            self.stdout.write('\n10. УДАЛЕНИЕ ТОВАРОВ...')
+            if items_to_delete:
+                journal.capture_delete(Item, item_ids_to_delete)
+                deleted_count = Item.objects.filter(id__in=item_ids_to_delete).delete()[0]
+                self.stdout.write(f'   Удалено товаров: {deleted_count}')
+            else:
+                self.stdout.write('   Нет товаров для удаления')
+        journal.finish()
 
         self.stdout.write(self.style.SUCCESS(
             '\n=== УДАЛЕНИЕ ЗАВЕРШЕНО ===',
@@ -202,7 +235,54 @@ class Command(BaseCommand):
         self.stdout.write(self.style.SUCCESS(
             f'Сохранено товаров: {len(items_to_keep)}',
         ))
+        self.stdout.write(f'Отменить удаление: python manage.py undo_run --run {journal.run_id}')
+
+    def url_duplicate_groups(self, competitor):
+        """{(канонический URL, ключ артикула): [товары]} для групп из 2+ товаров
+        по индексу item_canonical_url. None, если индекс недоступен, неполный
+        или устарел.
+
+        Одинаковый канонический URL еще не значит один товар (например, карточка
+        с выбором варианта через фрагмент), поэтому группа по URL дополнительно
+        делится по ключу артикула, и удаляются только совпадающие по обоим.
+        """
+        self.stdout.write('\n2. Проверка индекса канонических URL...')
+        try:
+            total_items, indexed_items = coverage(competitor.id)
+        except DatabaseError as e:
+            self.stdout.write(self.style.ERROR(f'   Индекс канонических URL недоступен: {e}'))
+            self.stdout.write(f'   Заполните его: python manage.py backfill_canonical_urls {competitor.id}')
+            return None
+
+        self.stdout.write(f'   Товаров в индексе: {indexed_items}/{total_items}')
+        if indexed_items < total_items:
+            self.stdout.write(self.style.ERROR(
+                f'   Индекс неполный или устарел ({total_items - indexed_items} товаров без актуального '
+                f'канонического URL), удаление по нему невозможно'))
+            self.stdout.write(f'   Обновите его: python manage.py backfill_canonical_urls {competitor.id}')
+            return None
+
+        self.stdout.write('\n3. Поиск групп по каноническому URL (GROUP BY по индексу)...')
+        groups = duplicate_url_groups(competitor.id)
+
+        self.stdout.write('\n4. Загрузка товаров найденных групп...')
+        item_ids = [item_id for _, ids in groups for item_id in ids]
+        items_by_id = with_article_key(Item.objects.filter(competitor=competitor), competitor.id).in_bulk(item_ids)
+        duplicate_urls = {}
+        for url, ids in groups:
+            by_article = {}
+            for item_id in ids:
+                if item_id in items_by_id:
+                    item = items_by_id[item_id]
+                    by_article.setdefault(item.article_key, []).append(item)
+            for article_key, group_items in by_article.items():
+                if len(group_items) > 1:
+                    duplicate_urls[(url, article_key)] = group_items
+
+        self.stdout.write(f'   Найдено URL с дубликатами: {len(duplicate_urls)}')
+        return duplicate_urls
 
 # Запустите команду:
 # python manage.py remove_duplicate_items_prod 1  # где 1 - ID конкурента
 # python manage.py remove_duplicate_items_prod 142  # где 142 - ID Комус
+# python manage.py remove_duplicate_items_test 142 --group-by url  # после backfill_canonical_urls 142
@@ -0,0 +1,151 @@
+"""
+Отмена запуска разрушающей команды по журналу (_journal).
+
+Вместо восстановления каждого товара из базы backup (restore_item) запуск
+отменяется целиком: шаги журнала проигрываются в обратном порядке, каждый
+шаг - один set-based запрос:
+- удаленные строки вставляются обратно из снимков (jsonb_populate_record);
+- обновленные строки получают значения до запуска;
+- созданные запуском строки удаляются.
+Все шаги выполняются в одной транзакции.
+
+РЕЖИМЫ РАБОТЫ:
+--list    : последние запуски с журналом
+--dry-run : только показать шаги отмены и количество строк
+--purge --older-than DAYS : удалить из журнала запуски старше DAYS дней
+            (после этого их нельзя отменить); с --dry-run - только подсчет
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ._journal import get_run, list_runs, mark_undone, purge_run, purgeable_runs, run_steps, undo_step
+
+OP_LABELS = {
+    'delete': 'вставить удаленные',
+    'update': 'вернуть значения',
+    'insert': 'удалить созданные',
+}
+
+
+class Command(BaseCommand):
+    help = 'Отменяет запуск команды удаления/объединения по журналу изменений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--run', type=str, help='ID запуска (run_id из вывода команды)')
+        parser.add_argument('--list', action='store_true', help='Показать последние запуски')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет отменено')
+        parser.add_argument('--force', action='store_true',
+                            help='Выполнить без подтверждения и даже если запуск уже отменялся')
+        parser.add_argument('--purge', action='store_true',
+                            help='Удалить из журнала старые запуски (нужен --older-than)')
+        parser.add_argument('--older-than', type=int, metavar='DAYS',
+                            help='Для --purge: запуски, начатые больше DAYS дней назад')
+
+    def handle(self, *args, **options):
+        if options['purge']:
+            self.purge(options)
+            return
+
+        if options['list'] or not options['run']:
+            self.print_runs()
+            return
+
+        run_id = options['run']
+        run = get_run(run_id)
+        if run is None:
+            self.stdout.write(self.style.ERROR(f'Запуск {run_id} не найден в журнале'))
+            return
+
+        _, command, competitor_id, started_at, finished_at, undone_at = run
+        self.stdout.write('=== ОТМЕНА ЗАПУСКА ===')
+        self.stdout.write(f'Запуск: {run_id}')
+        self.stdout.write(f'Команда: {command}, конкурент: {competitor_id}')
+        self.stdout.write(f'Начат: {started_at}, завершен: {finished_at or "не завершен"}')
+        if undone_at and not options['force']:
+            self.stdout.write(self.style.ERROR(f'Запуск уже отменен {undone_at}. Повторить: --force'))
+            return
+
+        steps = run_steps(run_id)
+        if not steps:
+            self.stdout.write('Журнал запуска пуст - отменять нечего')
+            return
+
+        self.stdout.write('\nШаги отмены:')
+        for step, op, model_label, rows in steps:
+            self.stdout.write(f'   {step}. {model_label}: {OP_LABELS.get(op, op)} - {rows} строк')
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('Режим dry-run: изменения не выполнены'))
+            return
+
+        if not options['force']:
+            self.stdout.write("Для подтверждения отмены введите 'y':")
+            try:
+                confirm = input().strip().lower()
+            except UnicodeDecodeError:
+                self.stdout.write(
+                    'Обнаружена проблема с кодировкой ввода. Используйте параметр --force для выполнения без подтверждения.')
+                return
+            if confirm != 'y':
+                self.stdout.write('Отмена не выполнена.')
+                return
+
+        with transaction.atomic():
+            for step, op, model_label, rows in steps:
+                changed = undo_step(run_id, step, op, model_label)
+                self.stdout.write(f'   {model_label}: {OP_LABELS.get(op, op)} - {changed} из {rows}')
+            mark_undone(run_id)
+
+        self.stdout.write(self.style.SUCCESS(f'Запуск {run_id} отменен'))
+
+    def purge(self, options):
+        days = options['older_than']
+        if days is None or days < 0:
+            self.stdout.write(self.style.ERROR('Для --purge укажите --older-than DAYS (DAYS >= 0)'))
+            return
+
+        runs = purgeable_runs(days)
+        rows = sum(count for _, count in runs)
+        self.stdout.write(f'Запусков старше {days} дней: {len(runs)}, строк журнала: {rows}')
+        if not runs:
+            return
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('Режим dry-run: журнал не изменен'))
+            return
+
+        if not options['force']:
+            self.stdout.write("Эти запуски нельзя будет отменить. Для подтверждения введите 'y':")
+            try:
+                confirm = input().strip().lower()
+            except UnicodeDecodeError:
+                self.stdout.write(
+                    'Обнаружена проблема с кодировкой ввода. Используйте параметр --force для выполнения без подтверждения.')
+                return
+            if confirm != 'y':
+                self.stdout.write('Очистка не выполнена.')
+                return
+
+        # Запуск за запуском, каждый в своей транзакции - без одной огромной
+        purged_rows = 0
+        for run_id, _ in runs:
+            with transaction.atomic():
+                purged_rows += purge_run(run_id)
+        self.stdout.write(self.style.SUCCESS(f'Удалено запусков: {len(runs)}, строк журнала: {purged_rows}'))
+
+    def print_runs(self):
+        runs = list_runs()
+        if not runs:
+            self.stdout.write('Журнал пуст')
+            return
+        self.stdout.write('Последние запуски:')
+        for run_id, command, competitor_id, started_at, finished_at, undone_at, rows in runs:
+            state = f'отменен {undone_at:%Y-%m-%d %H:%M}' if undone_at else (
+                'завершен' if finished_at else 'не завершен')
+            self.stdout.write(f'   {run_id}  {started_at:%Y-%m-%d %H:%M}  {command} '
+                              f'(конкурент {competitor_id}): {rows} строк, {state}')
+
+# Запустите команду:
+# python manage.py undo_run --list
+# python manage.py undo_run --run 3f0c2d9e-... --dry-run
+# python manage.py undo_run --run 3f0c2d9e-... --force
+# python manage.py undo_run --purge --older-than 30 --dry-run
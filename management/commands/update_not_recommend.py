@@ -2,6 +2,10 @@ from django.core.management.base import BaseCommand
 from django.db import transaction, models
 from linked.models import RecommendedLinked
 
+from ._batching import DEFAULT_TARGET_SECONDS, AdaptiveBatcher
+from ._journal import UPDATE, Journal
+from ._progress import ProgressReporter
+
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
@@ -14,6 +18,12 @@ class Command(BaseCommand):
             '--dry-run',
             action='store_true',
         )
+        parser.add_argument(
+            '--target-latency',
+            type=float,
+            default=DEFAULT_TARGET_SECONDS,
+            help='Target seconds per chunk; --chunk-size is the initial size, 0 keeps it fixed',
+        )
 
     def handle(self, *args, **options):
         chunk_size = options['chunk_size']
@@ -40,9 +50,16 @@ class Command(BaseCommand):
 
         # Обрабатываем данные чанками для экономии памяти
         backup_list = list(backup_set)
+        progress = ProgressReporter(self.stdout.write, 'update_not_recommend', total=len(backup_list))
+        journal = None
+        if not dry_run:
+            journal = Journal('update_not_recommend')
+            self.stdout.write(f'Journal run: {journal.run_id}')
 
-        for i in range(0, len(backup_list), chunk_size):
-            chunk = backup_list[i:i + chunk_size]
+        # Chunk size adapts to --target-latency, lock waits and replication lag (_batching)
+        batcher = AdaptiveBatcher(chunk_size, options['target_latency'], write=self.stdout.write, label='chunks',
+                                  models=[RecommendedLinked])
+        for chunk in batcher.batches(backup_list):
 
             # Создаем условия для фильтрации
             query = models.Q()
@@ -59,21 +76,24 @@ class Command(BaseCommand):
                 # Только подсчет без обновления
                 count = records_to_update.count()
                 updated_count += count
-                self.stdout.write(f'Would update {count} records in chunk {i // chunk_size + 1}')
             else:
                 # Выполняем обновление в транзакции
                 with transaction.atomic(using='default'):
+                    journal.capture_queryset(UPDATE, records_to_update)
                     updated = records_to_update.update(not_recommend=True)
                     updated_count += updated
-                    self.stdout.write(f'Updated {updated} records in chunk {i // chunk_size + 1}')
 
-            self.stdout.write(f'Processed {min(i + chunk_size, len(backup_list))}/{len(backup_list)} records')
+            progress.update(len(chunk), updated=updated_count)
+        progress.finish()
+        batcher.finish()
 
         if dry_run:
             self.stdout.write(
                 self.style.WARNING(f'DRY RUN: Would update {updated_count} records total')
             )
         else:
+            journal.finish()
             self.stdout.write(
                 self.style.SUCCESS(f'Successfully updated {updated_count} records')
             )
+            self.stdout.write(f'Undo: python manage.py undo_run --run {journal.run_id}')
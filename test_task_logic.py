@@ -71,13 +71,18 @@ from linked.helpers import get_ones_nomenclature_qs
 # python test_task_logic.py
 
 from linked.helpers import get_ones_nomenclature_qs
+from linked.removed_suppliers import get_removed_suppliers
 
 join_result = get_ones_nomenclature_qs().filter(code=171664).filter(supplier___mark_remove=1).exists()
 manual_result = get_ones_nomenclature_qs().get(code=171664).supplier.filter(_mark_remove=1).exists()
+# Битовая карта _mark_remove по коду: один потоковый запрос, кэш на диске
+cache_result = 171664 in get_removed_suppliers()
 
 print(f"JOIN: {join_result}")
 print(f"Ручная: {manual_result}")
+print(f"Кэш удаленных поставщиков: {cache_result}")
 print(f"Баг Django ORM: {join_result and not manual_result}")
+print(f"Кэш совпадает с ручной проверкой: {cache_result == manual_result}")
 # if __name__ == "__main__":
 #     test_specific_issue()
 #     debug_supplier_join()
\ No newline at end of file
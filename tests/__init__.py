@@ -0,0 +1,6 @@
+"""
+Юнит-тесты вспомогательных модулей команд без обращения к БД
+(django.test.SimpleTestCase - тестовые базы не создаются).
+
+Запуск: python manage.py test tests
+"""
@@ -0,0 +1,79 @@
+import os
+import random
+import tempfile
+from datetime import datetime
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from management.commands import _grouping
+from management.commands._grouping import MAX_FAN_IN, group_duplicates, merge_fan_in
+from management.commands._records import ItemRecord
+
+
+def make_records(count=3000, keys=800, seed=7):
+    rng = random.Random(seed)
+    records = []
+    for item_id in range(1, count + 1):
+        key = f'k{rng.randrange(keys)}'
+        if item_id % 97 == 0:
+            key = None
+        elif item_id % 89 == 0:
+            key = ''
+        records.append(ItemRecord(item_id, f' {key}', datetime(2024, 1, 1), f'https://shop.ru/{item_id}', key))
+    return records
+
+
+def as_ids(groups):
+    return [(key, [record.id for record in members]) for key, members in groups.items()]
+
+
+class GroupDuplicatesTests(SimpleTestCase):
+    def test_external_matches_memory(self):
+        records = make_records()
+        for skip_empty in (False, True):
+            with self.subTest(skip_empty=skip_empty):
+                memory, memory_stats = group_duplicates(iter(records), 'memory', skip_empty=skip_empty)
+                external, external_stats = group_duplicates(iter(records), 'external', skip_empty=skip_empty)
+                self.assertEqual(as_ids(external), as_ids(memory))
+                self.assertEqual(external_stats.keys, memory_stats.keys)
+                self.assertEqual(external_stats.items, len(records))
+
+    def test_multi_pass_merge_matches_memory(self):
+        records = make_records()
+        spills = []
+        # Пачки по 50 строк и fan-in 2: 60 пачек сливаются в несколько проходов
+        with mock.patch.object(_grouping, 'SPILL_BLOCK', 50):
+            external, stats = group_duplicates(iter(records), 'external', memory_budget_mb=0,
+                                               on_spill=lambda runs, size: spills.append(runs))
+        memory, _ = group_duplicates(iter(records), 'memory')
+        self.assertEqual(as_ids(external), as_ids(memory))
+        self.assertEqual(stats.runs, 60)
+        self.assertGreater(stats.merge_passes, 1)
+        self.assertEqual(spills[-1], 60)
+
+    def test_none_and_empty_keys_are_separate_groups(self):
+        records = [ItemRecord(i, '', None, '', key) for i, key in enumerate([None, '', None, ''], 1)]
+        for backend in ('memory', 'external'):
+            with self.subTest(backend=backend):
+                groups, _ = group_duplicates(iter(records), backend)
+                self.assertEqual(as_ids(groups), [(None, [1, 3]), ('', [2, 4])])
+                groups, _ = group_duplicates(iter(records), backend, skip_empty=True)
+                self.assertEqual(groups, {})
+
+    def test_external_uses_and_cleans_the_spill_dir(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(DEDUPE_SPILL_DIR=directory):
+            group_duplicates(iter(make_records(200)), 'external')
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            group_duplicates([], 'sqlite')
+
+
+class MergeFanInTests(SimpleTestCase):
+    def test_fan_in_follows_the_memory_budget(self):
+        block_mb = _grouping.SPILL_BLOCK * _grouping.ESTIMATED_ROW_BYTES / 1024 / 1024
+        self.assertEqual(merge_fan_in(0), 2)
+        self.assertEqual(merge_fan_in(int(block_mb * 10)), 9)
+        self.assertEqual(merge_fan_in(1024 * 1024), MAX_FAN_IN)
@@ -0,0 +1,77 @@
+import gzip
+import json
+import os
+import tempfile
+
+from django.test import SimpleTestCase
+
+from management.commands._plan import (
+    PLAN_FORMAT, PLAN_VERSION, PlanError, PlanGroup, fingerprint_count, plan_item_ids, read_plan, write_plan,
+)
+
+GROUPS = [PlanGroup('ab 12', 10, [11, 12]), PlanGroup('Артикул', 20, [21])]
+
+
+class PlanFileTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_round_trip(self):
+        for name in ('plan.jsonl', 'plan.jsonl.gz'):
+            with self.subTest(name=name):
+                path = self.path(name)
+                header = {'competitor_id': 142, 'groups': len(GROUPS), 'fingerprint': 'v1:5:abc'}
+                self.assertEqual(write_plan(path, header, GROUPS), 2)
+                read_header, groups = read_plan(path)
+                self.assertEqual(groups, GROUPS)
+                self.assertEqual(read_header, dict(header, format=PLAN_FORMAT, version=PLAN_VERSION))
+
+    def test_gz_file_is_compressed(self):
+        path = self.path('plan.jsonl.gz')
+        write_plan(path, {}, GROUPS)
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            self.assertEqual(json.loads(f.readline())['format'], PLAN_FORMAT)
+
+    def write_lines(self, *lines):
+        path = self.path('plan.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def test_rejects_foreign_or_outdated_files(self):
+        cases = [
+            ('not json',),
+            (json.dumps({'format': 'other'}),),
+            (json.dumps({'format': PLAN_FORMAT, 'version': PLAN_VERSION + 1}),),
+        ]
+        for lines in cases:
+            with self.subTest(lines=lines), self.assertRaises(PlanError):
+                read_plan(self.write_lines(*lines))
+
+    def test_rejects_broken_group_line(self):
+        header = json.dumps({'format': PLAN_FORMAT, 'version': PLAN_VERSION})
+        with self.assertRaisesRegex(PlanError, 'строке 3'):
+            read_plan(self.write_lines(header, json.dumps({'article': 'a', 'master': 1, 'slaves': [2]}),
+                                       json.dumps({'article': 'b', 'slaves': [3]})))
+
+    def test_rejects_truncated_plan(self):
+        path = self.path('plan.jsonl')
+        write_plan(path, {'groups': 3}, GROUPS)
+        with self.assertRaisesRegex(PlanError, 'неполный'):
+            read_plan(path)
+
+
+class PlanHelpersTests(SimpleTestCase):
+    def test_plan_item_ids(self):
+        self.assertEqual(plan_item_ids(GROUPS), [10, 11, 12, 20, 21])
+
+    def test_fingerprint_count(self):
+        self.assertEqual(fingerprint_count(f'v{PLAN_VERSION}:5:d41d8cd98f00b204e9800998ecf8427e'), 5)
+        self.assertIsNone(fingerprint_count(f'v{PLAN_VERSION + 1}:5:abc'))
+        self.assertIsNone(fingerprint_count('garbage'))
+        self.assertIsNone(fingerprint_count(None))
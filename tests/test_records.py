@@ -0,0 +1,100 @@
+from datetime import datetime
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from management.commands import _records
+from management.commands._records import ItemRecord, MemoryReport, iter_item_records, load_item_records, load_names
+
+
+class FakeQuerySet:
+    """values_list(...).iterator(chunk_size) над готовыми строками."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.fields = None
+        self.chunk_size = None
+
+    def values_list(self, *fields):
+        self.fields = fields
+        return self
+
+    def iterator(self, chunk_size):
+        self.chunk_size = chunk_size
+        return iter(self.rows)
+
+
+class ItemRecordTests(SimpleTestCase):
+    def test_slots(self):
+        record = ItemRecord(1, 'AB-1', None, None, 'ab1')
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertIsNone(record.name)
+        with self.assertRaises(AttributeError):
+            record.extra = 1
+        self.assertEqual(repr(record), "ItemRecord(id=1, article='AB-1')")
+
+    def test_iter_item_records(self):
+        created = datetime(2024, 1, 1)
+        # Разные объекты строк с одинаковым значением - после загрузки одна строка
+        rows = [
+            (1, ''.join(['AB', '-1']), created, 'https://a/1', ''.join(['ab', '1'])),
+            (2, ''.join(['AB', '-1']), created, None, ''.join(['ab', '1'])),
+            (3, None, None, None, None),
+        ]
+        queryset = FakeQuerySet(rows)
+        records = load_item_records(queryset, chunk_size=2)
+        self.assertEqual(queryset.fields, _records.RECORD_FIELDS)
+        self.assertEqual(queryset.chunk_size, 2)
+        self.assertEqual([record.id for record in records], [1, 2, 3])
+        self.assertEqual(records[0].url, 'https://a/1')
+        self.assertEqual(records[0].date_create, created)
+        self.assertIs(records[0].article, records[1].article)
+        self.assertIs(records[0].article_key, records[1].article_key)
+        self.assertIsNone(records[2].article)
+        self.assertIsNone(records[2].article_key)
+
+    def test_iter_is_lazy(self):
+        records = iter_item_records(FakeQuerySet([(1, 'A', None, None, 'a')]))
+        self.assertEqual(next(records).id, 1)
+        with self.assertRaises(StopIteration):
+            next(records)
+
+    def test_load_names_in_chunks(self):
+        records = [ItemRecord(item_id, 'A', None, None, 'a') for item_id in (1, 2, 3)]
+        names = {1: 'Первый', 2: 'Второй', 3: 'Третий'}
+
+        def fake_filter(id__in):
+            queryset = mock.Mock()
+            queryset.values_list.return_value = [(item_id, names[item_id]) for item_id in id__in]
+            return queryset
+
+        with mock.patch.object(_records, 'Item') as item:
+            item.objects.filter.side_effect = fake_filter
+            load_names(records, chunk_size=2)
+        item_filter = item.objects.filter
+        self.assertEqual([call.kwargs['id__in'] for call in item_filter.call_args_list], [[1, 2], [3]])
+        self.assertEqual([record.name for record in records], ['Первый', 'Второй', 'Третий'])
+
+
+class MemoryReportTests(SimpleTestCase):
+    def test_disabled_report_writes_nothing(self):
+        lines = []
+        report = MemoryReport(lines.append, enabled=False)
+        report.checkpoint('загрузка')
+        report.finish()
+        self.assertEqual(report.points, [])
+        self.assertEqual(lines, [])
+
+    def test_growth_from_first_checkpoint(self):
+        lines = []
+        report = MemoryReport(lines.append)
+        with mock.patch.object(_records, '_current_rss', side_effect=[1024 * 1024, None]), \
+                mock.patch.object(_records, '_peak_rss', side_effect=[2 * 1024 * 1024, 5 * 1024 * 1024]):
+            report.checkpoint('загрузка')
+            report.checkpoint('группировка')
+        report.finish()
+        self.assertEqual(lines, [
+            '\nПАМЯТЬ (--memory-report):',
+            '   загрузка: RSS 1.0 МБ, пик 2.0 МБ (+0.0 МБ)',
+            '   группировка: RSS н/д, пик 5.0 МБ (+3.0 МБ)',
+        ])
@@ -0,0 +1,110 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from linked import removed_suppliers
+from linked.removed_suppliers import (
+    BITMAP_MAX_CODE, CACHE_VERSION, RemovedSuppliers, cache_path, get_removed_suppliers, read_cache, write_cache,
+)
+
+PROBE = (100, 3, '500')
+
+
+class RemovedSuppliersTests(SimpleTestCase):
+    def test_bitmap_membership(self):
+        removed = RemovedSuppliers([171664, 0, 9, 171664], PROBE)
+        self.assertIsNotNone(removed.bitmap)
+        self.assertEqual(len(removed), 3)
+        for code in (0, 9, 171664):
+            self.assertIn(code, removed)
+        for code in (1, 8, 171665, 10 ** 9, -1, '9', None):
+            self.assertNotIn(code, removed)
+        self.assertEqual(removed.codes(), [0, 9, 171664])
+
+    def test_large_or_non_integer_codes_use_a_set(self):
+        for codes in ([5, 'A1'], [5, BITMAP_MAX_CODE + 1]):
+            with self.subTest(codes=codes):
+                removed = RemovedSuppliers(codes, PROBE)
+                self.assertIsNone(removed.bitmap)
+                self.assertEqual(sorted(map(str, removed.codes())), sorted(map(str, codes)))
+                self.assertIn(codes[1], removed)
+                self.assertNotIn(6, removed)
+
+    def test_empty(self):
+        removed = RemovedSuppliers([], PROBE)
+        self.assertEqual(len(removed), 0)
+        self.assertNotIn(0, removed)
+        self.assertEqual(removed.codes(), [])
+
+    def test_exclude(self):
+        queryset = mock.Mock()
+        RemovedSuppliers([3, 1], PROBE).exclude(queryset, field='nomenclature__code')
+        queryset.exclude.assert_called_once_with(nomenclature__code__in=[1, 3])
+
+
+class CacheFileTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'cache', 'removed_suppliers.cache')
+
+    def test_round_trip(self):
+        for codes in ([0, 9, 171664], ['A1', 5]):
+            with self.subTest(codes=codes):
+                original = RemovedSuppliers(codes, PROBE, created_at=1000.0)
+                write_cache(self.path, original)
+                cached = read_cache(self.path)
+                self.assertEqual(cached.probe, PROBE)
+                self.assertEqual(cached.created_at, 1000.0)
+                self.assertEqual(len(cached), len(original))
+                self.assertEqual(sorted(map(str, cached.codes())), sorted(map(str, original.codes())))
+
+    def test_file_is_not_a_pickle(self):
+        write_cache(self.path, RemovedSuppliers([1], PROBE))
+        with open(self.path, 'rb') as f:
+            self.assertTrue(f.read().startswith(b'{'))
+
+    def test_damaged_or_missing_file_is_ignored(self):
+        self.assertIsNone(read_cache(self.path))
+        write_cache(self.path, RemovedSuppliers([1, 2], PROBE))
+        with open(self.path, 'ab') as f:
+            f.write(b'\x00')
+        self.assertIsNone(read_cache(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'\x80\x04garbage')
+        self.assertIsNone(read_cache(self.path))
+
+    def test_other_version_is_ignored(self):
+        data = RemovedSuppliers([1], PROBE).to_cache()
+        other = data.replace(f'"version": {CACHE_VERSION}'.encode(), f'"version": {CACHE_VERSION + 1}'.encode(), 1)
+        self.assertNotEqual(data, other)
+        write_cache(self.path, RemovedSuppliers([1], PROBE))
+        with open(self.path, 'wb') as f:
+            f.write(other)
+        self.assertIsNone(read_cache(self.path))
+
+    @override_settings(BASE_DIR='/srv/app', REMOVED_SUPPLIERS_CACHE_PATH='')
+    def test_default_path_is_under_project(self):
+        self.assertEqual(cache_path(), os.path.join('/srv/app', 'var', 'removed_suppliers.cache'))
+
+    @override_settings(REMOVED_SUPPLIERS_CACHE_PATH='/tmp/custom.cache')
+    def test_path_from_settings(self):
+        self.assertEqual(cache_path(), '/tmp/custom.cache')
+
+    def test_get_uses_fresh_cache_and_reloads_on_probe_change(self):
+        write_cache(self.path, RemovedSuppliers([1], PROBE))
+        fresh = RemovedSuppliers([2], (101, 4, '501'))
+        with mock.patch.object(removed_suppliers, 'probe_suppliers', return_value=PROBE), \
+                mock.patch.object(removed_suppliers, 'load_removed_suppliers', return_value=fresh) as load:
+            self.assertIn(1, get_removed_suppliers(ttl=60, path=self.path))
+            load.assert_not_called()
+            self.assertIn(2, get_removed_suppliers(ttl=60, path=self.path, refresh=True))
+        with mock.patch.object(removed_suppliers, 'probe_suppliers', return_value=(101, 4, '501')), \
+                mock.patch.object(removed_suppliers, 'load_removed_suppliers', return_value=fresh) as load:
+            # Кэш уже перезаписан свежей картой с новой пробой
+            self.assertIn(2, get_removed_suppliers(ttl=60, path=self.path))
+            load.assert_not_called()
+            self.assertIn(2, get_removed_suppliers(ttl=0, path=self.path))
+            load.assert_called_once()
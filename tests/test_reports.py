@@ -0,0 +1,147 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from management.commands import _reports
+from management.commands._plan import PlanGroup, write_plan
+from management.commands._reports import (
+    DELETED, DUPLICATE, KEPT, MASTER, SLAVE, ReportGroups, diff_groups, iter_report_events,
+)
+
+PREVIEW_MERGE = """=== ПРЕДВАРИТЕЛЬНЫЙ ПРОСМОТР ОБЪЕДИНЕНИЯ ===
+
+Конкурент: Тест
+Всего артикулов для объединения: 2
+
+Артикул: 'AB 12'
+Мастер-товар: 10 (последнее обновление: 2024-01-01)
+Подчинённый товар: 12 (последнее обновление: 2023-01-01)
+Подчинённый товар: 11 (последнее обновление: None)
+
+Артикул: 'cd'
+Мастер-товар: 20 (последнее обновление: 2024-01-01)
+Подчинённый товар: 21 (последнее обновление: 2023-01-01)
+"""
+
+DUPLICATES_REPORT = """Артикул: AB 12
+Оставляем товар:
+  ID: 10
+  URL: https://shop.ru/p
+Удаляем товары:
+  ID: 11
+  ID: 12
+"""
+
+PREVIEW_DELETION = """Артикул: 'x1'
+Сохраняемый товар (без параметров): 5 - https://shop.ru/x
+К удалению: 6 - https://shop.ru/x?a=1
+"""
+
+DATE_DUPLICATE = """Артикул: ' A1', Кол-во с пробелами: 2, Всего: 3
+"""
+
+CHECK_LOG = """Найдено:
+  1. ID: 7, Артикул: 'Z9'
+"""
+
+MERGE_RESULT = """Артикул: AB 12
+Мастер-товар ID: 10
+  Подчинённый товар 1 (ID: 11): 3 записей истории
+Подчинённый товар ID: 12
+Перенесено на мастер-товар ID: 10
+"""
+
+
+class ReportsTestCase(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    def events(self, path):
+        return [(article, item_id, role) for _, article, item_id, role in iter_report_events(path)]
+
+
+class IterReportEventsTests(ReportsTestCase):
+    def test_preview_merge(self):
+        self.assertEqual(self.events(self.write('preview.txt', PREVIEW_MERGE)), [
+            ('AB 12', 10, MASTER), ('AB 12', 12, SLAVE), ('AB 12', 11, SLAVE),
+            ('cd', 20, MASTER), ('cd', 21, SLAVE),
+        ])
+
+    def test_remove_duplicate_items_report(self):
+        self.assertEqual(self.events(self.write('report.txt', DUPLICATES_REPORT)), [
+            ('AB 12', 10, KEPT), ('AB 12', 11, DELETED), ('AB 12', 12, DELETED),
+        ])
+
+    def test_preview_deletion(self):
+        self.assertEqual(self.events(self.write('deletion.txt', PREVIEW_DELETION)), [
+            ('x1', 5, KEPT), ('x1', 6, DELETED),
+        ])
+
+    def test_date_duplicate_report_has_no_ids(self):
+        self.assertEqual(self.events(self.write('dates.txt', DATE_DUPLICATE)), [(' A1', None, DUPLICATE)])
+
+    def test_check_report_log(self):
+        self.assertEqual(self.events(self.write('check.log', CHECK_LOG)), [('Z9', 7, KEPT)])
+
+    def test_merge_result_detail_follows_the_master(self):
+        self.assertEqual(self.events(self.write('result.txt', MERGE_RESULT)), [
+            ('AB 12', 10, MASTER), ('AB 12', 11, SLAVE), ('AB 12', 12, SLAVE),
+        ])
+
+    def test_offsets_point_at_lines_across_chunks(self):
+        path = self.write('preview.txt', PREVIEW_MERGE)
+        with open(path, 'rb') as f:
+            data = f.read()
+        with mock.patch.object(_reports, 'CHUNK_SIZE', 16):
+            events = list(iter_report_events(path))
+        self.assertEqual(len(events), 5)
+        for offset, _, item_id, _ in events:
+            line = data[offset:data.index(b'\n', offset)].decode('utf-8')
+            self.assertIn(str(item_id), line)
+
+    def test_plan_file(self):
+        path = os.path.join(self.directory, 'plan.jsonl.gz')
+        write_plan(path, {'competitor_id': 1}, [PlanGroup('ab12', 10, [11, 12])])
+        self.assertEqual(self.events(path), [('ab12', 10, MASTER), ('ab12', 11, SLAVE), ('ab12', 12, SLAVE)])
+
+
+class DiffGroupsTests(ReportsTestCase):
+    def groups(self, name, text):
+        return ReportGroups(self.write(name, text))
+
+    def test_report_groups_are_keyed_case_insensitively(self):
+        groups = self.groups('preview.txt', PREVIEW_MERGE)
+        self.assertEqual(groups.keys, ['ab 12', 'cd'])
+        self.assertEqual(list(groups.masters), [10, 20])
+        self.assertEqual(list(groups.slaves_at(0)), [11, 12])
+        self.assertEqual(groups.slave_count, 3)
+
+    def test_same_groups_in_different_formats_are_unchanged(self):
+        old = self.groups('preview.txt', PREVIEW_MERGE)
+        new = self.groups('report.txt', DUPLICATES_REPORT)
+        diff = diff_groups(old, new)
+        self.assertEqual(diff.removed, ['cd'])
+        self.assertEqual(diff.added, [])
+        self.assertEqual(diff.unchanged, 1)
+
+    def test_master_and_slave_changes(self):
+        old = self.groups('old.txt', PREVIEW_MERGE)
+        new = self.groups('new.txt', PREVIEW_MERGE.replace('Мастер-товар: 20', 'Мастер-товар: 22')
+                          .replace('Подчинённый товар: 11', 'Подчинённый товар: 13')
+                          + "\nАртикул: 'ef'\nМастер-товар: 30 (-)\nПодчинённый товар: 31 (-)\n")
+        diff = diff_groups(old, new)
+        self.assertEqual(diff.added, ['ef'])
+        self.assertEqual(diff.removed, [])
+        self.assertEqual(diff.master_changed, [('cd', 20, 22)])
+        self.assertEqual(diff.slaves_changed, [('ab 12', [11], [13])])
+        self.assertEqual(diff.unchanged, 0)
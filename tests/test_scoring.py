@@ -0,0 +1,71 @@
+from datetime import datetime
+from unittest import mock
+
+from django.test import SimpleTestCase
+from kenny.items.models import ItemInfoHistory
+
+from management.commands._records import ItemRecord
+from management.commands._scoring import MasterSelector
+
+
+def item(item_id, created, url='https://shop.ru/p', article='A1'):
+    return ItemRecord(item_id, article, datetime(2024, 1, created), url, 'a1')
+
+
+def masters(selector, groups):
+    return [(key, master.id, [slave.id for slave in slaves]) for key, master, slaves in selector.select(groups)]
+
+
+class MasterSelectorTests(SimpleTestCase):
+    def test_unknown_rule(self):
+        with self.assertRaises(ValueError):
+            MasterSelector('newest')
+
+    def test_clean_url_prefers_newest_clean_item(self):
+        group = [item(1, 1), item(2, 3, 'https://shop.ru/p?a=1'), item(3, 2), item(4, 4, 'https://shop.ru/p%3Fa=1')]
+        self.assertEqual(masters(MasterSelector('clean_url'), [('a1', group)]), [('a1', 3, [1, 2, 4])])
+
+    def test_clean_url_falls_back_to_oldest(self):
+        group = [item(1, 3, 'https://shop.ru/p?a=1'), item(2, 1, 'https://shop.ru/p?b=1')]
+        self.assertEqual(masters(MasterSelector('clean_url'), [('a1', group)]), [('a1', 2, [1])])
+
+    def test_leading_space_prefers_first_spaced_item(self):
+        group = [item(1, 5), item(2, 1, article=' A1'), item(3, 2, article=' A1')]
+        self.assertEqual(masters(MasterSelector('leading_space'), [('a1', group)]), [('a1', 2, [3, 1])])
+
+    def test_leading_space_falls_back_to_newest(self):
+        group = [item(1, 1), item(2, 3), item(3, 2)]
+        self.assertEqual(masters(MasterSelector('leading_space'), [('a1', group)]), [('a1', 2, [3, 1])])
+
+    def test_latest_info_uses_aggregate_and_creation_date(self):
+        group = [item(1, 1), item(2, 2), item(3, 3)]
+        latest = {1: datetime(2024, 2, 1)}
+        with mock.patch.object(MasterSelector, 'aggregate', return_value=latest) as aggregate:
+            selector = MasterSelector('latest_info')
+            self.assertEqual(masters(selector, [('a1', group)]), [('a1', 1, [3, 2])])
+        self.assertEqual(aggregate.call_count, 1)
+        self.assertEqual(selector.value('latest_info_datetime', group[2]), datetime(2024, 1, 3))
+
+    def test_ties_keep_group_order(self):
+        group = [item(1, 1), item(2, 1), item(3, 1)]
+        with mock.patch.object(MasterSelector, 'aggregate', return_value={1: 4, 2: 4, 3: 4}):
+            self.assertEqual(masters(MasterSelector('most_history'), [('a1', group)]), [('a1', 1, [2, 3])])
+
+    def test_groups_are_selected_independently_in_order(self):
+        groups = [('b', [item(1, 1), item(2, 2)]), ('a', [item(3, 2), item(4, 1)])]
+        def aggregate(model, ids, expression):
+            return {1: 1, 2: 5, 3: 2, 4: 2} if model is ItemInfoHistory else {}
+
+        with mock.patch.object(MasterSelector, 'aggregate', side_effect=aggregate):
+            selector = MasterSelector('most_history', extra_features=('latest_info_date',))
+            self.assertEqual(masters(selector, groups), [('b', 2, [1]), ('a', 3, [4])])
+        self.assertIn('latest_info_datetime', selector.values)
+
+    def test_aggregate_chunks_ids(self):
+        selector = MasterSelector('most_history', chunk_size=2)
+        model = mock.Mock()
+        query = model.objects.using.return_value.filter.return_value.values.return_value.annotate.return_value
+        query.values_list.side_effect = [[(1, 3), (2, 0)], [(3, 1)]]
+        self.assertEqual(selector.aggregate(model, [1, 2, 3], 'expression'), {1: 3, 2: 0, 3: 1})
+        self.assertEqual([c.kwargs for c in model.objects.using.return_value.filter.call_args_list],
+                         [{'item_id__in': [1, 2]}, {'item_id__in': [3]}])
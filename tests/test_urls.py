@@ -0,0 +1,55 @@
+import hashlib
+import uuid
+
+from django.test import SimpleTestCase
+
+from management.commands._urls import canonical_url, is_tracking_param, url_hash
+
+
+class CanonicalUrlTests(SimpleTestCase):
+    def test_scheme_www_port_and_trailing_slash_are_ignored(self):
+        for url in ('http://www.Example.com:80/a/b/', 'https://example.com/a/b', 'https://EXAMPLE.com:443/a/b',
+                    'example.com/a/b/', '//www.example.com/a/b'):
+            with self.subTest(url=url):
+                self.assertEqual(canonical_url(url), 'example.com/a/b')
+
+    def test_non_default_port_is_kept(self):
+        self.assertEqual(canonical_url('http://shop.ru:8080/p'), 'shop.ru:8080/p')
+
+    def test_tracking_params_are_dropped_and_the_rest_sorted(self):
+        self.assertEqual(canonical_url('https://shop.ru/p?utm_source=x&b=2&a=1&yclid=5'), 'shop.ru/p?a=1&b=2')
+        self.assertEqual(canonical_url('https://shop.ru/p?utm_medium=cpc&gclid=1'), 'shop.ru/p')
+
+    def test_blank_param_values_are_kept(self):
+        self.assertEqual(canonical_url('https://shop.ru/p?x='), 'shop.ru/p?x=')
+
+    def test_encoded_question_mark_starts_the_query(self):
+        self.assertEqual(canonical_url('https://shop.ru/p%3Fb=2&a=1'), 'shop.ru/p?a=1&b=2')
+        self.assertEqual(canonical_url('https://shop.ru/p%3fa=1'), 'shop.ru/p?a=1')
+
+    def test_fragment_is_dropped(self):
+        self.assertEqual(canonical_url('https://shop.ru/p#reviews'), 'shop.ru/p')
+
+    def test_path_keeps_case_and_uses_one_percent_encoding(self):
+        self.assertNotEqual(canonical_url('https://shop.ru/A'), canonical_url('https://shop.ru/a'))
+        self.assertEqual(canonical_url('https://shop.ru/café'), canonical_url('https://shop.ru/caf%C3%A9'))
+
+    def test_root_path_and_empty_values(self):
+        self.assertEqual(canonical_url('https://shop.ru/'), 'shop.ru/')
+        self.assertEqual(canonical_url(''), '')
+        self.assertEqual(canonical_url(None), '')
+        self.assertEqual(canonical_url('   '), '')
+
+    def test_is_tracking_param(self):
+        self.assertTrue(is_tracking_param('UTM_Campaign'))
+        self.assertTrue(is_tracking_param('yclid'))
+        self.assertFalse(is_tracking_param('color'))
+
+
+class UrlHashTests(SimpleTestCase):
+    def test_matches_postgres_md5_uuid_of_canonical_url(self):
+        expected = str(uuid.UUID(hashlib.md5('shop.ru/p'.encode('utf-8')).hexdigest()))
+        self.assertEqual(url_hash('https://shop.ru/p'), expected)
+
+    def test_variants_of_one_url_share_a_hash(self):
+        self.assertEqual(url_hash('https://shop.ru/p?utm_source=x'), url_hash('http://www.shop.ru/p/'))
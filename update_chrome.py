@@ -1,109 +1,311 @@
 #!/usr/bin/env python3
 """
 Обновить ТОЛЬКО Chrome браузер, не трогая chromedriver.
+
+Каждая версия ставится в свой каталог chrome/chrome-versions/<версия>,
+а chrome/chrome-linux - это симлинк на текущую версию. Переключение
+делается атомарной заменой симлинка (os.replace), поэтому парсер,
+запущенный во время обновления, всегда видит полностью распакованный
+бинарник: либо старый, либо новый. Последние N версий остаются на диске
+для мгновенного отката. Рядом с каждым бинарником пишется install.json
+с версией, чтобы check_chrome.get_chrome_version() не запускал браузер.
+
+Использование (из корня проекта):
+    python update_chrome.py                  # скачать и переключиться на новую версию
+    python update_chrome.py --keep 5         # хранить 5 последних версий
+    python update_chrome.py --list           # показать установленные версии
+    python update_chrome.py --rollback       # откатиться на предыдущую версию
+    python update_chrome.py --rollback 128.0.6613.84
+    python update_chrome.py --prune          # удалить лишние старые версии
 """
 
+import argparse
 import os
+import re
 import shutil
 import tempfile
 import subprocess
+import urllib.request
+from datetime import datetime
 from pathlib import Path
 
+from check_chrome import get_chrome_version, write_install_metadata
+
+CHROME_URL = "https://dl.google.com/linux/direct/google-chrome-stable_current_amd64.deb"
+DEFAULT_KEEP = 3
+
+
+def get_paths(project_root=None):
+    """Пути к каталогам Chrome в проекте."""
+    chrome_root = (project_root or Path.cwd()) / "chrome"
+    return {
+        'root': chrome_root,
+        'current': chrome_root / "chrome-linux",
+        'versions': chrome_root / "chrome-versions",
+        'chromedriver': chrome_root / "chromedriver-linux64",
+    }
+
+
+def version_key(version):
+    """Ключ сортировки версий: 128.0.6613.84 -> (1, (128, 0, 6613, 84)).
+
+    Нечисловые имена (например, legacy-каталоги) идут раньше любых версий.
+    """
+    parts = version.split('.')
+    if all(part.isdigit() for part in parts):
+        return 1, tuple(int(part) for part in parts)
+    return 0, (version,)
+
+
+def run_version(chrome_binary):
+    """Запустить бинарник с --version. Возвращает строку версии или None."""
+    try:
+        result = subprocess.run(
+            [str(chrome_binary), '--version'],
+            capture_output=True,
+            text=True,
+            timeout=5
+        )
+    except Exception:
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip()
+
+
+def list_versions(paths):
+    """Установленные версии, от старой к новой."""
+    if not paths['versions'].exists():
+        return []
+    versions = [
+        entry.name for entry in paths['versions'].iterdir()
+        if entry.is_dir() and not entry.name.startswith('.')
+    ]
+    return sorted(versions, key=version_key)
+
+
+def current_version(paths):
+    """Версия, на которую указывает симлинк chrome-linux (или None)."""
+    if not paths['current'].is_symlink():
+        return None
+    return Path(os.readlink(paths['current'])).name
+
+
+def switch_to(paths, version):
+    """Атомарно переключить chrome-linux на указанную версию.
+
+    Новый симлинк создается рядом под временным именем и переименовывается
+    поверх старого: rename(2) атомарен, промежуточного состояния
+    "браузера нет" не бывает.
+    """
+    target = paths['versions'] / version
+    if not (target / "chrome").exists():
+        raise FileNotFoundError(f"В {target} нет бинарника chrome")
+
+    tmp_link = paths['root'] / f".chrome-linux.{os.getpid()}.tmp"
+    if tmp_link.is_symlink() or tmp_link.exists():
+        tmp_link.unlink()
+    # Относительный путь, чтобы проект можно было переносить целиком
+    os.symlink(os.path.join(paths['versions'].name, version), tmp_link)
+    os.replace(tmp_link, paths['current'])
+
+
+def migrate_legacy_dir(paths):
+    """Перенести старый обычный каталог chrome-linux в chrome-versions.
+
+    Выполняется один раз: каталог переименовывается (rename в пределах одной
+    ФС) и сразу заменяется симлинком.
+    """
+    current = paths['current']
+    if current.is_symlink() or not current.is_dir():
+        return
+
+    try:
+        info = get_chrome_version(current / "chrome")
+    except Exception:
+        info = None
+    match = re.search(r'(\d+(?:\.\d+)+)', info.version if info else '')
+    version = match.group(1) if match else f"legacy-{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+
+    paths['versions'].mkdir(parents=True, exist_ok=True)
+    target = paths['versions'] / version
+    if target.exists():
+        version = f"{version}-legacy"
+        target = paths['versions'] / version
+
+    print(f"Переношу существующий Chrome в {target}")
+    os.rename(current, target)
+    if info is not None:
+        write_install_metadata(target, version, info.version_line)
+    switch_to(paths, version)
+
+
+def read_deb_version(unpack_dir):
+    """Версия пакета из control-архива deb: 128.0.6613.84-1 -> 128.0.6613.84."""
+    control_tar = next(iter(sorted(unpack_dir.glob("control.tar*"))), None)
+    if control_tar is None:
+        return None
+
+    control_dir = unpack_dir / "control"
+    control_dir.mkdir(exist_ok=True)
+    subprocess.run(["tar", "-xf", str(control_tar), "-C", str(control_dir)], check=True)
+
+    control_file = control_dir / "control"
+    for line in control_file.read_text(encoding='utf-8').splitlines():
+        if line.startswith('Version:'):
+            return line.split(':', 1)[1].strip().rsplit('-', 1)[0]
+    return None
+
+
+def prune_versions(paths, keep):
+    """Удалить старые версии, оставив keep последних и текущую."""
+    versions = list_versions(paths)
+    current = current_version(paths)
+    removable = [v for v in versions if v != current]
+    # Текущая версия всегда входит в число сохраняемых
+    keep_others = max(keep - (1 if current in versions else 0), 0)
+    to_remove = removable[:max(len(removable) - keep_others, 0)]
+
+    for version in to_remove:
+        print(f"Удаляю старую версию: {version}")
+        shutil.rmtree(paths['versions'] / version)
+    return to_remove
+
 
-def update_chrome_only():
+def rollback(paths, version=None):
+    """Откатиться на указанную или предыдущую установленную версию."""
+    versions = list_versions(paths)
+    current = current_version(paths)
+
+    if version is None:
+        older = [v for v in versions if current is None or version_key(v) < version_key(current)]
+        if not older:
+            print("❌ Нет предыдущей версии для отката")
+            return False
+        version = older[-1]
+
+    if version not in versions:
+        print(f"❌ Версия {version} не установлена")
+        return False
+
+    switch_to(paths, version)
+    print(f"✅ Chrome переключен: {current} -> {version}")
+    return True
+
+
+def update_chrome_only(keep=DEFAULT_KEEP):
     """Обновить Chrome браузер в проекте."""
 
-    project_root = Path.cwd()
-    chrome_dir = project_root / "chrome" / "chrome-linux"
-    chromedriver_dir = project_root / "chrome" / "chromedriver-linux64"
+    paths = get_paths()
 
     print("=" * 60)
     print("Обновление Chrome браузера (сохраняем ChromeDriver)")
     print("=" * 60)
 
     # Проверить что chromedriver на месте
-    if not chromedriver_dir.exists():
-        print(f"⚠ ChromeDriver не найден: {chromedriver_dir}")
+    if not paths['chromedriver'].exists():
+        print(f"⚠ ChromeDriver не найден: {paths['chromedriver']}")
         response = input("Продолжить? (y/n): ")
         if response.lower() != 'y':
             return False
 
-    # Проверить текущий Chrome
-    chrome_binary = chrome_dir / "chrome"
-    if chrome_binary.exists():
-        try:
-            result = subprocess.run(
-                [chrome_binary, '--version'],
-                capture_output=True,
-                text=True
-            )
-            if result.returncode == 0:
-                print(f"Текущий Chrome: {result.stdout.strip()}")
-        except:
-            pass
-
-    # Удалить старый Chrome (браузер)
-    if chrome_dir.exists():
-        print(f"Удаляю старый Chrome: {chrome_dir}")
-        shutil.rmtree(chrome_dir)
-
-    # Создать временную папку
-    with tempfile.TemporaryDirectory() as temp_dir:
+    # Проверить текущий Chrome (без запуска, если есть install.json)
+    try:
+        info = get_chrome_version(paths['current'] / "chrome")
+    except Exception:
+        info = None
+    if info:
+        print(f"Текущий Chrome: {info.version_line}")
+
+    # Старый каталог не удаляем: он становится одной из версий для отката
+    migrate_legacy_dir(paths)
+    paths['versions'].mkdir(parents=True, exist_ok=True)
+
+    # Временная папка на той же ФС, что и chrome-versions, чтобы rename был атомарным
+    with tempfile.TemporaryDirectory(dir=paths['root'], prefix='.chrome-update-') as temp_dir:
         temp_path = Path(temp_dir)
 
         print("Скачиваю новый Chrome...")
-
-        # Скачать Chrome
         deb_file = temp_path / "chrome.deb"
-        chrome_url = "https://dl.google.com/linux/direct/google-chrome-stable_current_amd64.deb"
-
-        # Используем curl или wget
-        import urllib.request
-        urllib.request.urlretrieve(chrome_url, deb_file)
+        urllib.request.urlretrieve(CHROME_URL, deb_file)
 
         # Распаковать deb
         print("Распаковываю...")
         subprocess.run(["ar", "x", deb_file], cwd=temp_path, check=True)
 
-        # Извлечь data.tar.xz
-        data_tar = temp_path / "data.tar.xz"
-        if data_tar.exists():
-            subprocess.run(["tar", "-xf", "data.tar.xz"], cwd=temp_path, check=True)
+        version = read_deb_version(temp_path)
+        if not version:
+            print("❌ Не удалось определить версию пакета")
+            return False
+        print(f"Версия пакета: {version}")
+
+        if version in list_versions(paths):
+            print(f"Версия {version} уже установлена, только переключаю")
+            switch_to(paths, version)
+            prune_versions(paths, keep)
+            return True
+
+        # Извлечь data.tar.*
+        data_tar = next(iter(sorted(temp_path.glob("data.tar*"))), None)
+        if data_tar is None:
+            print("❌ Не удалось найти data.tar в пакете")
+            return False
+        subprocess.run(["tar", "-xf", data_tar.name], cwd=temp_path, check=True)
 
         # Найти Chrome в распакованных файлах
         chrome_source = temp_path / "opt" / "google" / "chrome"
-
-        if chrome_source.exists():
-            # Скопировать в проект
-            print(f"Копирую в проект: {chrome_dir}")
-            shutil.copytree(chrome_source, chrome_dir)
-
-            # Дать права
-            chrome_binary = chrome_dir / "chrome"
-            if chrome_binary.exists():
-                os.chmod(chrome_binary, 0o755)
-
-                # Проверить
-                result = subprocess.run(
-                    [chrome_binary, '--version'],
-                    capture_output=True,
-                    text=True
-                )
-                if result.returncode == 0:
-                    print(f"✅ Новый Chrome: {result.stdout.strip()}")
-                    return True
-                else:
-                    print("❌ Не удалось проверить новую версию")
-                    return False
-            else:
-                print("❌ Chrome не найден в распакованных файлах")
-                return False
-        else:
+        if not chrome_source.exists():
             print("❌ Не удалось найти Chrome в архиве")
             return False
 
+        chrome_binary = chrome_source / "chrome"
+        if not chrome_binary.exists():
+            print("❌ Chrome не найден в распакованных файлах")
+            return False
+        os.chmod(chrome_binary, 0o755)
+
+        # Проверяем новый бинарник ДО переключения
+        new_version_line = run_version(chrome_binary)
+        if not new_version_line:
+            print("❌ Не удалось проверить новую версию, текущий Chrome не тронут")
+            return False
+
+        # Метаданные для get_chrome_version(): дальше версию можно узнать без запуска
+        write_install_metadata(chrome_source, version, new_version_line)
+
+        # Переносим готовый каталог в chrome-versions одним rename
+        target = paths['versions'] / version
+        print(f"Устанавливаю в: {target}")
+        os.rename(chrome_source, target)
+
+    switch_to(paths, version)
+    print(f"✅ Новый Chrome: {new_version_line}")
+    prune_versions(paths, keep)
+    return True
+
+
+def print_versions(paths):
+    current = current_version(paths)
+    versions = list_versions(paths)
+    if not versions:
+        print("Установленных версий нет")
+        return
+    print("Установленные версии:")
+    for version in versions:
+        marker = " <- текущая" if version == current else ""
+        print(f"  {version}{marker}")
+
 
 def main():
+    parser = argparse.ArgumentParser(description="Обновление Chrome браузера с хранением версий для отката")
+    parser.add_argument('--keep', type=int, default=DEFAULT_KEEP,
+                        help=f'Сколько последних версий хранить (по умолчанию: {DEFAULT_KEEP})')
+    parser.add_argument('--rollback', nargs='?', const='', metavar='VERSION',
+                        help='Откатиться на предыдущую (или указанную) версию')
+    parser.add_argument('--prune', action='store_true', help='Только удалить лишние старые версии')
+    parser.add_argument('--list', action='store_true', help='Показать установленные версии')
+    args = parser.parse_args()
+
     print("Скрипт обновления Chrome браузера")
     print("Сохраняет ChromeDriver для других парсеров")
     print("-" * 60)
@@ -114,7 +316,24 @@ def main():
         print("Запустите скрипт из корня проекта")
         return
 
-    if update_chrome_only():
+    paths = get_paths()
+
+    if args.list:
+        print_versions(paths)
+        return
+
+    if args.rollback is not None:
+        migrate_legacy_dir(paths)
+        rollback(paths, args.rollback or None)
+        return
+
+    if args.prune:
+        migrate_legacy_dir(paths)
+        removed = prune_versions(paths, max(args.keep, 1))
+        print(f"Удалено версий: {len(removed)}")
+        return
+
+    if update_chrome_only(keep=max(args.keep, 1)):
         print("\n" + "=" * 60)
         print("✅ Chrome браузер успешно обновлен!")
         print("✅ ChromeDriver сохранен!")
@@ -134,4 +353,4 @@ if __name__ == "__main__":
         print(f"\n❌ Ошибка: {e}")
         import traceback
 
-        traceback.print_exc()
\ No newline at end of file
+        traceback.print_exc()